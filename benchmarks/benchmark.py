@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# Benchmarks the hot paths of wsl-windows-toolbar against synthetic menus and icon themes. Runs on stock linux: the
+# windows tools are replaced by stubs on the $PATH and the "C: drive" is just a directory, so nothing here needs WSL.
+#
+#   python benchmarks/benchmark.py --sizes 10,100,1000,5000
+#
+# Each size runs in its own process so that timings and peak memory use don't bleed between runs.
+import collections
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DISTRIBUTION = "Bench"
+WINDOWS_USER = "bench"
+CATEGORIES = ["Utility", "Development", "Graphics", "Office", "Network", "AudioVideo", "Game", "System"]
+ICON_FORMATS = ["png", "svg", "xpm"]
+
+# Phases reported, in the order they run
+PHASES = collections.OrderedDict([
+    ("menu", "Parse menu and collect desktop entries"),
+    ("menu_cached", "Load desktop entries from the menu cache"),
+    ("icon_index", "Index icon themes"),
+    ("plan", "Look up icons and render launchers"),
+    ("icons", "Convert icons"),
+    ("apply", "Write launchers and shortcuts"),
+    ("inventory", "Take an inventory of the installed files"),
+    ("replan", "Plan again with nothing changed")
+])
+
+# Speaks just enough of the shortcut writer protocol to acknowledge every shortcut and flush
+STUB_POWERSHELL = r'''#!/usr/bin/env python3
+import re
+import sys
+
+for line in sys.stdin:
+    match = re.search(r"Write-Output '(\S+) (OK|FLUSH) (\d+)'", line)
+    if match:
+        sys.stdout.write("%s %s %s\n" % match.groups())
+        sys.stdout.flush()
+'''
+
+STUB_CMD = r'''#!/bin/sh
+case "$*" in
+    *%%APPDATA%%*) printf '%%s\n' 'C:\Users\%(user)s\AppData\Roaming' ;;
+    *%%USERPROFILE%%*) printf '%%s\n' 'C:\Users\%(user)s' ;;
+esac
+'''
+
+STUB_WSLPATH = r'''#!/bin/sh
+if [ "$1" = "-w" ]; then
+    shift; [ "$1" = "-a" ] && shift
+    printf '\\\\wsl.localhost\\%(distribution)s%%s\n' "$(printf '%%s' "$1" | tr '/' '\\')"
+else
+    printf '%%s\n' "$1"
+fi
+'''
+
+# Copies a tree like robocopy.exe /E, between the fake C: drive and \\wsl.localhost paths as the wslpath stub makes them
+STUB_ROBOCOPY = r'''#!/usr/bin/env python3
+import os
+import shutil
+import sys
+
+
+def to_linux_path(path):
+    prefix = "\\\\wsl.localhost\\%(distribution)s"
+    if path.startswith(prefix):
+        return path[len(prefix):].replace("\\", "/")
+    return os.path.join(%(drive)r, *path[3:].split("\\"))
+
+
+shutil.copytree(to_linux_path(sys.argv[1]), to_linux_path(sys.argv[2]), dirs_exist_ok=True)
+sys.exit(1)
+'''
+
+STUB_SUCCESS = "#!/bin/sh\nexit 0\n"
+
+ICON_THEME = """[Icon Theme]
+Name=Hicolor
+Comment=Benchmark theme
+Directories=16x16/apps,48x48/apps,scalable/apps
+
+[16x16/apps]
+Size=16
+Context=Applications
+Type=Threshold
+
+[48x48/apps]
+Size=48
+Context=Applications
+Type=Threshold
+
+[scalable/apps]
+MinSize=1
+Size=128
+MaxSize=256
+Context=Applications
+Type=Scalable
+"""
+
+SVG_ICON = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="128" height="128" viewBox="0 0 128 128">
+  <rect x="8" y="8" width="112" height="112" rx="16" fill="#%06x"/>
+  <circle cx="64" cy="64" r="%d" fill="#ffffff"/>
+</svg>
+"""
+
+DESKTOP_ENTRY = """[Desktop Entry]
+Type=Application
+Name=Benchmark App %(index)d
+Comment=Synthetic application number %(index)d
+Exec=bench-app-%(index)d --option %%U
+Icon=bench-icon-%(index)d
+Terminal=%(terminal)s
+Categories=%(category)s;
+"""
+
+
+def write_executable(path, content):
+    with open(path, "w") as handle:
+        handle.write(content)
+    os.chmod(path, 0o755)
+
+
+def write_stubs(bin_directory, drive_directory):
+    os.makedirs(bin_directory, exist_ok=True)
+    write_executable(os.path.join(bin_directory, "powershell.exe"), STUB_POWERSHELL)
+    write_executable(os.path.join(bin_directory, "cmd.exe"), STUB_CMD % {"user": WINDOWS_USER})
+    write_executable(os.path.join(bin_directory, "wslpath"), STUB_WSLPATH % {"distribution": DISTRIBUTION})
+    write_executable(os.path.join(bin_directory, "robocopy.exe"), STUB_ROBOCOPY % {
+        "distribution": DISTRIBUTION,
+        "drive": drive_directory
+    })
+    for exe in ["attrib.exe", "wscript.exe"]:
+        write_executable(os.path.join(bin_directory, exe), STUB_SUCCESS)
+
+
+def write_xpm_icon(path, size, color):
+    # Two colour XPM with a border so it is not trivially compressible
+    rows = ["#" * size] + ["#" + "." * (size - 2) + "#" for i in range(size - 2)] + ["#" * size]
+    with open(path, "w") as handle:
+        handle.write("/* XPM */\nstatic char *icon[] = {\n")
+        handle.write('"%d %d 2 1",\n"# c #%06x",\n". c #ffffff",\n' % (size, size, color))
+        handle.write(",\n".join('"%s"' % row for row in rows))
+        handle.write("};\n")
+
+
+def write_icon_theme(share_directory, count):
+    from PIL import Image, ImageDraw
+    theme_directory = os.path.join(share_directory, "icons", "hicolor")
+    for directory in ["16x16/apps", "48x48/apps", "scalable/apps"]:
+        os.makedirs(os.path.join(theme_directory, directory), exist_ok=True)
+    with open(os.path.join(theme_directory, "index.theme"), "w") as handle:
+        handle.write(ICON_THEME)
+
+    for index in range(count):
+        # Every icon gets its own colour so none of them are identical as far as the icon cache is concerned
+        color = (index * 2654435761) & 0xffffff
+        name = "bench-icon-%d" % index
+        icon_format = ICON_FORMATS[index % len(ICON_FORMATS)]
+        if icon_format == "svg":
+            with open(os.path.join(theme_directory, "scalable", "apps", name + ".svg"), "w") as handle:
+                handle.write(SVG_ICON % (color, 16 + index % 40))
+        elif icon_format == "xpm":
+            write_xpm_icon(os.path.join(theme_directory, "48x48", "apps", name + ".xpm"), 48, color)
+        else:
+            for size in [16, 48]:
+                image = Image.new("RGBA", (size, size), (color >> 16, (color >> 8) & 0xff, color & 0xff, 255))
+                ImageDraw.Draw(image).ellipse((size // 4, size // 4, size * 3 // 4, size * 3 // 4), fill="white")
+                image.save(os.path.join(theme_directory, "%dx%d" % (size, size), "apps", name + ".png"))
+
+
+def write_menu(fixture_directory, count):
+    applications_directory = os.path.join(fixture_directory, "applications")
+    os.makedirs(applications_directory, exist_ok=True)
+    for index in range(count):
+        with open(os.path.join(applications_directory, "bench-app-%d.desktop" % index), "w") as handle:
+            handle.write(DESKTOP_ENTRY % {
+                "index": index,
+                "terminal": "true" if index % 10 == 0 else "false",
+                "category": CATEGORIES[index % len(CATEGORIES)]
+            })
+
+    menu_file = os.path.join(fixture_directory, "bench-applications.menu")
+    with open(menu_file, "w") as handle:
+        handle.write('<!DOCTYPE Menu PUBLIC "-//freedesktop//DTD Menu 1.0//EN" '
+                     '"http://www.freedesktop.org/standards/menu-spec/1.0/menu.dtd">\n')
+        handle.write("<Menu>\n  <Name>Applications</Name>\n  <AppDir>%s</AppDir>\n" % applications_directory)
+        for category in CATEGORIES:
+            handle.write("  <Menu><Name>%s</Name><Include><Category>%s</Category></Include></Menu>\n" % (
+                category, category))
+        handle.write("</Menu>\n")
+    return menu_file
+
+
+def create_fixture(fixture_directory, count):
+    write_icon_theme(os.path.join(fixture_directory, "share"), count)
+    write_menu(fixture_directory, count)
+    os.makedirs(os.path.join(fixture_directory, "c", "Users", WINDOWS_USER), exist_ok=True)
+
+
+def get_fixture_environment(fixture_directory):
+    env = dict(os.environ)
+    env.update({
+        "PATH": os.path.join(fixture_directory, "bin") + os.pathsep + os.environ.get("PATH", ""),
+        "XDG_DATA_DIRS": os.path.join(fixture_directory, "share"),
+        "XDG_CACHE_HOME": os.path.join(fixture_directory, "cache"),
+        "WSL_DISTRO_NAME": DISTRIBUTION,
+        "PYTHONPATH": REPOSITORY_DIRECTORY + os.pathsep + os.environ.get("PYTHONPATH", "")
+    })
+    return env
+
+
+def run_worker(fixture_directory, shortcut_backend, jobs, launcher_mode, write_mode):
+    # Runs inside the fixture environment (see get_fixture_environment) so the module picks up the synthetic themes
+    import wsl_windows_toolbar as toolbar
+    from jinja2 import Environment, FileSystemLoader
+    logging.getLogger(toolbar.__name__).setLevel(logging.ERROR)
+
+    # The fake C: drive stands in for /mnt/c
+    drive_directory = os.path.join(fixture_directory, "c")
+    toolbar.HOST_MOUNTS.clear()
+    toolbar.HOST_MOUNTS[drive_directory] = "C:"
+    install_directory = os.path.join(drive_directory, "Users", WINDOWS_USER, "AppData", "Roaming",
+                                     *toolbar.DEFAULT_INSTALL_DIRECTORY_PARTS)
+    metadata_directory = os.path.join(drive_directory, "Users", WINDOWS_USER, *toolbar.DEFAULT_METADATA_DIRECTORY_PARTS)
+    for directory in [install_directory, metadata_directory]:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    env = Environment(loader=FileSystemLoader(REPOSITORY_DIRECTORY))
+    batch_template = env.get_template(toolbar.LAUNCHER_TEMPLATES[launcher_mode][0])
+    shell_template = env.get_template(toolbar.LAUNCHER_TEMPLATES[launcher_mode][1])
+    settings = {
+        "distribution": DISTRIBUTION,
+        "user": WINDOWS_USER,
+        "wsl_executable": "C:\\Windows\\System32\\wsl.exe",
+        "rc_file": os.path.expanduser("~/.bashrc"),
+        "launch_directory": os.path.expanduser("~"),
+        "batch_encoding": None,
+        "use_batch_newline_crlf": False,
+        "shortcut_suffix": " (WSL)",
+        "launcher_mode": launcher_mode,
+        "shortcut_backend": shortcut_backend,
+        "install_directory": install_directory,
+        "metadata_directory": metadata_directory,
+        "preferred_theme": "hicolor",
+        "alternative_theme": []
+    }
+
+    timings = collections.OrderedDict()
+    start = time.perf_counter()
+    menu_file = os.path.join(fixture_directory, "bench-applications.menu")
+    entries = collections.OrderedDict(toolbar.load_menu_entries(menu_file, rebuild=True))
+    timings["menu"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cached_entries = toolbar.load_menu_entries(menu_file)
+    timings["menu_cached"] = time.perf_counter() - start
+    assert isinstance(cached_entries, list) and len(cached_entries) == len(entries), "menu cache was not used"
+
+    start = time.perf_counter()
+    icon_index = toolbar.IconThemeIndex.load(["hicolor"], toolbar.ICON_THEME_INDEX_FILE, rebuild=True)
+    timings["icon_index"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plan = toolbar.plan_menu_items(entries.items(), {}, settings, batch_template, shell_template, icon_index)
+    timings["plan"] = time.perf_counter() - start
+
+    # Convert every icon up front, one at a time so the cost per icon is visible - the apply phase then finds them all
+    # in the icon cache and is left with just the launchers and shortcuts
+    icon_cache = toolbar.IconCache(os.path.join(fixture_directory, "cache", "icons"), 1 << 40)
+    icons_failed = 0
+    start = time.perf_counter()
+    for item in plan["items"]:
+        if item["icon"]["source"]:
+            metadata_prefix = os.path.splitext(item["icon"]["path"])[0]
+            if not toolbar.convert_windows_icon_files(item["icon"]["source"], metadata_prefix, icon_cache):
+                icons_failed += 1
+    timings["icons"] = time.perf_counter() - start
+
+    manifest = {}
+    start = time.perf_counter()
+    staging = toolbar.StagingDirectory() if write_mode == "staged" else None
+    shortcuts_installed = toolbar.apply_plan(plan, manifest, shortcut_backend, jobs, icon_cache, staging=staging)
+    if staging is not None:
+        staging.close()
+    timings["apply"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    inventory = toolbar.FileInventory([settings["install_directory"], settings["metadata_directory"]])
+    timings["inventory"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    replan = toolbar.plan_menu_items(entries.items(), manifest, settings, batch_template, shell_template, icon_index,
+                                     inventory=inventory)
+    timings["replan"] = time.perf_counter() - start
+
+    return {
+        "entries": len(entries),
+        "shortcuts_installed": shortcuts_installed,
+        "shortcuts_unchanged": len(replan["diff"]["unchanged"]),
+        "icons_failed": icons_failed,
+        "timings": timings,
+        "calls": toolbar.report.calls,
+        # ru_maxrss is in KB on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    }
+
+
+def run_benchmark(count, work_directory, shortcut_backend, jobs, launcher_mode, write_mode):
+    fixture_directory = os.path.join(work_directory, "entries-%d" % count)
+    if not os.path.exists(os.path.join(fixture_directory, "bench-applications.menu")):
+        create_fixture(fixture_directory, count)
+    # Stubs are cheap, so always written afresh in case a reused fixture predates any of them
+    write_stubs(os.path.join(fixture_directory, "bin"), os.path.join(fixture_directory, "c"))
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), "--worker", fixture_directory,
+         "--shortcut-backend", shortcut_backend, "--jobs", str(jobs), "--launcher-mode", launcher_mode,
+         "--write-mode", write_mode],
+        env=get_fixture_environment(fixture_directory)
+    )
+    return json.loads(output.decode("utf-8"))
+
+
+def print_results(results):
+    click.echo("%8s  %-40s %10s %14s" % ("entries", "phase", "total (s)", "per entry (ms)"))
+    for result in results:
+        entries = max(result["entries"], 1)
+        for phase, description in PHASES.items():
+            elapsed = result["timings"][phase]
+            click.echo("%8d  %-40s %10.3f %14.3f" % (result["entries"], description, elapsed, elapsed * 1000 / entries))
+        click.echo("%8d  %-40s %10.3f %14.3f" % (
+            result["entries"], "Total", sum(result["timings"].values()),
+            sum(result["timings"].values()) * 1000 / entries))
+        click.echo("%8d  peak rss %.1f MB (children %.1f MB), %d shortcuts, %d icons failed to convert" % (
+            result["entries"], result["peak_rss_mb"], result["peak_child_rss_mb"], result["shortcuts_installed"],
+            result["icons_failed"]))
+        for name, call in sorted(result["calls"].items(), key=lambda call: call[1]["seconds"], reverse=True):
+            click.echo("%8d  %d %s call(s) taking %.3fs" % (result["entries"], call["count"], name, call["seconds"]))
+        click.echo("")
+
+
+@click.command()
+@click.option("--sizes",
+              "-s",
+              default="10,100,1000,5000",
+              show_default=True,
+              help="Comma separated numbers of menu entries to benchmark")
+@click.option("--shortcut-backend",
+              "-b",
+              type=click.Choice(["native", "powershell"]),
+              default="powershell",
+              show_default=True,
+              help="Shortcut writer to benchmark (powershell talks to a stub)")
+@click.option("--launcher-mode",
+              "-L",
+              type=click.Choice(["per-entry", "dispatch"]),
+              default="per-entry",
+              show_default=True,
+              help="Launcher mode to benchmark")
+@click.option("--write-mode",
+              "-x",
+              type=click.Choice(["direct", "staged"]),
+              default="direct",
+              show_default=True,
+              help="Write files in place, or stage them and copy them across with robocopy (talks to a stub)")
+@click.option("--jobs",
+              "-p",
+              type=click.IntRange(min=1),
+              default=1,
+              show_default=True,
+              help="Icon conversion processes used while applying")
+@click.option("--work-directory",
+              "-w",
+              default=None,
+              show_default=False,
+              help="Keep generated fixtures here and reuse them between runs (defaults to a temporary directory)")
+@click.option("--json-file",
+              "-j",
+              type=click.File("w"),
+              default=None,
+              show_default=False,
+              help="Also write the results as JSON to this file ('-' for stdout)")
+@click.option("--worker",
+              default=None,
+              hidden=True)
+def main(sizes, shortcut_backend, launcher_mode, write_mode, jobs, work_directory, json_file, worker):
+    if worker:
+        json.dump(run_worker(worker, shortcut_backend, jobs, launcher_mode, write_mode), sys.stdout)
+        return
+
+    temporary_directory = None
+    if work_directory is None:
+        temporary_directory = work_directory = tempfile.mkdtemp(prefix="wsl-windows-toolbar-benchmark-")
+    try:
+        results = []
+        for count in [int(size) for size in sizes.split(",") if size.strip()]:
+            click.echo("Benchmarking %d entries..." % count, err=True)
+            results.append(run_benchmark(count, work_directory, shortcut_backend, jobs, launcher_mode, write_mode))
+        print_results(results)
+        if json_file:
+            json.dump(results, json_file, indent=1)
+            json_file.write("\n")
+    finally:
+        if temporary_directory is not None:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
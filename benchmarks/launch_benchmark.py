@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# Benchmarks how long a click takes to get an application going, with and without the launch broker. The linux side of
+# the launch is run locally (wsl.exe and the windows end are left out, as they cost the same either way): a generated
+# launcher script is run directly, and the clock stops once the application it starts has begun running.
+#
+#   python benchmarks/launch_benchmark.py --launches 20 --rc-file ~/.bashrc
+import collections
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Longest to wait for a launch before giving up on it
+LAUNCH_TIMEOUT = 60
+
+# Stands in for the application - all it does is show it has started
+MARKER_APPLICATION = "#!/bin/sh\n: > \"%s\"\n"
+
+DESKTOP_ENTRY = """[Desktop Entry]
+Type=Application
+Name=Launch Benchmark
+Exec=%s
+Terminal=false
+"""
+
+MENU = """<!DOCTYPE Menu PUBLIC "-//freedesktop//DTD Menu 1.0//EN"
+ "http://www.freedesktop.org/standards/menu-spec/1.0/menu.dtd">
+<Menu>
+  <Name>Applications</Name>
+  <AppDir>%s</AppDir>
+  <Include><All/></Include>
+</Menu>
+"""
+
+# Launch paths compared, in the order they are reported
+LAUNCH_PATHS = collections.OrderedDict([
+    ("interactive", "Interactive shell sourcing the rc file"),
+    ("broker", "Launch broker")
+])
+
+
+def create_fixture(fixture_directory):
+    marker_file = os.path.join(fixture_directory, "started")
+    application = os.path.join(fixture_directory, "bin", "launch-benchmark")
+    os.makedirs(os.path.dirname(application))
+    with open(application, "w") as handle:
+        handle.write(MARKER_APPLICATION % marker_file)
+    os.chmod(application, 0o755)
+
+    applications_directory = os.path.join(fixture_directory, "applications")
+    os.makedirs(applications_directory)
+    with open(os.path.join(applications_directory, "launch-benchmark.desktop"), "w") as handle:
+        handle.write(DESKTOP_ENTRY % application)
+    menu_file = os.path.join(fixture_directory, "launch-benchmark.menu")
+    with open(menu_file, "w") as handle:
+        handle.write(MENU % applications_directory)
+    return menu_file, marker_file
+
+
+def write_launchers(toolbar, fixture_directory, menu_file, rc_file):
+    # One target per launch path, each with the shell launcher generated for the benchmark's only menu item
+    from jinja2 import Environment, FileSystemLoader
+    env = Environment(loader=FileSystemLoader(REPOSITORY_DIRECTORY))
+    batch_template, shell_template = [env.get_template(name) for name in toolbar.LAUNCHER_TEMPLATES["per-entry"]]
+    (path, entry), = list(toolbar.load_menu_entries(menu_file))
+
+    targets = collections.OrderedDict()
+    for launch_path in LAUNCH_PATHS:
+        settings = {
+            "target_name": launch_path,
+            "distribution": "Bench",
+            "user": os.environ.get("USER"),
+            "wsl_executable": "C:\\Windows\\System32\\wsl.exe",
+            "menu_file": menu_file,
+            "rc_file": rc_file,
+            "launch_directory": fixture_directory,
+            "batch_encoding": None,
+            "use_batch_newline_crlf": False,
+            "metadata_directory": os.path.join(fixture_directory, "metadata", launch_path),
+            "environment_snapshot": None,
+            "broker_file": os.path.join(fixture_directory, "launch-broker-%s" % launch_path)
+            if launch_path == "broker" else None
+        }
+        exec_cmd, exec_dir, run_in_terminal = toolbar.get_launch_details(entry, settings)
+        shell_launcher_path = os.path.join(settings["metadata_directory"], "%s.sh" % path)
+        renderer = toolbar.LauncherRenderer(batch_template, shell_template, settings)
+        # Only the shell launcher takes part, and it is written out here as there are no windows attributes to set
+        shell_launcher = renderer.render(shell_launcher_path, os.path.splitext(shell_launcher_path)[0] + ".bat",
+                                         command=exec_cmd, exec_dir=exec_dir, run_in_terminal=run_in_terminal)[0]
+        os.makedirs(os.path.dirname(shell_launcher_path), exist_ok=True)
+        with open(shell_launcher_path, "w") as handle:
+            handle.write(shell_launcher["content"])
+        os.chmod(shell_launcher_path, shell_launcher["mode"])
+        targets[launch_path] = (settings, shell_launcher_path)
+    return targets
+
+
+def time_launch(launcher, marker_file):
+    # Seconds from running the launcher to the application starting
+    started = time.perf_counter()
+    process = subprocess.Popen([launcher], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, start_new_session=True)
+    while not os.path.exists(marker_file):
+        if time.perf_counter() - started > LAUNCH_TIMEOUT:
+            process.kill()
+            raise click.ClickException("%s did not start the application within %ds" % (launcher, LAUNCH_TIMEOUT))
+        time.sleep(0.0005)
+    elapsed = time.perf_counter() - started
+    process.wait()
+    os.remove(marker_file)
+    return elapsed
+
+
+def run_benchmark(work_directory, launches, rc_file):
+    # The module works out its cache directory on import, so this has to be set first
+    os.environ["XDG_CACHE_HOME"] = os.path.join(work_directory, "cache")
+    sys.path.insert(0, REPOSITORY_DIRECTORY)
+    import wsl_windows_toolbar as toolbar
+    logging.getLogger(toolbar.__name__).setLevel(logging.ERROR)
+
+    menu_file, marker_file = create_fixture(work_directory)
+    targets = write_launchers(toolbar, work_directory, menu_file, rc_file)
+
+    results = collections.OrderedDict()
+    broker = None
+    try:
+        for launch_path, (settings, launcher) in targets.items():
+            if launch_path == "broker":
+                started = time.perf_counter()
+                broker = toolbar.LaunchBroker()
+                broker.add(settings)
+                broker.start()
+                startup = time.perf_counter() - started
+            else:
+                startup = 0.0
+            timings = [time_launch(launcher, marker_file) for launch in range(launches)]
+            results[launch_path] = {
+                "startup": startup,
+                "timings": timings
+            }
+    finally:
+        if broker is not None:
+            broker.close()
+    return results
+
+
+def print_results(results):
+    click.echo("%-40s %10s %10s %10s %10s %12s" % (
+        "launch path", "mean (ms)", "median", "p95", "min", "startup (s)"))
+    for launch_path, description in LAUNCH_PATHS.items():
+        timings = sorted(timing * 1000 for timing in results[launch_path]["timings"])
+        click.echo("%-40s %10.1f %10.1f %10.1f %10.1f %12.2f" % (
+            description, statistics.mean(timings), statistics.median(timings),
+            timings[min(len(timings) - 1, int(len(timings) * 0.95))], timings[0], results[launch_path]["startup"]))
+
+
+@click.command()
+@click.option("--launches",
+              "-n",
+              type=click.IntRange(min=1),
+              default=20,
+              show_default=True,
+              help="How many times to launch the application along each launch path")
+@click.option("--rc-file",
+              "-r",
+              type=click.Path(exists=True, dir_okay=False),
+              default=os.path.expanduser("~/.bashrc"),
+              show_default=True,
+              help="rc file the launchers source (the broker loads it just the once)")
+@click.option("--json-file",
+              "-j",
+              type=click.File("w"),
+              default=None,
+              show_default=False,
+              help="Also write the results as JSON to this file ('-' for stdout)")
+def main(launches, rc_file, json_file):
+    work_directory = tempfile.mkdtemp(prefix="wsl-windows-toolbar-launch-benchmark-")
+    try:
+        results = run_benchmark(work_directory, launches, os.path.abspath(rc_file))
+        print_results(results)
+        if json_file:
+            json.dump(results, json_file, indent=1)
+            json_file.write("\n")
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -35,7 +35,6 @@ setuptools.setup(
         "winshell>=0.6",
         "swinlnk>=0.1.4",
         "pillow>=6",
-        "python-magic>=0.4.15",
         "jinja2>=2.11"
     ],
     packages=[
@@ -48,6 +47,8 @@ setuptools.setup(
         'wsl_windows_toolbar': [
             "wsl-windows-toolbar-template.bat.j2",
             "wsl-windows-toolbar-template.sh.j2",
+            "wsl-windows-toolbar-dispatch.bat.j2",
+            "wsl-windows-toolbar-dispatch.sh.j2",
             "__init__.py"
         ]
     },
@@ -0,0 +1,117 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+from click.testing import CliRunner
+
+# The module lives at the top of the repository rather than in a package directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wsl_windows_toolbar as toolbar  # noqa: E402
+
+WINDOWS_COMMANDS = ["cmd.exe", "attrib.exe", "powershell.exe", "wscript.exe", "robocopy.exe", "wslpath"]
+
+
+# Keeps everything the tool caches between runs (menus, the icon theme index, templates...) out of the real cache
+@pytest.fixture
+def cache_directory(tmp_path, monkeypatch):
+    cache_directory = tmp_path / "cache"
+    cache_directory.mkdir()
+    for name, value in list(vars(toolbar).items()):
+        if name.isupper() and isinstance(value, str) and value.startswith(toolbar.CACHE_DIRECTORY + os.sep):
+            monkeypatch.setattr(toolbar, name, str(cache_directory) + value[len(toolbar.CACHE_DIRECTORY):])
+    monkeypatch.setattr(toolbar, "CACHE_DIRECTORY", str(cache_directory))
+    return cache_directory
+
+
+# Fails the test if anything tries to start a windows command
+@pytest.fixture
+def no_windows(monkeypatch):
+    started = []
+
+    def refuse(command):
+        started.append(command)
+        pytest.fail("Started %s" % " ".join(command))
+
+    class RefusingExecutor(toolbar.CommandExecutor):
+        def run(self, commands):
+            for command in commands:
+                refuse(command)
+
+    real_popen = subprocess.Popen
+
+    def popen(command, *args, **kwargs):
+        if os.path.basename(command[0]) in WINDOWS_COMMANDS:
+            refuse(command)
+        return real_popen(command, *args, **kwargs)
+    monkeypatch.setattr(toolbar, "command_executor", RefusingExecutor())
+    monkeypatch.setattr(toolbar.subprocess, "Popen", popen)
+    return started
+
+
+# Gives whatever a launched menu item does a moment to happen, as nothing waits for it to finish
+def wait_for(path, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return os.path.exists(path)
+
+
+MENU = """<!DOCTYPE Menu PUBLIC "-//freedesktop//DTD Menu 1.0//EN"
+ "http://www.freedesktop.org/standards/menu-spec/1.0/menu.dtd">
+<Menu>
+  <Name>Applications</Name>
+  <AppDir>%s</AppDir>
+  <Menu><Name>Utilities</Name><Include><Category>Utility</Category></Include></Menu>
+</Menu>
+"""
+
+DESKTOP_ENTRY = """[Desktop Entry]
+Type=Application
+Name=%(name)s
+Exec=%(command)s %%U
+Comment=%(name)s for testing
+Terminal=false
+Categories=Utility;
+"""
+
+
+# A menu of three applications, each of which leaves a file behind in the test's directory when run
+@pytest.fixture
+def menu(tmp_path):
+    applications = tmp_path / "applications"
+    applications.mkdir()
+    for number in range(1, 4):
+        (applications / ("app%d.desktop" % number)).write_text(
+            DESKTOP_ENTRY % {"name": "App %d" % number, "command": "touch %s" % (tmp_path / ("app%d-ran" % number))})
+    menu_file = tmp_path / "applications.menu"
+    menu_file.write_text(MENU % applications)
+    return menu_file
+
+
+# Runs cli with --dry-run (and any other arguments given) against the menu, giving the plan it writes
+@pytest.fixture
+def dry_run(tmp_path, menu, cache_directory, no_windows, monkeypatch):
+    # Nothing is installed, so imagemagick would only be looked for to be logged
+    monkeypatch.setattr(toolbar.environment, "_has_imagemagick", False)
+    monkeypatch.setattr(toolbar, "HOST_MOUNTS", {str(tmp_path / "c"): "C:"})
+    toolbar.get_windows_directory_from_wsl_directory.cache_clear()
+    rc_file = tmp_path / "bashrc"
+    rc_file.write_text("")
+    metadata_directory = tmp_path / "c" / "metadata"
+
+    def run_dry_run(*arguments):
+        plan_file = tmp_path / "plan.json"
+        result = CliRunner().invoke(toolbar.cli, [
+            "--dry-run", "--plan-file", str(plan_file), "--menu-file", str(menu), "--distribution", "Test",
+            "--user", "tester", "--rc-file", str(rc_file), "--install-directory", str(tmp_path / "c" / "install"),
+            "--metadata-directory", str(metadata_directory), "--icon-cache-dir", str(cache_directory / "icons")
+        ] + list(arguments), catch_exceptions=False)
+        assert result.exit_code == 0, result.output
+        with open(str(plan_file)) as plan_handle:
+            return json.load(plan_handle)
+    yield run_dry_run, metadata_directory / "WSL"
+    toolbar.get_windows_directory_from_wsl_directory.cache_clear()
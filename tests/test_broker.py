@@ -0,0 +1,76 @@
+import os
+import socket
+import stat
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+from conftest import DESKTOP_ENTRY, wait_for
+
+
+@pytest.fixture
+def broker(tmp_path, menu, cache_directory, monkeypatch):
+    # The environment comes from an interactive shell, which shouldn't pick up this machine's own rc files
+    monkeypatch.setenv("HOME", str(tmp_path))
+    (tmp_path / "applications" / "terminal.desktop").write_text(
+        DESKTOP_ENTRY.replace("Terminal=false", "Terminal=true") % {
+            "name": "Terminal App", "command": "touch %s" % (tmp_path / "terminal-ran")})
+    rc_file = tmp_path / "bashrc"
+    rc_file.write_text("")
+    settings = {
+        "target_name": "Test",
+        "menu_file": str(menu),
+        "launch_directory": str(tmp_path),
+        "metadata_directory": str(tmp_path / "metadata"),
+        "rc_file": str(rc_file),
+        "broker_file": toolbar.BROKER_FILE % "Test"
+    }
+    broker = toolbar.LaunchBroker()
+    broker.add(settings)
+    broker.start()
+    yield broker, settings
+    broker.close()
+
+
+def send(broker_file, *request):
+    with open(broker_file) as broker_handle:
+        port, token = broker_handle.read().split()
+    request = [token if field is None else field for field in request]
+    with socket.create_connection(("127.0.0.1", int(port)), timeout=10) as connection:
+        connection.sendall(("\t".join(request) + "\n").encode("utf-8"))
+        return connection.makefile().readline().rstrip("\n")
+
+
+def test_broker_launches_menu_items_for_its_launchers(broker, tmp_path):
+    broker, settings = broker
+    assert stat.S_IMODE(os.stat(settings["broker_file"]).st_mode) == 0o600
+
+    # The dispatcher asks by menu item id, and the per-entry launchers by their own path
+    assert send(settings["broker_file"], None, "dispatch.sh", toolbar.get_entry_id("Utilities/App 2")) == "OK"
+    assert wait_for(str(tmp_path / "app2-ran"))
+    launcher = os.path.join(settings["metadata_directory"], "Utilities/App 1.sh")
+    assert send(settings["broker_file"], None, launcher, "") == "OK"
+    assert wait_for(str(tmp_path / "app1-ran"))
+
+    assert send(settings["broker_file"], None, "dispatch.sh", "000000000000") == "ERR unknown menu item"
+    assert send(settings["broker_file"], "not enough fields") == "ERR bad request"
+
+    broker.close()
+    assert not os.path.exists(settings["broker_file"])
+
+
+def test_broker_only_launches_for_its_token(broker, tmp_path):
+    broker, settings = broker
+    entry_id = toolbar.get_entry_id("Utilities/App 3")
+    for token in ["", "not-the-token", list(broker.targets)[0][:-1]]:
+        assert send(settings["broker_file"], token, "dispatch.sh", entry_id) == "ERR unknown token"
+    assert not (tmp_path / "app3-ran").exists()
+    assert send(settings["broker_file"], None, "dispatch.sh", entry_id) == "OK"
+    assert wait_for(str(tmp_path / "app3-ran"))
+
+
+def test_broker_leaves_terminal_menu_items_to_their_launchers(broker, tmp_path):
+    broker, settings = broker
+    reply = send(settings["broker_file"], None, "dispatch.sh", toolbar.get_entry_id("Utilities/Terminal App"))
+    assert reply == "ERR menu item runs in a terminal"
+    assert not wait_for(str(tmp_path / "terminal-ran"), timeout=0.5)
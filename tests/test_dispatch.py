@@ -0,0 +1,58 @@
+import os
+import subprocess
+
+import wsl_windows_toolbar as toolbar
+from conftest import wait_for
+
+
+def write_launchers(plan):
+    for launcher in plan["launchers"]:
+        os.makedirs(os.path.dirname(launcher["path"]), exist_ok=True)
+        with open(launcher["path"], "w", newline=launcher["newline"]) as launcher_handle:
+            launcher_handle.write(launcher["content"])
+
+
+def test_dispatcher_runs_menu_items_from_the_table(dry_run, tmp_path):
+    run_dry_run, metadata_directory = dry_run
+    plan = run_dry_run("--launcher-mode", "dispatch")
+
+    # Shortcuts all go through the one dispatcher, passing it their menu item's id
+    assert all(item["launchers"] == [] for item in plan["items"])
+    entry_ids = dict((item["path"], item["shortcut"]["arguments"].split()[-1]) for item in plan["items"])
+    assert entry_ids["Utilities/App 2"] == toolbar.get_entry_id("Utilities/App 2")
+    assert len(set(entry_ids.values())) == 3
+    assert sorted(os.path.basename(launcher["path"]) for launcher in plan["launchers"]) == [
+        "dispatch.bat", "dispatch.sh", "launchers.tsv"]
+
+    write_launchers(plan)
+    dispatcher = str(metadata_directory / "dispatch.sh")
+    subprocess.run(["bash", dispatcher, entry_ids["Utilities/App 2"]], check=True, timeout=10)
+    assert wait_for(str(tmp_path / "app2-ran"))
+    assert not (tmp_path / "app1-ran").exists() and not (tmp_path / "app3-ran").exists()
+
+    missing = subprocess.run(["bash", dispatcher, "000000000000"], stderr=subprocess.PIPE, timeout=10,
+                             universal_newlines=True)
+    assert missing.returncode == 1
+    assert "No launcher found for menu item 000000000000" in missing.stderr
+
+
+def test_switching_launcher_mode_regenerates_every_menu_item(dry_run):
+    run_dry_run, metadata_directory = dry_run
+    per_entry = run_dry_run("--launcher-mode", "per-entry")
+    assert all(len(item["launchers"]) == 2 for item in per_entry["items"])
+
+    metadata_directory.mkdir(parents=True)
+    toolbar.save_manifest(str(metadata_directory), dict(
+        (item["path"], {"fingerprint": item["fingerprint"], "files": item["files"]}) for item in per_entry["items"]))
+    dispatch = run_dry_run("--launcher-mode", "dispatch")
+    assert dispatch["diff"]["changed"] == ["Utilities/App 1", "Utilities/App 2", "Utilities/App 3"]
+    # The per-entry launchers are left for the stale file sweep, as no menu item accounts for them any more
+    assert all(not any(path.endswith((".sh", ".bat")) for path in item["files"]) for item in dispatch["items"])
+
+    toolbar.save_manifest(str(metadata_directory), dict(
+        (item["path"], {"fingerprint": item["fingerprint"], "files": item["files"]}) for item in dispatch["items"]))
+    switched_back = run_dry_run("--launcher-mode", "per-entry")
+    assert switched_back["diff"]["changed"] == ["Utilities/App 1", "Utilities/App 2", "Utilities/App 3"]
+    # The dispatcher and its table go as soon as nothing uses them
+    assert sorted(os.path.basename(path) for path in switched_back["obsolete_files"]) == [
+        "dispatch.bat", "dispatch.sh", "launchers.tsv", "silent-dispatcher.vbs"]
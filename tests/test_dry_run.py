@@ -0,0 +1,28 @@
+import wsl_windows_toolbar as toolbar
+
+
+def test_dry_run_plans_against_the_manifest_without_windows(dry_run, no_windows):
+    run_dry_run, metadata_directory = dry_run
+    first_plan = run_dry_run()
+    assert first_plan["diff"]["new"] == ["Utilities/App 1", "Utilities/App 2", "Utilities/App 3"]
+    assert not metadata_directory.exists()
+
+    fingerprints = dict((item["path"], item["fingerprint"]) for item in first_plan["items"])
+    metadata_directory.mkdir(parents=True)
+    toolbar.save_manifest(str(metadata_directory), {
+        "Utilities/App 1": {"fingerprint": fingerprints["Utilities/App 1"], "files": []},
+        "Utilities/App 2": {"fingerprint": "from an older version of App 2", "files": []},
+        "Utilities/Gone": {"fingerprint": "from an uninstalled app", "files": [str(metadata_directory / "Gone.sh")]}
+    })
+    plan = run_dry_run()
+
+    assert plan["diff"] == {
+        "new": ["Utilities/App 3"],
+        "changed": ["Utilities/App 2"],
+        "unchanged": ["Utilities/App 1"],
+        "removed": ["Utilities/Gone"]
+    }
+    assert plan["removed"] == [{"path": "Utilities/Gone", "files": [str(metadata_directory / "Gone.sh")]}]
+    assert sorted(item["path"] for item in plan["items"]) == ["Utilities/App 1", "Utilities/App 2", "Utilities/App 3"]
+    assert sorted(path.name for path in metadata_directory.iterdir()) == ["manifest.json"]
+    assert no_windows == []
@@ -0,0 +1,38 @@
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+
+@pytest.fixture
+def converters(monkeypatch):
+    def set_converters(has_cairosvg, has_imagemagick):
+        monkeypatch.setattr(toolbar.environment, "_has_cairosvg", has_cairosvg)
+        monkeypatch.setattr(toolbar.environment, "_has_imagemagick", has_imagemagick)
+    return set_converters
+
+
+def make_entry(icon):
+    return toolbar.DesktopEntryRecord("App", "app %U", "", False, icon, "An application")
+
+
+def test_fingerprint_changes_when_icon_converters_turn_up(tmp_path, converters):
+    icon_path = tmp_path / "app.svg"
+    icon_path.write_text("<svg/>")
+    entry = make_entry("app")
+
+    converters(False, False)
+    without_cairosvg = toolbar.get_entry_fingerprint(entry, str(icon_path), ["run"])
+    assert toolbar.get_entry_fingerprint(entry, str(icon_path), ["run"]) == without_cairosvg
+    converters(True, False)
+    assert toolbar.get_entry_fingerprint(entry, str(icon_path), ["run"]) != without_cairosvg
+    converters(False, True)
+    assert toolbar.get_entry_fingerprint(entry, str(icon_path), ["run"]) != without_cairosvg
+
+
+def test_fingerprint_without_icon_ignores_converters(converters):
+    entry = make_entry("")
+
+    converters(False, False)
+    fingerprint = toolbar.get_entry_fingerprint(entry, None, ["run"])
+    converters(True, True)
+    assert toolbar.get_entry_fingerprint(entry, None, ["run"]) == fingerprint
@@ -0,0 +1,72 @@
+import os
+import subprocess
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+RC_FILE = """export DISPLAY=:0
+export FOO=bar
+"""
+
+
+@pytest.fixture
+def rc_file(tmp_path, monkeypatch):
+    # Keep the real ~/.bashrc out of the interactive shells
+    home = tmp_path / "home"
+    home.mkdir()
+    monkeypatch.setenv("HOME", str(home))
+    rc_file = tmp_path / "rc"
+    rc_file.write_text(RC_FILE)
+    return str(rc_file)
+
+
+def read_snapshot_variables(snapshot_file):
+    with open(snapshot_file) as snapshot_handle:
+        lines = snapshot_handle.read().splitlines()
+    return [line.split()[2].split("=")[0] for line in lines if line.startswith("declare -x ")], lines
+
+
+def test_snapshot_keeps_variables_already_set_by_the_caller(tmp_path, monkeypatch, rc_file):
+    monkeypatch.setenv("DISPLAY", ":0")
+    monkeypatch.setenv("FOO", "bar")
+    monkeypatch.setenv("CALLER_ONLY", "1")
+    snapshot_file = str(tmp_path / "snapshot.sh")
+
+    assert toolbar.update_environment_snapshot(snapshot_file, rc_file)
+    variables, lines = read_snapshot_variables(snapshot_file)
+    assert 'declare -x DISPLAY=":0"' in lines
+    assert 'declare -x FOO="bar"' in lines
+    assert "CALLER_ONLY" not in variables
+    assert "PWD" not in variables and "SHLVL" not in variables
+
+    # Up to date now, so not taken again
+    assert not toolbar.update_environment_snapshot(snapshot_file, rc_file)
+
+
+def test_snapshot_from_an_older_version_is_taken_again(tmp_path, rc_file):
+    snapshot_file = str(tmp_path / "snapshot.sh")
+    with open(toolbar.BOOT_ID_FILE) as boot_id_handle:
+        boot_id = boot_id_handle.read().strip()
+    with open(rc_file, "rb") as rc_handle:
+        rc_hash = toolbar.hashlib.sha256(rc_handle.read()).hexdigest()
+    with open(snapshot_file, "w") as snapshot_handle:
+        snapshot_handle.write("# boot %s\n# rc %s\ndeclare -x PATH=\"/usr/bin\"\n" % (boot_id, rc_hash))
+
+    assert toolbar.update_environment_snapshot(snapshot_file, rc_file)
+    variables, lines = read_snapshot_variables(snapshot_file)
+    assert "DISPLAY" in variables
+
+
+def test_launcher_takes_snapshot_with_variables_already_set(tmp_path, monkeypatch, rc_file):
+    monkeypatch.setenv("DISPLAY", ":0")
+    monkeypatch.setenv("FOO", "bar")
+    snapshot_file = str(tmp_path / "snapshot.sh")
+    loader = toolbar.get_environment_loader({"environment_snapshot": snapshot_file, "rc_file": rc_file})
+
+    subprocess.check_call(["bash", "-c", loader], stdin=subprocess.DEVNULL)
+    # A launcher started without them (as from wsl.exe) gets them from the snapshot
+    environment = dict((name, value) for name, value in os.environ.items() if name not in ["DISPLAY", "FOO"])
+    output = subprocess.check_output(["bash", "-c", loader + '\nprintf "%s %s" "$DISPLAY" "$FOO"'], env=environment,
+                                     stdin=subprocess.DEVNULL)
+    assert output.decode() == ":0 bar"
@@ -0,0 +1,54 @@
+import os
+
+import wsl_windows_toolbar as toolbar
+
+
+def make_files(root, paths):
+    for path in paths:
+        full_path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "w") as handle:
+            handle.write(path)
+    return [os.path.join(root, path) for path in paths]
+
+
+def test_inventory_records_every_file(tmp_path):
+    files = make_files(str(tmp_path), ["a/b/c.lnk", "a/d.sh", "e.ico"])
+    inventory = toolbar.FileInventory([str(tmp_path)], threads=4)
+    for path in files:
+        assert inventory.exists(path)
+        assert not inventory.entries[path].is_directory
+        assert inventory.entries[path].size == len(os.path.relpath(path, str(tmp_path)))
+    assert inventory.entries[os.path.join(str(tmp_path), "a", "b")].is_directory
+    assert not inventory.exists(os.path.join(str(tmp_path), "missing.lnk"))
+    assert inventory.get_unwritable(str(tmp_path)) == []
+
+
+def test_inventory_of_missing_root_is_empty(tmp_path):
+    inventory = toolbar.FileInventory([str(tmp_path / "missing")])
+    assert inventory.entries == {}
+    assert inventory.errors == {}
+
+
+def test_foreign_files_survive_stale_sweep(tmp_path):
+    install_directory = str(tmp_path / "install")
+    metadata_directory = str(tmp_path / "metadata")
+    current = make_files(install_directory, ["Utilities/App (WSL).lnk"]) + \
+        make_files(metadata_directory, ["Utilities/App.sh", "Utilities/App.bat", "Utilities/App.ico"])
+    stale = make_files(install_directory, ["Gone/Old (WSL).lnk"]) + \
+        make_files(metadata_directory, ["Gone/Old.sh", "Gone/Old.bat", "Gone/Old.ico"])
+    make_files(install_directory, ["my own shortcut.lnk", "Utilities/Other (Ubuntu).lnk", "notes.txt"])
+    make_files(metadata_directory, ["Utilities/Unrelated.sh"])
+
+    inventory = toolbar.FileInventory([install_directory, metadata_directory])
+    assert inventory.get_stale_files(install_directory, metadata_directory, " (WSL)", current) == sorted(stale)
+
+
+def test_nothing_is_stale_without_a_shortcut_suffix(tmp_path):
+    install_directory = str(tmp_path / "install")
+    metadata_directory = str(tmp_path / "metadata")
+    make_files(install_directory, ["Gone/Old.lnk"])
+    make_files(metadata_directory, ["Gone/Old.sh"])
+
+    inventory = toolbar.FileInventory([install_directory, metadata_directory])
+    assert inventory.get_stale_files(install_directory, metadata_directory, "", []) == []
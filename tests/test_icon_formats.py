@@ -0,0 +1,117 @@
+import gzip
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+RED, GREEN, BLUE, WHITE = (255, 0, 0, 255), (0, 255, 0, 255), (0, 0, 255, 255), (255, 255, 255, 255)
+CLEAR = (0, 0, 0, 0)
+
+XPM3 = b"""/* XPM */
+static char * app_xpm[] = {
+/* width height colours chars per pixel, and a "quoted" comment */
+"2 2 2 1",
+". c #FF0000",
+"# c blue",
+".#",
+"#."};
+"""
+
+XPM2 = b"""! XPM2
+2 2 2 1
+. c #FF0000
+# c blue
+.#
+#.
+"""
+
+MULTI_CHARACTER_PIXELS = b"""/* XPM */
+static char *app[] = {
+"3 1 3 2",
+"  c None",
+"a. c #0f0",
+"b. s highlight m white c #ffffffffffff",
+"  a.b."
+};
+"""
+
+ESCAPED_QUOTES = b"""/* XPM */
+static char *app[] = {
+"2 1 2 1",
+"\\" c #00FF00",
+"x c Red",
+"\\"x"
+};
+"""
+
+NAMED_COLOURS = b"""! XPM2
+4 1 4 1
+a c Light Grey
+b c grey100
+c g4 black m white
+d c #00000000ffff
+abcd
+"""
+
+
+@pytest.mark.parametrize("data, size, pixels", [
+    (XPM3, (2, 2), [RED, BLUE, BLUE, RED]),
+    (XPM2, (2, 2), [RED, BLUE, BLUE, RED]),
+    (MULTI_CHARACTER_PIXELS, (3, 1), [CLEAR, GREEN, WHITE]),
+    (ESCAPED_QUOTES, (2, 1), [GREEN, RED]),
+    (NAMED_COLOURS, (4, 1), [(211, 211, 211, 255), WHITE, (0, 0, 0, 255), BLUE]),
+], ids=["xpm3", "xpm2", "multi-character-pixels", "escaped-quotes", "named-colours"])
+def test_decode_xpm(data, size, pixels):
+    image = toolbar.decode_xpm(data)
+    assert image.mode == "RGBA"
+    assert image.size == size
+    assert [image.getpixel((x, y)) for y in range(image.height) for x in range(image.width)] == pixels
+
+
+@pytest.mark.parametrize("colour, rgba", [
+    ("#f80", (255, 136, 0, 255)),
+    ("#FF8800", (255, 136, 0, 255)),
+    ("#fff888000", (255, 136, 0, 255)),
+    ("#ffff88880000", (255, 136, 0, 255)),
+    ("None", CLEAR),
+    ("gray50", (127, 127, 127, 255)),
+    ("DarkSlateGray", (47, 79, 79, 255)),
+])
+def test_xpm_colours(colour, rgba):
+    assert tuple(toolbar._get_xpm_colour(colour)) == rgba
+
+
+@pytest.mark.parametrize("data, message", [
+    (b"! XPM2\n2 1 1 1\na c red\nab\n", "undefined colour 'b'"),
+    (b"! XPM2\n1 1 1 1\na c #12345\na\n", "Unknown XPM colour"),
+    (b"! XPM2\n1 2 1 1\na c red\na\n", "truncated"),
+    (b"! XPM2\n1 1 1 1\na s label\na\n", "no usable value"),
+    (b"/* XPM */ static char *x[] = {};", "Not an XPM image"),
+])
+def test_bad_xpm_images_are_refused(data, message):
+    with pytest.raises(ValueError, match=message):
+        toolbar.decode_xpm(data)
+
+
+@pytest.mark.parametrize("name, data, icon_format", [
+    ("app.png", b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR", "png"),
+    ("app.svg", b"<?xml version=\"1.0\"?><svg/>", "svg"),
+    ("app.svg", b"\xef\xbb\xbf\n  <svg xmlns=\"http://www.w3.org/2000/svg\"/>", "svg"),
+    ("app.svg", b"<!DOCTYPE svg PUBLIC \"-//W3C//DTD SVG 1.1//EN\"><svg/>", "svg"),
+    ("app.svgz", gzip.compress(b"<svg/>"), "svg"),
+    ("app.ico", b"\x00\x00\x01\x00\x01\x00", "ico"),
+    ("app.bmp", b"BM\x36\x00\x00\x00", "bmp"),
+    ("app.xpm", XPM3, "xpm"),
+    ("app.xpm", XPM2, "xpm"),
+    # The header wins over a misleading extension...
+    ("app.png", XPM3, "xpm"),
+    ("app.xpm", b"\x89PNG\r\n\x1a\n", "png"),
+    # ...and the extension is only gone by when the header is not recognised
+    ("app.svg", b"<!-- drawn by hand -->\n<svg/>", "svg"),
+    ("app.XPM", b"static char *app[] = {};", "xpm"),
+    ("app.png", b"not an image", None),
+])
+def test_sniff_icon_format(tmp_path, name, data, icon_format):
+    path = tmp_path / name
+    path.write_bytes(data)
+    assert toolbar.sniff_icon_format(str(path)) == icon_format
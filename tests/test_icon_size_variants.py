@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+
+@pytest.fixture
+def theme(tmp_path):
+    def make_theme(*icons):
+        for icon in icons:
+            path = tmp_path / "hicolor" / icon
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b"")
+        return lambda icon: str(tmp_path / "hicolor" / icon) if icon else str(tmp_path / "hicolor")
+    return make_theme
+
+
+@pytest.mark.parametrize("icons, found, sources", [
+    # Each ico size comes from the smallest drawing at least as big as it, rather than upscaling a small one
+    (["16x16/apps/app.png", "48x48/apps/app.png", "128x128/apps/app.png", "512x512/apps/app.png"],
+     "48x48/apps/app.png", ["16x16/apps/app.png", "48x48/apps/app.png", "512x512/apps/app.png"]),
+    (["22x22/apps/app.png", "64x64/apps/app.png", "96x96/apps/app.png"],
+     "22x22/apps/app.png", ["22x22/apps/app.png", "64x64/apps/app.png", "96x96/apps/app.png"]),
+    # Vectors are only used where no drawing is big enough
+    (["16x16/apps/app.png", "48x48/apps/app.png", "scalable/apps/app.svg"],
+     "48x48/apps/app.png", ["16x16/apps/app.png", "48x48/apps/app.png", "scalable/apps/app.svg"]),
+    (["scalable/apps/app.svg", "32x32/apps/app.png"],
+     "scalable/apps/app.svg", ["32x32/apps/app.png", "scalable/apps/app.svg"]),
+    # Other sizes in the same format as the icon found are preferred, and other icons and directories are ignored
+    (["48x48/apps/app.xpm", "256x256/apps/app.png", "256x256/apps/app.xpm", "256x256/apps/other.png",
+      "48x48@2/apps/app.png", "symbolic/apps/app.svg"],
+     "48x48/apps/app.xpm", ["48x48/apps/app.xpm", "256x256/apps/app.xpm"]),
+    (["48x48/apps/app.png"], "48x48/apps/app.png", ["48x48/apps/app.png"]),
+])
+def test_find_icon_size_variants(theme, icons, found, sources):
+    path = theme(*icons)
+    assert toolbar.find_icon_size_variants(path(found)) == [path(source) for source in sources]
+
+
+def test_icons_outside_of_sized_directories_are_used_as_they_are(tmp_path):
+    pixmap = tmp_path / "pixmaps" / "app.png"
+    pixmap.parent.mkdir()
+    pixmap.write_bytes(b"")
+    assert toolbar.find_icon_size_variants(str(pixmap)) == [str(pixmap)]
+
+
+def test_source_sizes():
+    assert toolbar._get_icon_source_size(os.path.join(os.sep, "icons", "128x128", "apps", "app.png")) == 128
+    assert toolbar._get_icon_source_size(os.path.join(os.sep, "icons", "scalable", "apps", "app.svg")) > 256
+    assert toolbar._get_icon_source_size(os.path.join(os.sep, "pixmaps", "app.png")) == 0
@@ -0,0 +1,59 @@
+import logging
+import threading
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+
+@pytest.fixture
+def report(monkeypatch):
+    report = toolbar.RunReport()
+    monkeypatch.setattr(toolbar, "report", report)
+    return report
+
+
+def test_inline_conversion_only_captures_its_own_thread(monkeypatch, report, caplog):
+    def log_elsewhere():
+        toolbar.logger.warning("Launcher written")
+        report.record_call("attrib.exe", 0.5)
+
+    def convert(icon_path, metadata_prefix, icon_cache=None, decoded=None):
+        toolbar.logger.warning("Converting %s", icon_path)
+        report.record_call("svg2png", 0.25)
+        # Another thread (a launcher writer, or another target) carries on while the icon is converted
+        other_thread = threading.Thread(target=log_elsewhere)
+        other_thread.start()
+        other_thread.join()
+        assert toolbar.logger.propagate
+        return metadata_prefix + ".ico"
+    monkeypatch.setattr(toolbar, "convert_windows_icon_files", convert)
+
+    with caplog.at_level(logging.DEBUG, logger=toolbar.logger.name):
+        future = toolbar._InlineExecutor().submit(toolbar._convert_windows_icon_task, "/icons/app.svg", "/meta/app")
+        ico_file, records, calls, seconds = future.result()
+
+    assert ico_file == "/meta/app.ico"
+    assert records == [(logging.WARNING, "Converting /icons/app.svg")]
+    assert list(calls) == ["svg2png"] and calls["svg2png"]["seconds"] == 0.25
+    assert [record.getMessage() for record in caplog.records] == ["Launcher written"]
+    assert list(report.calls) == ["attrib.exe"]
+
+    # Once the conversion is done, this thread's output goes through as usual again
+    with caplog.at_level(logging.DEBUG, logger=toolbar.logger.name):
+        toolbar.logger.warning("Shortcut written")
+        report.record_call("powershell.exe", 1.0)
+    assert caplog.records[-1].getMessage() == "Shortcut written"
+    assert sorted(report.calls) == ["attrib.exe", "powershell.exe"]
+
+
+def test_failed_conversion_stops_capturing(monkeypatch, report, caplog):
+    def convert(icon_path, metadata_prefix, icon_cache=None, decoded=None):
+        raise toolbar.IconDecodingDeferred(icon_path)
+    monkeypatch.setattr(toolbar, "convert_windows_icon_files", convert)
+
+    future = toolbar._InlineExecutor().submit(toolbar._convert_windows_icon_task, "/icons/app.xpm", "/meta/app")
+    assert isinstance(future.exception(), toolbar.IconDecodingDeferred)
+    with caplog.at_level(logging.DEBUG, logger=toolbar.logger.name):
+        toolbar.logger.warning("Deferred")
+    assert [record.getMessage() for record in caplog.records] == ["Deferred"]
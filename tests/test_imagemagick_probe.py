@@ -0,0 +1,28 @@
+import subprocess
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+
+@pytest.fixture
+def installed_tools(monkeypatch):
+    def set_installed_tools(*tools):
+        def check_output(command):
+            if command[0] not in tools:
+                raise subprocess.CalledProcessError(127, command)
+            return b"Version: ImageMagick 6.9.11-60 Q16 x86_64\n"
+        monkeypatch.setattr(toolbar.command_executor, "check_output", check_output)
+        monkeypatch.setattr(toolbar.environment, "_has_imagemagick", None)
+    return set_installed_tools
+
+
+def test_imagemagick_is_found_when_both_of_its_tools_are(installed_tools):
+    installed_tools("convert", "mogrify")
+    assert toolbar.environment.has_imagemagick
+
+
+@pytest.mark.parametrize("tool", ["convert", "mogrify"])
+def test_imagemagick_is_not_found_without_one_of_its_tools(installed_tools, tool):
+    installed_tools(tool)
+    assert not toolbar.environment.has_imagemagick
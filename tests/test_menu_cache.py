@@ -0,0 +1,112 @@
+import os
+
+import pytest
+import xdg.BaseDirectory
+import xdg.Menu
+
+import wsl_windows_toolbar as toolbar
+from conftest import DESKTOP_ENTRY
+
+
+@pytest.fixture
+def menu_cache(tmp_path, menu, cache_directory, monkeypatch):
+    # pyxdg's own directories are kept to the test's, so nothing installed on this machine comes into it
+    monkeypatch.setattr(xdg.BaseDirectory, "xdg_config_home", str(tmp_path / "config"))
+    monkeypatch.setattr(xdg.BaseDirectory, "xdg_config_dirs", [str(tmp_path / "config")])
+    monkeypatch.setattr(xdg.BaseDirectory, "xdg_data_dirs", [str(tmp_path / "data")])
+    parsed = []
+    real_parse = xdg.Menu.parse
+
+    def parse(menu_file):
+        parsed.append(menu_file)
+        return real_parse(menu_file)
+    monkeypatch.setattr(xdg.Menu, "parse", parse)
+
+    def load(rebuild=False):
+        return [(path, entry.exec) for path, entry in toolbar.load_menu_entries(str(menu), rebuild=rebuild)]
+    return load, parsed
+
+
+def test_unchanged_menu_is_loaded_from_the_cache(menu_cache, cache_directory):
+    load, parsed = menu_cache
+    entries = load()
+    assert [path for path, command in entries] == ["Utilities/App 1", "Utilities/App 2", "Utilities/App 3"]
+    assert len(parsed) == 1
+    assert len(list(cache_directory.glob("menu-*.json"))) == 1
+
+    assert load() == entries
+    assert len(parsed) == 1
+    assert load(rebuild=True) == entries
+    assert len(parsed) == 2
+
+
+def bump_mtime(path):
+    stat = os.stat(str(path))
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+def edit_entry(tmp_path, menu):
+    (tmp_path / "applications" / "app2.desktop").write_text(
+        DESKTOP_ENTRY % {"name": "App 2", "command": "app2 --new-option"})
+
+
+def add_entry(tmp_path, menu):
+    (tmp_path / "applications" / "app4.desktop").write_text(DESKTOP_ENTRY % {"name": "App 4", "command": "app4"})
+
+
+def remove_entry(tmp_path, menu):
+    (tmp_path / "applications" / "app3.desktop").unlink()
+
+
+def touch_menu_file(tmp_path, menu):
+    bump_mtime(menu)
+
+
+def add_merged_menu(tmp_path, menu):
+    merged = tmp_path / "applications-merged"
+    merged.mkdir()
+    (merged / "extra.menu").write_text("<Menu><Name>Applications</Name></Menu>")
+
+
+def add_system_entry(tmp_path, menu):
+    applications = tmp_path / "data" / "applications"
+    applications.mkdir(parents=True)
+    (applications / "app5.desktop").write_text(DESKTOP_ENTRY % {"name": "App 5", "command": "app5"})
+
+
+def change_language(tmp_path, menu):
+    # Set to en by the test, which puts it back afterwards
+    os.environ["LANGUAGE"] = "fr"
+
+
+@pytest.mark.parametrize("change", [edit_entry, add_entry, remove_entry, touch_menu_file, add_merged_menu,
+                                    add_system_entry, change_language])
+def test_menu_is_parsed_again_once_something_it_depends_on_changes(menu_cache, tmp_path, menu, monkeypatch, change):
+    load, parsed = menu_cache
+    monkeypatch.setenv("LANGUAGE", "en")
+    before = load()
+    change(tmp_path, menu)
+    after = load()
+
+    assert len(parsed) == 2
+    if change is edit_entry:
+        assert dict(after)["Utilities/App 2"] == "app2 --new-option %U"
+    elif change is add_entry:
+        assert "Utilities/App 4" in dict(after)
+    elif change is remove_entry:
+        assert "Utilities/App 3" not in dict(after)
+    else:
+        assert after == before
+    # And the cache is good again from then on
+    assert load() == after
+    assert len(parsed) == 2
+
+
+def test_unreadable_cache_is_ignored(menu_cache, cache_directory):
+    load, parsed = menu_cache
+    entries = load()
+    for cache_file in cache_directory.glob("menu-*.json"):
+        cache_file.write_text("{\"version\": ")
+
+    assert load() == entries
+    assert len(parsed) == 2
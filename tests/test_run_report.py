@@ -0,0 +1,30 @@
+import time
+
+import wsl_windows_toolbar as toolbar
+
+
+def slow_items(count, seconds):
+    for item in range(count):
+        time.sleep(seconds)
+        yield item
+
+
+def test_streamed_items_count_towards_their_own_phase():
+    report = toolbar.RunReport()
+    with report.phase("generate"):
+        items = list(report.iterate("plan", slow_items(3, 0.02)))
+        time.sleep(0.02)
+
+    assert items == [0, 1, 2]
+    assert report.phases["plan"] >= 0.06
+    # The generate phase is only charged with what was not spent planning
+    assert 0.02 <= report.phases["generate"] < 0.06
+
+
+def test_phases_accumulate():
+    report = toolbar.RunReport()
+    for _ in range(2):
+        with report.phase("plan"):
+            time.sleep(0.01)
+
+    assert report.phases["plan"] >= 0.02
@@ -0,0 +1,189 @@
+import os
+import struct
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+# Reference shortcuts are kept byte for byte, so any change to how shortcuts are laid out shows up here. Their fields
+# were checked against MS-SHLLINK and an independent parser (LnkParse3) when they were added.
+REFERENCE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "shell_links")
+
+LONG_PATH = "C:\\Users\\tester\\AppData\\Roaming\\" + "\\".join(
+    ["very long directory name %02d" % index for index in range(12)]) + "\\App.bat"
+
+CASES = {
+    "bare_executable": {
+        "target": "wscript",
+        "arguments": '"C:\\Users\\tester\\.config\\silent-launcher.vbs" "C:\\Users\\tester\\App 1.bat"',
+        "description": "Runs App 1",
+        "icon_location": "C:\\Users\\tester\\App 1.ico"
+    },
+    "local_path": {
+        "target": "C:\\Users\\tester\\.config\\wsl-windows-toolbar-launcher\\metadata\\WSL\\Utilities\\App 1.bat",
+        "arguments": "--flag",
+        "description": "App 1",
+        "working_directory": "C:\\Users\\tester",
+        "icon_location": "C:\\Users\\tester\\App 1.ico"
+    },
+    "unc_path": {
+        "target": "\\\\wsl.localhost\\Ubuntu\\home\\tester\\.config\\App 1.bat",
+        "arguments": "abc123",
+        "description": "App 1",
+        "working_directory": "\\\\wsl.localhost\\Ubuntu\\home\\tester",
+        "icon_location": "\\\\wsl.localhost\\Ubuntu\\home\\tester\\App 1.ico"
+    },
+    "non_ascii": {
+        "target": "C:\\Users\\Zo\u00eb\\Men\u00fc\\\u65e5\u672c\u8a9e \u30a8\u30c7\u30a3\u30bf.bat",
+        "arguments": "--title \"Caf\u00e9 \u2615\"",
+        "description": "\u00c9diteur de texte \u2013 \u65e5\u672c\u8a9e",
+        "working_directory": "C:\\Users\\Zo\u00eb",
+        "icon_location": "C:\\Users\\Zo\u00eb\\Men\u00fc\\\u65e5\u672c\u8a9e \u30a8\u30c7\u30a3\u30bf.ico"
+    },
+    "long_path": {
+        "target": LONG_PATH,
+        "arguments": "x" * 1000,
+        "description": "d" * 300,
+        "working_directory": LONG_PATH.rsplit("\\", 1)[0],
+        "icon_location": LONG_PATH[:-4] + ".ico"
+    }
+}
+
+
+def read_reference(name):
+    with open(os.path.join(REFERENCE_DIRECTORY, name + ".lnk"), "rb") as reference_handle:
+        return reference_handle.read()
+
+
+def read_ansi(data, offset):
+    return data[offset:data.index(b"\0", offset)].decode("cp1252")
+
+
+def read_unicode(data, offset):
+    end = offset
+    while data[end:end + 2] != b"\0\0":
+        end += 2
+    return data[offset:end].decode("utf-16-le")
+
+
+# Just enough of MS-SHLLINK to pull the fields written by build_shell_link back out
+def parse_shell_link(data):
+    (header_size, clsid, link_flags, file_attributes, creation_time, access_time, write_time, file_size, icon_index,
+     show_command, hot_key) = struct.unpack("<I16sIIQQQIiIH", data[:66])
+    link = {
+        "header_size": header_size,
+        "clsid": clsid,
+        "link_flags": link_flags,
+        "show_command": show_command,
+        "link_info": None,
+        "strings": {},
+        "extra": []
+    }
+    offset = header_size
+
+    if link_flags & toolbar.SHELL_LINK_HAS_LINK_INFO:
+        info_size, info_header_size, info_flags = struct.unpack("<III", data[offset:offset + 12])
+        offsets = struct.unpack("<IIIIII", data[offset + 12:offset + 36])
+        info = data[offset:offset + info_size]
+        link["link_info"] = {
+            "size": info_size,
+            "header_size": info_header_size,
+            "flags": info_flags,
+            "local_base_path": read_ansi(info, offsets[1]) if offsets[1] else None,
+            "common_path_suffix": read_ansi(info, offsets[3]),
+            "local_base_path_unicode": read_unicode(info, offsets[4]) if offsets[4] else None,
+            "common_path_suffix_unicode": read_unicode(info, offsets[5]) if offsets[5] else None,
+            "net_name": None
+        }
+        if offsets[0]:
+            volume_size, drive_type = struct.unpack("<II", info[offsets[0]:offsets[0] + 8])
+            link["link_info"]["volume"] = (volume_size, drive_type)
+        if offsets[2]:
+            network = info[offsets[2]:]
+            network_size, network_flags, net_name_offset = struct.unpack("<III", network[:12])
+            net_name_offset_unicode = struct.unpack("<I", network[20:24])[0]
+            link["link_info"]["net_name"] = read_ansi(network, net_name_offset)
+            link["link_info"]["net_name_unicode"] = read_unicode(network, net_name_offset_unicode)
+        offset += info_size
+
+    for flag, name in [(toolbar.SHELL_LINK_HAS_NAME, "description"),
+                       (toolbar.SHELL_LINK_HAS_WORKING_DIR, "working_directory"),
+                       (toolbar.SHELL_LINK_HAS_ARGUMENTS, "arguments"),
+                       (toolbar.SHELL_LINK_HAS_ICON_LOCATION, "icon_location")]:
+        if link_flags & flag:
+            count = struct.unpack("<H", data[offset:offset + 2])[0]
+            link["strings"][name] = data[offset + 2:offset + 2 + count * 2].decode("utf-16-le")
+            offset += 2 + count * 2
+
+    while True:
+        block_size = struct.unpack("<I", data[offset:offset + 4])[0]
+        if block_size < 4:
+            break
+        signature = struct.unpack("<I", data[offset + 4:offset + 8])[0]
+        link["extra"].append((signature, data[offset + 8:offset + block_size]))
+        offset += block_size
+    link["trailing"] = data[offset + 4:]
+    return link
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_shell_link_matches_reference(name):
+    assert toolbar.build_shell_link(**CASES[name]) == read_reference(name)
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_shell_link_header_and_strings(name):
+    case = CASES[name]
+    link = parse_shell_link(read_reference(name))
+    assert link["header_size"] == 0x4C
+    assert link["clsid"] == bytes.fromhex("0114020000000000c000000000000046")
+    assert link["link_flags"] & toolbar.SHELL_LINK_IS_UNICODE
+    assert link["show_command"] == toolbar.SHELL_LINK_SW_SHOWNORMAL
+    for field in ["description", "working_directory", "arguments", "icon_location"]:
+        assert link["strings"].get(field) == case.get(field)
+    assert link["trailing"] == b""
+
+
+def test_bare_executable_goes_through_environment_block():
+    link = parse_shell_link(read_reference("bare_executable"))
+    assert link["link_flags"] & toolbar.SHELL_LINK_HAS_EXP_STRING
+    assert link["link_info"] is None
+    (signature, block), = link["extra"]
+    assert signature == toolbar.SHELL_LINK_ENVIRONMENT_VARIABLE_DATA_BLOCK
+    assert len(block) == 260 + 520
+    assert block[:260].rstrip(b"\0") == b"%SystemRoot%\\System32\\wscript.exe"
+    assert block[260:].decode("utf-16-le").rstrip("\0") == "%SystemRoot%\\System32\\wscript.exe"
+
+
+@pytest.mark.parametrize("name", ["local_path", "non_ascii", "long_path"])
+def test_local_target_link_info(name):
+    target = CASES[name]["target"]
+    info = parse_shell_link(read_reference(name))["link_info"]
+    assert info["header_size"] == 0x24
+    assert info["flags"] == toolbar.SHELL_LINK_VOLUME_ID_AND_LOCAL_BASE_PATH
+    assert info["volume"] == (0x11, toolbar.SHELL_LINK_DRIVE_FIXED)
+    assert info["local_base_path_unicode"] == target
+    # The system code page can't hold everything, but the unicode path can
+    assert info["local_base_path"] == target.encode("cp1252", errors="replace").decode("cp1252")
+    assert info["common_path_suffix"] == ""
+    assert info["common_path_suffix_unicode"] == ""
+
+
+def test_non_ascii_link_info_falls_back_in_system_code_page():
+    info = parse_shell_link(read_reference("non_ascii"))["link_info"]
+    assert info["local_base_path"] == "C:\\Users\\Zo\u00eb\\Men\u00fc\\??? ????.bat"
+
+
+def test_long_path_is_kept_whole():
+    link = parse_shell_link(read_reference("long_path"))
+    assert len(CASES["long_path"]["target"]) > 260
+    assert link["link_info"]["local_base_path_unicode"] == CASES["long_path"]["target"]
+    assert len(link["strings"]["arguments"]) == 1000
+
+
+def test_unc_target_link_info():
+    info = parse_shell_link(read_reference("unc_path"))["link_info"]
+    assert info["flags"] == toolbar.SHELL_LINK_COMMON_NETWORK_RELATIVE_LINK_AND_PATH_SUFFIX
+    assert info["local_base_path"] is None and info["local_base_path_unicode"] is None
+    assert info["net_name"] == info["net_name_unicode"] == "\\\\wsl.localhost\\Ubuntu"
+    assert info["common_path_suffix"] == info["common_path_suffix_unicode"] == "home\\tester\\.config\\App 1.bat"
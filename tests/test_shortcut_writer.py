@@ -0,0 +1,103 @@
+import json
+import sys
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+# Plays the part of powershell.exe for ShortcutWriter: answers each shortcut command with the result marker, recording
+# the decoded values it was sent. Shortcuts named "fail" are refused, and the first session to be sent one named
+# "hang" stops responding to everything.
+STAND_IN_POWERSHELL = """#!%(python)s
+import base64, json, os, re, sys, time
+
+state = %(state)r
+with open(os.path.join(state, "sessions"), "a") as sessions:
+    sessions.write("%%s\\n" %% " ".join(sys.argv[1:]))
+for line in sys.stdin:
+    flush = re.search(r"Write-Output '(\\S+) FLUSH (\\d+)'", line)
+    if flush:
+        print("%%s FLUSH %%s" %% flush.groups(), flush=True)
+        continue
+    result = re.search(r"Write-Output '(\\S+) OK (\\d+)'", line)
+    if not result:
+        continue
+    values = [base64.b64decode(value).decode("utf-8") for value in re.findall(r"\\(D '([^']*)'\\)", line)]
+    name = values[0].rsplit("\\\\", 1)[-1]
+    if name.startswith("hang") and not os.path.exists(os.path.join(state, "hung")):
+        open(os.path.join(state, "hung"), "w").close()
+        time.sleep(60)
+    if name.startswith("fail"):
+        print("%%s ERR %%s Access is denied." %% result.groups(), flush=True)
+        continue
+    with open(os.path.join(state, "shortcuts"), "a") as shortcuts:
+        shortcuts.write(json.dumps(values) + "\\n")
+    print("%%s OK %%s" %% result.groups(), flush=True)
+"""
+
+
+@pytest.fixture
+def powershell(tmp_path, monkeypatch):
+    monkeypatch.setattr(toolbar, "HOST_MOUNTS", {"/mnt/c": "C:"})
+    toolbar.get_windows_directory_from_wsl_directory.cache_clear()
+    state = tmp_path / "state"
+    state.mkdir()
+    script = tmp_path / "powershell.exe"
+    script.write_text(STAND_IN_POWERSHELL % {"python": sys.executable, "state": str(state)})
+    script.chmod(0o755)
+    yield str(script), state
+    toolbar.get_windows_directory_from_wsl_directory.cache_clear()
+
+
+def read_lines(path):
+    return path.read_text().splitlines() if path.exists() else []
+
+
+def test_shortcuts_are_created_in_one_session(powershell):
+    script, state = powershell
+    writer = toolbar.ShortcutWriter(powershell=script, timeout=10, retries=0)
+    windows_lnk = writer.create("/mnt/c/Users/tester/Menu/App 1.lnk", "C:\\Windows\\System32\\wscript.exe",
+                                arguments='"silent.vbs" "App 1.bat"', comment="Ünïcode app", icon_file="C:\\app.ico")
+    writer.create("/mnt/c/Users/tester/Menu/App 2.lnk", "C:\\Windows\\System32\\wscript.exe")
+
+    assert windows_lnk == "C:\\Users\\tester\\Menu\\App 1.lnk"
+    assert writer.close() == {"/mnt/c/Users/tester/Menu/App 1.lnk": None, "/mnt/c/Users/tester/Menu/App 2.lnk": None}
+    assert read_lines(state / "sessions") == [" ".join(toolbar.POWERSHELL_ARGUMENTS)]
+    assert json.loads(read_lines(state / "shortcuts")[0]) == [
+        "C:\\Users\\tester\\Menu\\App 1.lnk", "C:\\Windows\\System32\\wscript.exe", '"silent.vbs" "App 1.bat"',
+        "Ünïcode app", "%USERPROFILE%", "C:\\app.ico"]
+
+
+def test_failed_shortcuts_are_reported_on_their_own(powershell):
+    script, state = powershell
+    writer = toolbar.ShortcutWriter(powershell=script, timeout=10, retries=0)
+    writer.create("/mnt/c/Menu/fail.lnk", "C:\\wscript.exe")
+    writer.create("/mnt/c/Menu/App.lnk", "C:\\wscript.exe")
+
+    assert writer.flush() == {"/mnt/c/Menu/fail.lnk": "Access is denied.", "/mnt/c/Menu/App.lnk": None}
+    # The session carries on, and each flush only gives what happened since the last one
+    writer.create("/mnt/c/Menu/Other.lnk", "C:\\wscript.exe")
+    assert writer.close() == {"/mnt/c/Menu/Other.lnk": None}
+    assert len(read_lines(state / "sessions")) == 1
+
+
+def test_hung_session_is_killed_and_its_shortcuts_retried(powershell):
+    script, state = powershell
+    writer = toolbar.ShortcutWriter(powershell=script, timeout=0.5, retries=1)
+    writer.create("/mnt/c/Menu/hang.lnk", "C:\\wscript.exe")
+    writer.create("/mnt/c/Menu/App.lnk", "C:\\wscript.exe")
+
+    assert writer.close() == {"/mnt/c/Menu/hang.lnk": None, "/mnt/c/Menu/App.lnk": None}
+    assert len(read_lines(state / "sessions")) == 2
+    assert sorted(json.loads(line)[0] for line in read_lines(state / "shortcuts")) == [
+        "C:\\Menu\\App.lnk", "C:\\Menu\\hang.lnk"]
+
+
+def test_shortcuts_are_failed_once_out_of_retries(powershell):
+    script, state = powershell
+    writer = toolbar.ShortcutWriter(powershell=script, timeout=0.5, retries=0)
+    writer.create("/mnt/c/Menu/hang.lnk", "C:\\wscript.exe")
+
+    assert writer.close() == {
+        "/mnt/c/Menu/hang.lnk": "powershell session stopped responding before creating shortcut"}
+    assert not (state / "shortcuts").exists()
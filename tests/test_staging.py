@@ -0,0 +1,135 @@
+import os
+import stat
+import sys
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+# Plays the part of robocopy.exe for StagingDirectory, copying between the windows paths it is given as they appear
+# under the test's C: drive. Copies to anywhere named "locked" fail with robocopy's error output.
+STAND_IN_ROBOCOPY = """#!%(python)s
+import os, shutil, sys
+
+drive = %(drive)r
+with open(os.path.join(drive, "robocopy-calls"), "a") as calls:
+    calls.write("%%s\\n" %% " ".join(sys.argv[1:]))
+source, destination = [os.path.join(drive, path[3:].replace("\\\\", "/")) for path in sys.argv[1:3]]
+if "locked" in destination:
+    print("2026/10/17 12:00:00 ERROR 5 (0x00000005) Accessing Destination Directory %%s" %% sys.argv[2])
+    print("  Access is denied.")
+    sys.exit(16)
+shutil.copytree(source, destination, dirs_exist_ok=True)
+sys.exit(1)
+"""
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    drive = tmp_path / "c"
+    drive.mkdir()
+    robocopy = tmp_path / "robocopy.exe"
+    robocopy.write_text(STAND_IN_ROBOCOPY % {"python": sys.executable, "drive": str(drive)})
+    robocopy.chmod(0o755)
+    monkeypatch.setattr(toolbar, "ROBOCOPY_EXECUTABLE", str(robocopy))
+    monkeypatch.setattr(toolbar, "HOST_MOUNTS", {str(drive): "C:"})
+    monkeypatch.setattr(toolbar, "command_executor", toolbar.CommandExecutor(retries=0))
+    toolbar.get_windows_directory_from_wsl_directory.cache_clear()
+    yield drive
+    toolbar.get_windows_directory_from_wsl_directory.cache_clear()
+
+
+def robocopy_calls(drive):
+    calls = drive / "robocopy-calls"
+    return calls.read_text().splitlines() if calls.exists() else []
+
+
+def stage_file(staging, path, content, mode=None):
+    staged_path = staging.path(str(path))
+    with open(staged_path, "w") as staged_file:
+        staged_file.write(content)
+    if mode is not None:
+        staging.set_mode(str(path), mode)
+    return staged_path
+
+
+def test_staged_files_are_copied_across_in_one_go(drive):
+    install, metadata, elsewhere = drive / "install", drive / "metadata", drive / "elsewhere"
+    staging = toolbar.StagingDirectory(parent=str(drive))
+    try:
+        staging.add(str(install))
+        staging.add(str(metadata))
+        assert staging.path(str(elsewhere / "app.sh")) == str(elsewhere / "app.sh")
+        staged_path = stage_file(staging, install / "App 1.lnk", "shortcut")
+        assert not staged_path.startswith(str(install))
+        stage_file(staging, metadata / "app1.sh", "#!/bin/bash\n", mode=0o755)
+        assert not install.exists() and not metadata.exists()
+
+        assert staging.sync([str(install), str(metadata)]) == []
+        assert (install / "App 1.lnk").read_text() == "shortcut"
+        assert (metadata / "app1.sh").read_text() == "#!/bin/bash\n"
+        assert stat.S_IMODE((metadata / "app1.sh").stat().st_mode) == 0o755
+        # The copies are run side by side, so may be made in either order
+        assert sorted(tuple(call.split()[:2]) for call in robocopy_calls(drive)) == sorted(
+            (toolbar.get_windows_path_from_wsl_path(staging.roots[root]), toolbar.get_windows_path_from_wsl_path(root))
+            for root in [str(install), str(metadata)])
+        assert staging.modes == {}
+    finally:
+        staging.close()
+
+
+def test_adding_a_root_again_starts_it_afresh(drive):
+    install = drive / "install"
+    staging = toolbar.StagingDirectory(parent=str(drive))
+    try:
+        staging.add(str(install))
+        stale_path = stage_file(staging, install / "Old App.lnk", "shortcut")
+        staging.add(str(install))
+        stage_file(staging, install / "App 1.lnk", "shortcut")
+
+        assert staging.sync([str(install)]) == []
+        assert sorted(path.name for path in install.iterdir()) == ["App 1.lnk"]
+        assert not os.path.exists(stale_path)
+
+        # Nothing staged since, so there is nothing to copy
+        staging.add(str(install))
+        assert staging.sync([str(install)]) == []
+        assert len(robocopy_calls(drive)) == 1
+    finally:
+        staging.close()
+    assert staging.directory is None and staging.roots == {}
+
+
+def test_failed_copies_are_reported_without_holding_up_the_rest(drive):
+    locked, metadata = drive / "locked", drive / "metadata"
+    staging = toolbar.StagingDirectory(parent=str(drive))
+    try:
+        staging.add(str(locked))
+        staging.add(str(metadata))
+        stage_file(staging, locked / "App 1.lnk", "shortcut")
+        stage_file(staging, locked / "app1.sh", "#!/bin/bash\n", mode=0o755)
+        stage_file(staging, metadata / "app1.sh", "#!/bin/bash\n", mode=0o755)
+
+        failures = staging.sync([str(locked), str(metadata)])
+        assert failures == [(str(locked), "2026/10/17 12:00:00 ERROR 5 (0x00000005) Accessing Destination Directory "
+                                          "C:\\locked Access is denied.")]
+        assert not locked.exists()
+        assert stat.S_IMODE((metadata / "app1.sh").stat().st_mode) == 0o755
+        # Permissions for what didn't make it across are dropped rather than set on the next sync
+        assert staging.modes == {}
+    finally:
+        staging.close()
+
+
+def test_missing_robocopy_fails_every_copy(drive, monkeypatch):
+    monkeypatch.setattr(toolbar, "ROBOCOPY_EXECUTABLE", str(drive / "missing" / "robocopy.exe"))
+    install = drive / "install"
+    staging = toolbar.StagingDirectory(parent=str(drive))
+    try:
+        staging.add(str(install))
+        stage_file(staging, install / "App 1.lnk", "shortcut")
+        [(root, error)] = staging.sync([str(install)])
+        assert root == str(install)
+        assert "No such file or directory" in error
+    finally:
+        staging.close()
@@ -0,0 +1,58 @@
+import io
+import json
+import os
+
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+
+def config_file(config):
+    handle = io.StringIO(json.dumps(config))
+    handle.name = "targets.json"
+    return handle
+
+
+@pytest.fixture
+def defaults(tmp_path):
+    menu_file = tmp_path / "applications.menu"
+    menu_file.write_text("<Menu/>")
+    groups = {"distribution": ["Ubuntu"], "menu_file": [str(menu_file)], "target_name": []}
+    return groups, {
+        "user": "tester",
+        "wsl_executable": "C:\\Windows\\System32\\wsl.exe",
+        "rc_file": "/home/tester/.bashrc",
+        "launch_directory": "/home/tester",
+        "shortcut_suffix": None,
+        "launcher_mode": "per-entry",
+        "launch_environment": "interactive"
+    }
+
+
+def test_config_targets_fill_in_from_the_command_line(defaults):
+    groups, target_defaults = defaults
+    targets = toolbar.get_targets(groups, target_defaults, config_file({"targets": [
+        {"distribution": "Debian", "target_name": "Work", "shortcut_suffix": None}, {"distribution": "Alpine"}]}))
+
+    assert [(target["distribution"], target["target_name"]) for target in targets] == [
+        ("Debian", "Work"), ("Alpine", "Alpine")]
+    assert all(target["user"] == "tester" for target in targets)
+
+
+@pytest.mark.parametrize("config", [
+    {"targets": [{"distribution": "Bench", "target_name": 5}]},
+    {"targets": [{"distribution": "Bench", "user": ["tester"]}]},
+    {"targets": [{"distribution": "Bench", "rc_file": None}]},
+    {"targets": [{"distribution": "Bench"}, {"distribution": "Other", "shortcut_suffix": False}]},
+    {"targets": [{"distribution": "Bench", "colour": "red"}]},
+    {"targets": {"distribution": "Bench"}},
+    {"targets": ["Bench"]},
+    ["Bench"]
+])
+def test_bad_config_files_are_refused(defaults, config, caplog):
+    groups, target_defaults = defaults
+    with pytest.raises(SystemExit) as exit_info:
+        toolbar.get_targets(groups, target_defaults, config_file(config))
+
+    assert exit_info.value.code == os.EX_DATAERR
+    assert "targets.json" in caplog.text
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+import xdg.Menu
+
+import wsl_windows_toolbar as toolbar
+
+
+@pytest.fixture
+def menu(tmp_path, monkeypatch):
+    menu_directory = tmp_path / "menus"
+    menu_directory.mkdir()
+    (menu_directory / "applications.menu").write_text("<Menu/>")
+    applications = tmp_path / "applications"
+    applications.mkdir()
+    parsed = []
+
+    def parse(menu_file):
+        parsed.append(menu_file)
+        return menu_file
+    monkeypatch.setattr(xdg.Menu, "parse", parse)
+    monkeypatch.setattr(toolbar, "get_menu_directories", lambda parsed_menu: [str(applications)])
+    return {"menu_file": str(menu_directory / "applications.menu")}, str(menu_directory), str(applications), parsed
+
+
+def test_menu_is_only_parsed_again_when_its_menu_files_change(menu):
+    target, menu_directory, applications, parsed = menu
+    paths = toolbar.get_menu_watch_paths(target)
+    assert applications in paths and menu_directory in paths
+    assert len(parsed) == 1
+
+    assert toolbar.get_menu_watch_paths(target, paths, {applications}) == paths
+    assert len(parsed) == 1
+    toolbar.get_menu_watch_paths(target, paths, {os.path.join(menu_directory, "applications-merged")})
+    assert len(parsed) == 2
+
+
+def test_new_subdirectories_of_changed_directories_are_watched(menu):
+    target, _, applications, parsed = menu
+    paths = toolbar.get_menu_watch_paths(target)
+    os.mkdir(os.path.join(applications, "games"))
+
+    assert os.path.join(applications, "games") in toolbar.get_menu_watch_paths(target, paths, {applications})
+    assert len(parsed) == 1
+
+
+@pytest.mark.parametrize("watcher_class", [toolbar.InotifyWatcher, toolbar.PollingWatcher])
+def test_watchers_report_which_directories_changed(tmp_path, watcher_class):
+    watcher = watcher_class() if watcher_class is toolbar.InotifyWatcher else watcher_class(interval=0.01)
+    directories = [str(tmp_path / name) for name in ["first", "second"]]
+    for directory in directories:
+        os.mkdir(directory)
+    try:
+        watcher.watch(directories)
+        os.utime(directories[1], (0, 0))
+        assert watcher.wait(1) == {directories[1]}
+        assert watcher.wait(0.05) == set()
+    finally:
+        watcher.close()
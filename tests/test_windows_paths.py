@@ -0,0 +1,87 @@
+import pytest
+
+import wsl_windows_toolbar as toolbar
+
+
+@pytest.mark.parametrize("line, mount", [
+    # WSL1 names the drive as the drvfs device
+    ("C: /mnt/c drvfs rw,noatime,uid=1000,gid=1000,case=off 0 0", ("/mnt/c", "C:")),
+    ("C:\\134 /mnt/c drvfs rw,noatime 0 0", ("/mnt/c", "C:")),
+    ("\\134\\134server\\134share /mnt/share drvfs rw 0 0", ("/mnt/share", "\\\\server\\share")),
+    # WSL2 mounts drives over 9p, with the drive in the options
+    ("C:\\134 /mnt/c 9p rw,noatime,dirsync,aname=drvfs;path=C:\\134;uid=1000;gid=1000;symlinkroot=/mnt/,mmap,"
+     "access=client,msize=262144,trans=virtio 0 0", ("/mnt/c", "C:")),
+    ("drvfs /mnt/d 9p rw,aname=drvfs;path=D:\\134Data\\040Files\\134;symlinkroot=/mnt/ 0 0",
+     ("/mnt/d", "D:\\Data Files")),
+    # Mount points are escaped too
+    ("E: /mnt/my\\040drive drvfs rw 0 0", ("/mnt/my drive", "E:")),
+    # Windows filesystems which can't be placed on the windows side
+    ("drvfs /mnt/x drvfs rw,noatime 0 0", ("/mnt/x", None)),
+])
+def test_parse_windows_mounts(line, mount):
+    assert list(toolbar.parse_windows_mounts([line + "\n"])) == [mount]
+
+
+def test_other_filesystems_are_not_windows_mounts():
+    assert list(toolbar.parse_windows_mounts([
+        "/dev/sdc / ext4 rw,relatime,discard,errors=remount-ro,data=ordered 0 0\n",
+        "tmpfs /run tmpfs rw,nosuid,nodev,mode=755 0 0\n",
+        "none /usr/lib/wsl/drivers 9p ro,dirsync,aname=drivers;fmask=222;dmask=222,mmap,access=client 0 0\n",
+        "none /mnt/wsl 9p rw,trans=fd 0 0\n",
+        "\n"
+    ])) == []
+
+
+@pytest.fixture
+def windows_paths(monkeypatch):
+    wslpath_calls = []
+
+    def check_output(command):
+        wslpath_calls.append(command)
+        answers = {
+            "/home/tester/.config/menus": b"\\\\wsl.localhost\\Ubuntu\\home\\tester\\.config\\menus\n",
+            # Symbolic links are resolved, so the answer says nothing about where the root is
+            "/home/tester/link": b"\\\\wsl.localhost\\Ubuntu\\opt\\target\n"
+        }
+        return answers[command[-1]]
+    monkeypatch.setattr(toolbar, "HOST_MOUNTS", {"/mnt/c": "C:", "/mnt/c/data": "\\\\server\\share"})
+    monkeypatch.setattr(toolbar, "linux_root_windows_path", None)
+    monkeypatch.setattr(toolbar.command_executor, "check_output", check_output)
+    monkeypatch.setenv("WSL_DISTRO_NAME", "Ubuntu")
+    toolbar.get_windows_directory_from_wsl_directory.cache_clear()
+    yield wslpath_calls
+    toolbar.get_windows_directory_from_wsl_directory.cache_clear()
+
+
+@pytest.mark.parametrize("path, windows_path", [
+    ("/mnt/c/Users/tester/App 1.lnk", "C:\\Users\\tester\\App 1.lnk"),
+    ("/mnt/c/App.lnk", "C:\\App.lnk"),
+    ("/mnt/c/data/shared/App.lnk", "\\\\server\\share\\shared\\App.lnk"),
+    ("/mnt/cdrom/App.lnk", "\\\\wsl.localhost\\Ubuntu\\mnt\\cdrom\\App.lnk"),
+])
+def test_drive_paths_need_no_wslpath(windows_paths, path, windows_path):
+    assert toolbar.get_windows_path_from_wsl_path(path, query_wslpath=False) == windows_path
+    assert windows_paths == []
+
+
+def test_linux_root_is_learned_from_wslpath(windows_paths):
+    assert toolbar.get_windows_path_from_wsl_path("/home/tester/.config/menus/app.sh") == \
+        "\\\\wsl.localhost\\Ubuntu\\home\\tester\\.config\\menus\\app.sh"
+    assert toolbar.linux_root_windows_path == "\\\\wsl.localhost\\Ubuntu"
+    assert toolbar.get_windows_path_from_wsl_path("/opt/app/app.sh") == "\\\\wsl.localhost\\Ubuntu\\opt\\app\\app.sh"
+    assert len(windows_paths) == 1
+
+
+def test_linux_root_is_not_learned_from_resolved_links(windows_paths):
+    assert toolbar.get_windows_path_from_wsl_path("/home/tester/link/app.sh") == \
+        "\\\\wsl.localhost\\Ubuntu\\opt\\target\\app.sh"
+    assert toolbar.linux_root_windows_path is None
+
+
+@pytest.mark.parametrize("windows_path, path", [
+    ("C:\\Users\\tester\\AppData", "/mnt/c/Users/tester/AppData"),
+    ("c:\\Users\\\\tester\\", "/mnt/c/Users/tester"),
+])
+def test_wsl_paths_from_drive_paths(windows_paths, windows_path, path):
+    assert toolbar.get_wsl_path_from_windows_path(windows_path) == path
+    assert windows_paths == []
@@ -5,71 +5,260 @@ import logging
 import shutil
 import subprocess
 import sys
+import re
 import glob
-import magic
+import functools
+import itertools
+import hashlib
+import json
+import base64
+import io
+import struct
+import threading
+import multiprocessing
+import concurrent.futures
+import asyncio
+import signal
+import collections
+import contextlib
+import time
+import select
+import tempfile
+import hmac
+import getpass
+import socketserver
 from platform import uname
 import click
-from PIL import Image
-# Set up default logging format and level
-import xdg.Menu
-import xdg.IconTheme
 from click import confirm
-from jinja2 import Environment, PackageLoader, FileSystemLoader
-
+# Heavier dependencies (PIL, pyxdg, jinja2, cairosvg) are imported where they are used so that --help and option
+# errors don't pay for them
 
+# Set up default logging format and level
 logging.basicConfig(level=logging.INFO, format='%(asctime)s[%(levelname)s]: %(message)s')
 logger = logging.getLogger(__name__)
 
-# Pre-run checks up here
-if uname().system.upper() != "LINUX" or "MICROSOFT" not in uname().release.upper():
-    logger.error("WSL Linux environment required (detected: %s [%s])",
-                 uname().system,
-                 uname().release)
-    exit(1)
-
-# Check required tools are available
-for exe in ["cmd.exe", "attrib.exe", "powershell.exe", "wscript.exe", "wslpath"]:
-    # Just check for non zero return codes
-    logger.debug("Checking availability of %s...", exe)
-    try:
-        proc = subprocess.check_output(["which", exe])
-        logger.debug("Found: %s", proc.rstrip().decode())
-    except subprocess.CalledProcessError:
-        logger.error("The %s application must be in the current user's executable $PATH.", exe)
-        sys.exit(os.EX_UNAVAILABLE)
+# These must all be on the $PATH
+REQUIRED_EXECUTABLES = ["cmd.exe", "attrib.exe", "powershell.exe", "wscript.exe", "wslpath"]
 
 PROC_MOUNTS = "/proc/mounts"
 DEFAULT_HOST_MOUNTPOINT = "/mnt/c"
+# Windows drives mounted in WSL, indexed by wsl mount point (e.g. /mnt/c -> C:\)
+HOST_MOUNTS = {}
+
+
+def _unescape_mount_field(field):
+    # /proc/mounts escapes whitespace and backslashes as octal (e.g. C:\134 for C:\)
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), field)
+
+
+def _get_windows_mount_root(fs, opts):
+    # WSL2 records the drive in the 9p mount options (aname=drvfs;path=C:\;...), WSL1 as the drvfs device (C:)
+    for opt in re.split("[,;]", opts):
+        if opt.startswith("path="):
+            return opt[len("path="):]
+    if re.match("^[A-Za-z]:", fs) or fs.startswith("\\\\"):
+        return fs
+    return None
+
+
+# Gives the (mount point, windows root) of each windows filesystem in the lines of /proc/mounts, with a root of None for
+# any whose windows location can't be told. WSL2 also uses 9p for things other than drives (e.g. its gpu drivers).
+def parse_windows_mounts(lines):
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 4 or fields[2] not in ["drvfs", "9p"]:
+            continue
+        if fields[2] == "9p" and "aname=drvfs" not in re.split("[,;]", fields[3]):
+            continue
+        windows_root = _get_windows_mount_root(_unescape_mount_field(fields[0]), _unescape_mount_field(fields[3]))
+        yield _unescape_mount_field(fields[1]), windows_root.rstrip("\\") if windows_root else None
+
+
 if os.path.exists(PROC_MOUNTS):
     with open(PROC_MOUNTS) as mount_fh:
-        for mount in mount_fh.readlines():
-            fs, mp, typ, opts, dump, pas = mount.rstrip().split()
-            if typ in ["drvfs", "9p"]:
-                DEFAULT_HOST_MOUNTPOINT = mp
-
-WINDOWS_USERPROFILE = subprocess.check_output(
-    ["cmd.exe", "/C", "echo", "%USERPROFILE%"],
-    stderr=subprocess.DEVNULL
-).rstrip().decode("utf-8")
-WSL_USERPROFILE = subprocess.check_output(
-    ["wslpath", WINDOWS_USERPROFILE]
-).rstrip().decode("utf-8")
-
-WINDOWS_USERAPPDATA = subprocess.check_output(
-    ["cmd.exe", "/C", "echo", "%APPDATA%"],
-    stderr=subprocess.DEVNULL
-).rstrip().decode("utf-8")
-WSL_USERAPPDATA = subprocess.check_output(
-    ["wslpath", WINDOWS_USERAPPDATA]
-).rstrip().decode("utf-8")
-
-# Install in the start menu
-DEFAULT_INSTALL_DIRECTORY = os.path.join(
-    WSL_USERAPPDATA, "Microsoft", "Windows", "Start Menu", "Programs", "WSL Windows Toolbar")
-
-# Install metadata in our local .config directory
-DEFAULT_METADATA_DIRECTORY = os.path.join(
-    WSL_USERPROFILE, ".config", "wsl-windows-toolbar-launcher/metadata")
+        for mount_point, windows_root in parse_windows_mounts(mount_fh.readlines()):
+            DEFAULT_HOST_MOUNTPOINT = mount_point
+            if windows_root:
+                HOST_MOUNTS[mount_point] = windows_root
+
+# Lazily learned windows (UNC) location of the linux root filesystem, e.g. \\wsl.localhost\Ubuntu
+linux_root_windows_path = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_windows_directory_from_wsl_directory(directory, query_wslpath=True):
+    global linux_root_windows_path
+    directory = os.path.abspath(directory)
+
+    # Prefer the most specific windows drive mount containing this directory
+    for mount_point in sorted(HOST_MOUNTS, key=len, reverse=True):
+        if directory == mount_point or directory.startswith(mount_point.rstrip("/") + "/"):
+            relative_path = directory[len(mount_point):].strip("/")
+            return "\\".join([HOST_MOUNTS[mount_point]] + (relative_path.split("/") if relative_path else [""]))
+
+    if linux_root_windows_path is not None and directory != "/":
+        return linux_root_windows_path + directory.replace("/", "\\")
+
+    if not query_wslpath:
+        # Best guess at where windows sees the linux filesystem, for when spawning wslpath is off the table
+        return "\\\\wsl.localhost\\%s%s" % (os.environ.get("WSL_DISTRO_NAME", ""), directory.replace("/", "\\"))
+
+    # Not something we can work out ourselves - ask wslpath, and learn the linux root location from its answer
+    windows_directory = command_executor.check_output(["wslpath", "-w", "-a", directory]).rstrip().decode()
+    windows_suffix = directory.replace("/", "\\")
+    if directory != "/" and windows_directory.startswith("\\\\") and windows_directory.endswith(windows_suffix):
+        linux_root_windows_path = windows_directory[:-len(windows_suffix)]
+        logger.debug("Windows location of linux root filesystem is %s", linux_root_windows_path)
+    return windows_directory
+
+
+def get_wsl_path_from_windows_path(path):
+    drive_root, separator, relative_path = path.partition("\\")
+    for mount_point, windows_root in HOST_MOUNTS.items():
+        if windows_root.upper() == drive_root.upper():
+            return os.path.join(mount_point, *[part for part in relative_path.split("\\") if part])
+    return command_executor.check_output(["wslpath", path]).rstrip().decode("utf-8")
+
+
+# Install in the start menu (relative to %APPDATA%)
+DEFAULT_INSTALL_DIRECTORY_PARTS = ["Microsoft", "Windows", "Start Menu", "Programs", "WSL Windows Toolbar"]
+
+# Install metadata in our local .config directory (relative to %USERPROFILE%)
+DEFAULT_METADATA_DIRECTORY_PARTS = [".config", "wsl-windows-toolbar-launcher/metadata"]
+# Stands in for %USERPROFILE% in dry runs outside of WSL, where there is no windows to ask
+DRY_RUN_PROFILE_DIRECTORY = "/mnt/c/Users"
+
+# Converted icons (and the icon theme index) are cached on the linux side so they can be shared between installations
+CACHE_DIRECTORY = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "wsl-windows-toolbar-launcher")
+DEFAULT_ICON_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "icons")
+ICON_CACHE_VERSION = "3"
+ICON_THEME_INDEX_FILE = os.path.join(CACHE_DIRECTORY, "icon-theme-index.json")
+ICON_THEME_INDEX_VERSION = 1
+ENVIRONMENT_CACHE_FILE = os.path.join(CACHE_DIRECTORY, "environment-%s.json")
+# Flattened copies of parsed menus, keyed by menu file. Besides the files that went into a menu, how it comes out
+# depends on where pyxdg looks for menus and desktop entries, the desktop entries are shown for and the language.
+MENU_CACHE_FILE = os.path.join(CACHE_DIRECTORY, "menu-%s.json")
+MENU_CACHE_VERSION = 1
+MENU_ENVIRONMENT = ["XDG_CONFIG_HOME", "XDG_CONFIG_DIRS", "XDG_DATA_HOME", "XDG_DATA_DIRS", "XDG_MENU_PREFIX",
+                    "XDG_CURRENT_DESKTOP", "LANGUAGE", "LC_ALL", "LC_MESSAGES", "LANG"]
+# Compiled launcher templates - these are checked against the template source, so edited templates are recompiled
+TEMPLATE_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "templates")
+
+# Sizes rendered into each windows icon
+ICON_SIZES = [16, 24, 32, 48, 256]
+# Icon theme directories which hold the same icons drawn at one size (e.g. 48x48), or as vectors to suit any size
+ICON_SIZE_DIRECTORY_PATTERN = re.compile(r"^(?:(\d+)x\1|scalable)$")
+# A theme may draw an icon in a different format at another size (most often a png, with an svg under scalable)
+ICON_VARIANT_EXTENSIONS = [".png", ".svg", ".svgz", ".xpm"]
+# Icon formats are told apart by the first few bytes of the file, which is all it takes for anything icon themes and
+# pixmap directories hold. Files which match none of these go by their extension.
+ICON_SNIFF_BYTES = 256
+ICON_FORMAT_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\x1f\x8b", "svg"),
+    (b"<?xml", "svg"),
+    (b"<svg", "svg"),
+    (b"<!DOCTYPE svg", "svg"),
+    (b"/* XPM */", "xpm"),
+    (b"! XPM2", "xpm"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF8", "gif"),
+    (b"BM", "bmp"),
+    (b"\x00\x00\x01\x00", "ico")
+]
+ICON_FORMAT_EXTENSIONS = {".svg": "svg", ".svgz": "svg", ".xpm": "xpm"}
+# XPM images are C source - the image is in the string literals, and comments (which may hold quotes) are skipped over
+XPM_TOKEN_PATTERN = re.compile(r'/\*.*?\*/|"((?:[^"\\]|\\.)*)"', re.DOTALL)
+# Colour keys in order of preference - colour, grayscale, 4 level grayscale and mono (symbolic names are no use here)
+XPM_COLOUR_KEYS = ["c", "g", "g4", "m"]
+# Whatever python can't read is handed to imagemagick, all together in one run - or one at a time where there is no
+# batch (icons converted outside of an IconConverter)
+IMAGEMAGICK_BATCH_COMMAND = ["mogrify", "-format", "png"]
+IMAGEMAGICK_COMMAND = ["convert"]
+
+# Launchers are either generated for each menu item, or one dispatcher looks each menu item up in a table by its id
+LAUNCHER_MODES = ["per-entry", "dispatch"]
+LAUNCHER_TEMPLATES = {
+    "per-entry": ("wsl-windows-toolbar-template.bat.j2", "wsl-windows-toolbar-template.sh.j2"),
+    "dispatch": ("wsl-windows-toolbar-dispatch.bat.j2", "wsl-windows-toolbar-dispatch.sh.j2")
+}
+DISPATCH_TABLE_FILE_NAME = "launchers.tsv"
+DISPATCH_SHELL_FILE_NAME = "dispatch.sh"
+DISPATCH_BATCH_FILE_NAME = "dispatch.bat"
+
+# Generated files are either written straight to windows, or staged on the linux side and copied across in bulk
+WRITE_MODES = ["direct", "staged"]
+ROBOCOPY_EXECUTABLE = "robocopy.exe"
+# Copy subdirectories (even empty ones) with data, attributes and timestamps, without retrying for ages on failure and
+# without listing every file and directory copied - errors are still printed
+ROBOCOPY_ARGUMENTS = ["/E", "/COPY:DAT", "/R:2", "/W:1", "/NP", "/NJH", "/NJS", "/NFL", "/NDL"]
+# robocopy.exe exit codes are a bit mask, where anything from here up means something could not be copied
+ROBOCOPY_FAILED = 8
+
+# Launchers either start an interactive shell which sources the rc file every time, load a snapshot of the environment
+# that leaves behind, or ask the launch broker to start their menu item. The snapshot lives on the linux side and is
+# taken again whenever the rc file changes or WSL restarts (as things like $DISPLAY can change between boots).
+LAUNCH_ENVIRONMENTS = ["interactive", "snapshot", "broker"]
+ENVIRONMENT_SNAPSHOT_FILE = os.path.join(CACHE_DIRECTORY, "launch-environment-%s.sh")
+BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
+# Shell function which writes out the environment an interactive shell has once it has sourced the rc file. The shell
+# starts from a clean environment with only the basics passed through, so what is written out is all down to the rc
+# file and not whatever happened to be set where the snapshot was taken. Anything tied to the shell itself is left out.
+ENVIRONMENT_SNAPSHOT_VERSION = 2
+ENVIRONMENT_SNAPSHOT_FUNCTION = """take_environment_snapshot() {
+    local name
+    local clean_environment=()
+    for name in HOME USER LOGNAME SHELL PATH LANG WSL_DISTRO_NAME WSLENV; do
+        [ -n "${!name+set}" ] && clean_environment+=("$name=${!name}")
+    done
+    env -i "${clean_environment[@]}" \\
+        bash -i -c 'source "$1" > /dev/null 2>&1; export -n PWD OLDPWD SHLVL TERM _; export -p > "$2"' \\
+        bash "$1" "$2" < /dev/null > /dev/null 2>&1
+}"""
+# Launcher preamble which loads the snapshot, taking it again first if it has gone stale since it was installed
+ENVIRONMENT_SNAPSHOT_LOADER = """%(function)s
+
+read -r boot_id < %(boot_id_file)s
+snapshot="%(snapshot)s"
+rcfile="%(rcfile)s"
+header=""
+version=""
+[ -r "$snapshot" ] && { read -r header; read -r; read -r version; } < "$snapshot"
+if [ "$header" != "# boot $boot_id" ] || [ "$version" != "# snapshot %(version)d" ] || \\
+        [ "$rcfile" -nt "$snapshot" ]; then
+    take_environment_snapshot "$rcfile" "$snapshot.$$"
+    {
+        echo "# boot $boot_id"
+        echo "# rc $(sha256sum < "$rcfile" | cut -d ' ' -f 1)"
+        echo "# snapshot %(version)d"
+        cat "$snapshot.$$"
+    } > "$snapshot.$$.tmp" && mv "$snapshot.$$.tmp" "$snapshot"
+    rm -f "$snapshot.$$"
+fi
+source "$snapshot"
+"""
+# The launch broker (see LaunchBroker) listens on a localhost port, which launchers find in the broker file of their
+# target along with the token to send it. Only the user can read the broker file.
+BROKER_FILE = os.path.join(CACHE_DIRECTORY, "launch-broker-%s")
+BROKER_TIMEOUT = 5
+# Launcher preamble which hands the launch to the broker, or when that doesn't work out starts the launcher over again
+# in an interactive shell like any other
+BROKER_LOADER = """broker_file="%(broker_file)s"
+if [ -z "$WSL_WINDOWS_TOOLBAR_NO_BROKER" ] && read -r broker_port broker_token < "$broker_file" 2> /dev/null; then
+    broker_reply=$(
+        exec 2> /dev/null 3<> "/dev/tcp/127.0.0.1/$broker_port" || exit
+        printf '%%s\\t%%s\\t%%s\\n' "$broker_token" "$0" "$1" >&3
+        read -r -t %(timeout)d reply <&3 && echo "$reply"
+    )
+    [ "$broker_reply" = "OK" ] && exit 0
+fi
+
+if [ -z "$WSL_WINDOWS_TOOLBAR_NO_BROKER" ]; then
+    WSL_WINDOWS_TOOLBAR_NO_BROKER=1 exec /bin/bash -i "$0" "$@"
+fi
+unset WSL_WINDOWS_TOOLBAR_NO_BROKER
+source %(rcfile)s"""
 
 # Default order of preference for menu selection
 MENU_PREFERENCES = ["gnome", "xfce", "kf5"]
@@ -88,9 +277,6 @@ for menu_type in MENU_PREFERENCES:
 if DEFAULT_MENU_FILE is None and len(MENUS_AVAILABLE) > 0:
     DEFAULT_MENU_FILE = MENUS_AVAILABLE[0]
 
-DEFAULT_METADATA_DIRECTORY = os.path.join(
-    WSL_USERPROFILE, ".config", "wsl-windows-toolbar-launcher/metadata")
-
 FREEDESKTOP_FIELD_CODES = [
     "%f",
     "%F",
@@ -107,48 +293,351 @@ FREEDESKTOP_FIELD_CODES = [
     "%m"
 ]
 
-# Default environment detection for optional extras
-has_cairosvg = False
-has_imagemagick = False
 
-try:
-    from cairosvg import svg2png
-    has_cairosvg = True
-except ImportError:
-    logger.warning("Could not find cairosvg - will not be able to convert svg ")
-    pass
+# Everything we need to know about the WSL / windows environment, worked out the first time it is needed rather than at
+# import. The windows side probes are slow (each one starts a windows process) but only change if windows is
+# reconfigured, so they are cached on disk per distribution.
+class WslEnvironment(object):
+
+    def __init__(self, distribution=None):
+        self.distribution = distribution or os.environ.get("WSL_DISTRO_NAME", "")
+        self.cache_file = ENVIRONMENT_CACHE_FILE % self.distribution
+        self.checked = False
+        self._probes = None
+        self._has_cairosvg = None
+        self._has_imagemagick = None
+
+    @property
+    def is_wsl(self):
+        return uname().system.upper() == "LINUX" and "MICROSOFT" in uname().release.upper()
+
+    def check(self):
+        if self.checked:
+            return
+        if not self.is_wsl:
+            logger.error("WSL Linux environment required (detected: %s [%s])",
+                         uname().system,
+                         uname().release)
+            sys.exit(1)
+
+        # Check required tools are available
+        for exe in REQUIRED_EXECUTABLES:
+            logger.debug("Checking availability of %s...", exe)
+            path = self.probes["tools"].get(exe)
+            if not path:
+                logger.error("The %s application must be in the current user's executable $PATH.", exe)
+                sys.exit(os.EX_UNAVAILABLE)
+            logger.debug("Found: %s", path)
+        self.checked = True
+
+    @property
+    def probes(self):
+        if self._probes is None:
+            self._probes = self._load_probes()
+        return self._probes
+
+    @property
+    def wsl_userprofile(self):
+        self.check()
+        return self.probes["wsl_userprofile"]
+
+    @property
+    def wsl_userappdata(self):
+        self.check()
+        return self.probes["wsl_userappdata"]
+
+    @property
+    def default_install_directory(self):
+        return os.path.join(self.wsl_userappdata, *DEFAULT_INSTALL_DIRECTORY_PARTS)
+
+    @property
+    def default_metadata_directory(self):
+        return os.path.join(self.wsl_userprofile, *DEFAULT_METADATA_DIRECTORY_PARTS)
+
+    @property
+    def has_cairosvg(self):
+        if self._has_cairosvg is None:
+            try:
+                import cairosvg  # noqa: F401
+                self._has_cairosvg = True
+            except (ImportError, OSError):
+                # cairosvg raises OSError rather than ImportError when the cairo library itself is missing
+                logger.warning("Could not find cairosvg - will not be able to convert svg ")
+                self._has_cairosvg = False
+        return self._has_cairosvg
+
+    @property
+    def has_imagemagick(self):
+        if self._has_imagemagick is None:
+            self._has_imagemagick = False
+            try:
+                # Both ways imagemagick gets run must be there - some packagings only install some of its tools
+                self._has_imagemagick = all(
+                    'ImageMagick' in command_executor.check_output([command[0], "-version"]).rstrip().decode()
+                    for command in [IMAGEMAGICK_COMMAND, IMAGEMAGICK_BATCH_COMMAND])
+            except Exception:
+                pass
+            if not self._has_imagemagick:
+                logger.warning("Could not find imagemagick - icons in formats python can't read will not convert")
+        return self._has_imagemagick
+
+    def _load_probes(self):
+        try:
+            with open(self.cache_file) as cache_handle:
+                probes = json.load(cache_handle)
+            # Still good as long as every tool and directory found last time is still there
+            if all(probes["tools"].get(exe) and os.path.exists(probes["tools"][exe]) for exe in REQUIRED_EXECUTABLES) \
+                    and os.path.isdir(probes["wsl_userprofile"]) and os.path.isdir(probes["wsl_userappdata"]):
+                logger.debug("Loaded environment details from %s", self.cache_file)
+                return probes
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError):
+            logger.debug("Could not read environment cache %s", self.cache_file, exc_info=True)
+
+        probes = {
+            "tools": dict((exe, shutil.which(exe)) for exe in REQUIRED_EXECUTABLES),
+            "wsl_userprofile": None,
+            "wsl_userappdata": None
+        }
+        if not all(probes["tools"].values()):
+            # Don't bother asking windows anything - check() will report on what is missing
+            return probes
+
+        # Both are asked for at once, since each one has to wait for a windows process to start
+        variables = [("userprofile", "%USERPROFILE%"), ("userappdata", "%APPDATA%")]
+        results = command_executor.run([["cmd.exe", "/C", "echo", variable] for name, variable in variables])
+        for (name, variable), result in zip(variables, results):
+            probes["windows_" + name] = command_executor.check_result(result).rstrip().decode("utf-8")
+            probes["wsl_" + name] = get_wsl_path_from_windows_path(probes["windows_" + name])
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file + ".tmp", "w") as cache_handle:
+                json.dump(probes, cache_handle, indent=1, sort_keys=True)
+            os.replace(self.cache_file + ".tmp", self.cache_file)
+        except OSError:
+            logger.debug("Could not save environment cache %s", self.cache_file, exc_info=True)
+        return probes
+
+
+environment = WslEnvironment()
+
+
+# Where the time went during a run, for --report and the summary at the end. Phases are the major steps of a run,
+# calls are anything which leaves python (windows tools, imagemagick) or is known to be slow (svg rendering, png
+# encoding, menu parsing) and entries are the time spent on each menu item.
+class RunReport(object):
+    SLOWEST_ENTRIES = 10
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = collections.OrderedDict()
+        self.calls = {}
+        self.entries = {}
+        # Several targets may be reporting at once
+        self.lock = threading.Lock()
+        # Each thread's nested phases, and the calls it is capturing (see capture_calls)
+        self.local = threading.local()
+
+    # Time spent in a phase started within another one only counts towards the inner phase
+    @contextlib.contextmanager
+    def phase(self, name):
+        nested = self.local.__dict__.setdefault("phases", [])
+        started = time.perf_counter()
+        nested.append(0.0)
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            inner = nested.pop()
+            if nested:
+                nested[-1] += seconds
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + seconds - inner
+
+    # Yields from items, counting the time spent getting each one towards a phase - for the streamed plan, whose menu
+    # items are planned as they are asked for while the plan is being applied
+    def iterate(self, name, items):
+        items = iter(items)
+        while True:
+            with self.phase(name):
+                item = next(items, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    @contextlib.contextmanager
+    def call(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_call(name, time.perf_counter() - started)
+
+    # Calls made by this thread within go to the dict given rather than the report, for work which is reported back
+    # separately (icon conversion, which may be done in another process)
+    @contextlib.contextmanager
+    def capture_calls(self):
+        calls = {}
+        self.local.calls = calls
+        try:
+            yield calls
+        finally:
+            self.local.calls = None
+
+    def record_call(self, name, seconds, count=1, slowest=None):
+        calls = getattr(self.local, "calls", None)
+        with self.lock:
+            call = (self.calls if calls is None else calls).setdefault(name, {"count": 0, "seconds": 0.0,
+                                                                              "slowest": 0.0})
+            call["count"] += count
+            call["seconds"] += seconds
+            call["slowest"] = max(call["slowest"], seconds if slowest is None else slowest)
+
+    def merge_calls(self, calls):
+        for name, call in calls.items():
+            self.record_call(name, call["seconds"], call["count"], call["slowest"])
+
+    def record_entry(self, path, seconds):
+        with self.lock:
+            self.entries[path] = self.entries.get(path, 0.0) + seconds
+
+    def to_dict(self):
+        slowest = sorted(self.entries.items(), key=lambda entry: entry[1], reverse=True)[:self.SLOWEST_ENTRIES]
+        return {
+            "total_seconds": time.perf_counter() - self.started,
+            "phases": self.phases,
+            "calls": self.calls,
+            "entries": len(self.entries),
+            "slowest_entries": [{"path": path, "seconds": seconds} for path, seconds in slowest]
+        }
 
-try:
-    if 'ImageMagick' in subprocess.check_output(["convert", "-version"]).rstrip().decode():
-        has_imagemagick = True
-except Exception:
-    logger.warning("Could not find imagemagick - some xpm icons may not convert correctly")
-    pass
+    def save(self, report_file):
+        json.dump(self.to_dict(), report_file, indent=1)
+        report_file.write("\n")
+
+    def log_summary(self):
+        summary = self.to_dict()
+        logger.info("Run took %.2fs: %s", summary["total_seconds"], ", ".join(
+            "%s %.2fs" % (name, seconds) for name, seconds in summary["phases"].items()))
+        for name, call in sorted(summary["calls"].items(), key=lambda call: call[1]["seconds"], reverse=True):
+            logger.info("  %s: %d call(s) taking %.2fs (slowest %.2fs)", name, call["count"], call["seconds"],
+                        call["slowest"])
+        for entry in summary["slowest_entries"][:3]:
+            logger.info("  slow menu item: %s (%.2fs)", entry["path"], entry["seconds"])
+
+
+report = RunReport()
+
+
+CommandResult = collections.namedtuple("CommandResult", ["command", "returncode", "stdout", "stderr", "error"])
+
+
+# Runs external (mostly windows) commands on an asyncio event loop so a batch of them can be in flight at once - at most
+# limit at a time, each given timeout seconds to finish (0 for no limit). Commands which time out, or fail to start for
+# reasons other than not existing, are retried up to retries more times.
+class CommandExecutor(object):
+    RETRY_DELAY = 0.25
+
+    def __init__(self, limit=4, timeout=60.0, retries=2):
+        self.limit = limit
+        self.timeout = timeout
+        self.retries = retries
+
+    def run(self, commands):
+        # Results come back in the same order as the commands
+        commands = [list(command) for command in commands]
+        if not commands:
+            return []
+        return asyncio.run(self._run_all(commands))
+
+    def check_output(self, command):
+        # Drop in for subprocess.check_output on a single command
+        return self.check_result(self.run([command])[0])
+
+    @staticmethod
+    def check_result(result):
+        # Raises whatever subprocess.check_output would have done for this result, otherwise returns the output
+        if result.error is not None:
+            raise result.error
+        if result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, result.command, result.stdout, result.stderr)
+        return result.stdout
+
+    async def _run_all(self, commands):
+        semaphore = asyncio.Semaphore(self.limit)
+        return await asyncio.gather(*[self._run(semaphore, command) for command in commands])
+
+    async def _run(self, semaphore, command):
+        name = os.path.basename(command[0])
+        error = None
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    logger.debug("Retrying %s (%s)", " ".join(command), error)
+                    await asyncio.sleep(self.RETRY_DELAY * attempt)
+                started = time.perf_counter()
+                try:
+                    process = await asyncio.create_subprocess_exec(
+                        *command,
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        start_new_session=True
+                    )
+                except (FileNotFoundError, PermissionError) as e:
+                    return CommandResult(command, None, b"", b"", e)
+                except OSError as e:
+                    error = e
+                    continue
+                try:
+                    stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout or None)
+                except asyncio.TimeoutError:
+                    # Take out anything it started too, or they would hold its output open
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    await process.wait()
+                    error = subprocess.TimeoutExpired(command, self.timeout)
+                    logger.warning("%s did not finish within %ss", name, self.timeout)
+                    continue
+                finally:
+                    report.record_call(name, time.perf_counter() - started)
+                return CommandResult(command, process.returncode, stdout, stderr, None)
+        return CommandResult(command, None, b"", b"", error)
+
+
+command_executor = CommandExecutor()
 
 
 @click.command()
 @click.option("--install-directory",
               "-i",
               type=click.Path(),
-              default=DEFAULT_INSTALL_DIRECTORY,
+              default=None,
               show_default=False,
-              help="Install the launchers here [default: %s]" % DEFAULT_INSTALL_DIRECTORY)
+              help="Install the launchers here [default: %%APPDATA%%\\%s]" % "\\".join(DEFAULT_INSTALL_DIRECTORY_PARTS))
 @click.option("--metadata-directory",
               "-m",
               type=click.Path(),
-              default=DEFAULT_METADATA_DIRECTORY,
+              default=None,
               show_default=False,
-              help="Install any metadata here [default: %s]" % DEFAULT_METADATA_DIRECTORY)
+              help="Install any metadata here [default: %%USERPROFILE%%\\%s]" % "\\".join(
+                  DEFAULT_METADATA_DIRECTORY_PARTS).replace("/", "\\"))
 @click.option("--distribution",
               "-d",
               type=str,
-              default=os.environ['WSL_DISTRO_NAME'],
+              default=[os.environ['WSL_DISTRO_NAME']] if 'WSL_DISTRO_NAME' in os.environ else [],
               show_default=False,
-              help="WSL Distro to generate shortcuts for [default: $WSL_DISTRO_NAME]")
+              multiple=True,
+              help="WSL Distro to generate shortcuts for, pass multiple times for several targets "
+                   "[default: $WSL_DISTRO_NAME]")
 @click.option("--user",
               "-u",
               type=str,
-              default=os.environ['USER'],
+              default=os.environ.get('USER'),
               show_default=False,
               help="WSL Distro's user to launch programs as [default: $USER]")
 @click.option("--confirm-yes",
@@ -160,9 +649,10 @@ except Exception:
 @click.option("--menu-file",
               "-f",
               type=click.File('r'),
-              default=DEFAULT_MENU_FILE,
+              default=[DEFAULT_MENU_FILE] if DEFAULT_MENU_FILE else [],
               show_default=True,
-              help="The *.menu menu file to parse")
+              multiple=True,
+              help="The *.menu menu file to parse, pass multiple times for several targets")
 @click.option("--wsl-executable",
               "-w",
               type=str,
@@ -172,9 +662,19 @@ except Exception:
 @click.option("--target-name",
               "-n",
               type=str,
-              default="WSL",
-              show_default=True,
-              help="Name to give to the created installation (will be displayed in toolbar menu)")
+              default=[],
+              show_default=False,
+              multiple=True,
+              help="Name to give to the created installation (will be displayed in toolbar menu), pass multiple times "
+                   "for several targets [default: WSL, or the distribution when there are several targets]")
+@click.option("--config",
+              "-c",
+              "config_file",
+              type=click.File('r'),
+              default=None,
+              show_default=False,
+              help="JSON file listing the targets to generate shortcuts for, instead of --distribution, --menu-file "
+                   "and --target-name")
 @click.option("--preferred-theme",
               "-t",
               type=str,
@@ -234,6 +734,110 @@ except Exception:
               default=None,
               show_default=False,
               help="String to add to end of shortcut name (defaults to ' (target name)')")
+@click.option("--launcher-mode",
+              "-L",
+              type=click.Choice(LAUNCHER_MODES),
+              default="per-entry",
+              show_default=True,
+              help="Generate launcher scripts for every menu item, or share one dispatcher between them all")
+@click.option("--launch-environment",
+              "-e",
+              type=click.Choice(LAUNCH_ENVIRONMENTS),
+              default="interactive",
+              show_default=True,
+              help="Source the rc file in an interactive shell on every launch, load a cached snapshot of the "
+                   "environment it sets up (much quicker to launch with a heavy rc file), or have the launch broker "
+                   "start menu items when it is running (see --serve-broker)")
+@click.option("--shortcut-backend",
+              "-b",
+              type=click.Choice(["native", "powershell"]),
+              default="powershell",
+              show_default=True,
+              help="How to create shortcuts: through windows powershell, or natively writing .lnk files from python")
+@click.option("--write-mode",
+              "-x",
+              type=click.Choice(WRITE_MODES),
+              default="direct",
+              show_default=True,
+              help="Write generated files straight to windows, or build them on the linux filesystem first and copy "
+                   "only the changed files across in bulk with robocopy")
+@click.option("--jobs",
+              "-p",
+              type=click.IntRange(min=1),
+              default=os.cpu_count() or 1,
+              show_default=False,
+              help="Number of worker processes to use for icon conversion [default: number of CPUs]")
+@click.option("--icon-cache-dir",
+              "-C",
+              type=click.Path(file_okay=False),
+              default=DEFAULT_ICON_CACHE_DIRECTORY,
+              show_default=False,
+              help="Cache converted icons here, shared between all menu items and target names [default: "
+                   "$XDG_CACHE_HOME/wsl-windows-toolbar-launcher/icons]")
+@click.option("--icon-cache-size",
+              "-S",
+              type=click.IntRange(min=0),
+              default=64,
+              show_default=True,
+              help="Maximum size of the icon cache in MB, least recently used icons are evicted first (0 disables)")
+@click.option("--force-rebuild",
+              "-F",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Reparse the menu and regenerate every menu item, even those which have not changed since the last "
+                   "run")
+@click.option("--dry-run",
+              "-P",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Work out what would be installed, updated or removed without changing anything")
+@click.option("--plan-file",
+              "-o",
+              type=click.File("w"),
+              default=None,
+              show_default=False,
+              help="Write the planned shortcuts, launchers and icons as JSON to this file ('-' for stdout)")
+@click.option("--report",
+              "-R",
+              "report_file",
+              type=click.File("w"),
+              default=None,
+              show_default=False,
+              help="Write timings for each phase, external call and the slowest menu items as JSON to this file")
+@click.option("--watch",
+              "-k",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Keep running after installing, updating shortcuts whenever menus, desktop entries or icon themes "
+                   "change")
+@click.option("--serve-broker",
+              "-B",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Keep running after installing, starting menu items for the launchers of targets with the broker "
+                   "launch environment")
+@click.option("--windows-jobs",
+              "-W",
+              type=click.IntRange(min=1),
+              default=command_executor.limit,
+              show_default=True,
+              help="Maximum number of windows commands (attrib.exe, wslpath etc) to run at once")
+@click.option("--command-timeout",
+              "-O",
+              type=click.FloatRange(min=0),
+              default=command_executor.timeout,
+              show_default=True,
+              help="Seconds to wait for a windows command or an unresponsive powershell session (0 waits forever)")
+@click.option("--command-retries",
+              "-Q",
+              type=click.IntRange(min=0),
+              default=command_executor.retries,
+              show_default=True,
+              help="How many times to retry windows commands which time out or fail to start")
 def cli(install_directory,
         metadata_directory,
         distribution,
@@ -242,6 +846,7 @@ def cli(install_directory,
         menu_file,
         wsl_executable,
         target_name,
+        config_file,
         preferred_theme,
         alternative_theme,
         jinja_template_batch,
@@ -250,224 +855,1823 @@ def cli(install_directory,
         launch_directory,
         batch_encoding,
         use_batch_newline_crlf,
-        shortcut_suffix):
+        shortcut_suffix,
+        launcher_mode,
+        launch_environment,
+        shortcut_backend,
+        write_mode,
+        force_rebuild,
+        jobs,
+        icon_cache_dir,
+        icon_cache_size,
+        dry_run,
+        plan_file,
+        report_file,
+        watch,
+        serve_broker,
+        windows_jobs,
+        command_timeout,
+        command_retries):
+
+    command_executor.limit = windows_jobs
+    command_executor.timeout = command_timeout
+    command_executor.retries = command_retries
+
+    # Work out what to generate shortcuts for - each target has its own distribution, menu and installation
+    targets = get_targets(
+        {
+            "distribution": distribution,
+            "menu_file": [menu_file_handle.name for menu_file_handle in menu_file],
+            "target_name": target_name
+        },
+        {
+            "user": user,
+            "wsl_executable": wsl_executable,
+            "rc_file": rc_file.name,
+            "launch_directory": launch_directory,
+            "shortcut_suffix": shortcut_suffix,
+            "launcher_mode": launcher_mode,
+            "launch_environment": launch_environment
+        },
+        config_file
+    )
+
+    if watch and dry_run:
+        logger.error("A dry run can't watch for changes - pass one of --watch or --dry-run")
+        sys.exit(os.EX_USAGE)
+    if serve_broker and dry_run:
+        logger.error("A dry run can't serve launches - pass one of --serve-broker or --dry-run")
+        sys.exit(os.EX_USAGE)
+
+    # Make sure we're somewhere sensible - a dry run never touches windows so can be done anywhere
+    if not dry_run:
+        with report.phase("environment"):
+            environment.check()
+
+    # The default directories are found by asking windows, which a dry run outside of WSL has no way to do - it plans
+    # against stand ins for them instead
+    if install_directory is None or metadata_directory is None:
+        if dry_run and not environment.is_wsl:
+            windows_profile = os.path.join(DRY_RUN_PROFILE_DIRECTORY, user or "user")
+            install_directory = install_directory or os.path.join(windows_profile, "AppData", "Roaming",
+                                                                  *DEFAULT_INSTALL_DIRECTORY_PARTS)
+            metadata_directory = metadata_directory or os.path.join(windows_profile, *DEFAULT_METADATA_DIRECTORY_PARTS)
+            logger.info("Not running under WSL - planning against %s and %s", install_directory, metadata_directory)
+        else:
+            install_directory = install_directory or environment.default_install_directory
+            metadata_directory = metadata_directory or environment.default_metadata_directory
 
     # Debug information
-    logger.info("distribution = '%s'", distribution)
-    logger.info("user = '%s'", user)
     logger.info("confirm_yes = %s", confirm_yes)
-    logger.info("menu_file = '%s'", menu_file.name if menu_file else None)
-    logger.info("wsl_executable = '%s'", wsl_executable)
-    logger.info("target_name = '%s'", target_name)
+    logger.info("config_file = '%s'", config_file.name if config_file else None)
     logger.info("preferred_theme = '%s'", preferred_theme)
     logger.info("alternative_theme = '%s'", alternative_theme)
     logger.info("jinja_template_batch = '%s'", jinja_template_batch.name if jinja_template_batch else None)
     logger.info("jinja_template_shell = '%s'", jinja_template_shell.name if jinja_template_shell else None)
-    logger.info("rc_file = '%s'", rc_file.name)
-    logger.info("has_imagemagick = %s", has_imagemagick)
-    logger.info("has_cairosvg = %s", has_cairosvg)
-    logger.info("launch_directory = '%s'", launch_directory)
+    logger.info("has_imagemagick = %s", environment.has_imagemagick)
+    logger.info("has_cairosvg = %s", environment.has_cairosvg)
     logger.info("batch_encoding = '%s'", batch_encoding)
     logger.info("use_batch_newline_crlf = %s", use_batch_newline_crlf)
+    logger.info("shortcut_backend = '%s'", shortcut_backend)
+    logger.info("write_mode = '%s'", write_mode)
+    logger.info("force_rebuild = %s", force_rebuild)
+    logger.info("jobs = %d", jobs)
+    logger.info("icon_cache_dir = '%s'", icon_cache_dir)
+    logger.info("icon_cache_size = %d", icon_cache_size)
+    logger.info("dry_run = %s", dry_run)
+    logger.info("watch = %s", watch)
+    logger.info("serve_broker = %s", serve_broker)
+    logger.info("windows_jobs = %d", windows_jobs)
+    logger.info("command_timeout = %s", command_timeout)
+    logger.info("command_retries = %d", command_retries)
+
+    # Everything else that shapes the generated output of each target, shared by every menu item
+    for target in targets:
+        if target["shortcut_suffix"] is None:
+            target["shortcut_suffix"] = " (%s)" % target["target_name"]
+        target.update({
+            "batch_encoding": batch_encoding,
+            "use_batch_newline_crlf": use_batch_newline_crlf,
+            "environment_snapshot": ENVIRONMENT_SNAPSHOT_FILE % target["target_name"]
+            if target["launch_environment"] == "snapshot" else None,
+            "broker_file": BROKER_FILE % target["target_name"] if target["launch_environment"] == "broker" else None,
+            "shortcut_backend": shortcut_backend,
+            # Add distro to directory names, since we want to support multiple concurrent distributions
+            "install_directory": os.path.join(install_directory, target["target_name"]),
+            "metadata_directory": os.path.join(metadata_directory, target["target_name"]),
+            "preferred_theme": preferred_theme,
+            "alternative_theme": list(alternative_theme)
+        })
+        for name in TARGET_OPTIONS + ["install_directory", "metadata_directory"]:
+            logger.info("%s = '%s'", name, target[name])
+
+    # The broker starts menu items as whoever runs it, so can only stand in for launchers of this distribution and user
+    broker_targets = []
+    if serve_broker:
+        for target in targets:
+            if not target["broker_file"]:
+                continue
+            if target["distribution"] != os.environ.get("WSL_DISTRO_NAME") or target["user"] != getpass.getuser():
+                logger.warning("Can't serve launches for %s - the launch broker has to run in %s as %s",
+                               target["target_name"], target["distribution"], target["user"])
+                continue
+            broker_targets.append(target)
+        if not broker_targets:
+            logger.error("--serve-broker needs a target of this distribution and user with --launch-environment broker")
+            sys.exit(os.EX_USAGE)
+
+    if not dry_run and not confirm_yes:
+        logger.info("For full list of options available, call script again with --help")
+        logger.info(
+            "This script will write to the above locations if it can, but giving final chance to chicken out."
+        )
+        confirm("Press <enter> to continue or ctrl+c to abort.")
+
+    # Load in the templates which are used to generate the launcher scripts
+    with report.phase("templates"):
+        from jinja2 import Environment, PackageLoader, FileSystemLoader, FileSystemBytecodeCache
+        templates = {}
+        try:
+            os.makedirs(TEMPLATE_CACHE_DIRECTORY, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIRECTORY)
+        except OSError:
+            logger.debug("Could not create template cache %s", TEMPLATE_CACHE_DIRECTORY, exc_info=True)
+            bytecode_cache = None
+        if not jinja_template_batch:
+            # Default load from package
+            env = Environment(loader=PackageLoader('wsl_windows_toolbar', package_path=''),
+                              bytecode_cache=bytecode_cache)
+            for mode in set(target["launcher_mode"] for target in targets):
+                templates[mode] = [env.get_template(name) for name in LAUNCHER_TEMPLATES[mode]]
+        else:
+            # Optionally load from custom filesystem location
+            env = Environment(loader=FileSystemLoader(os.path.dirname(os.path.abspath(jinja_template_batch.name))),
+                              bytecode_cache=bytecode_cache)
+            for mode in set(target["launcher_mode"] for target in targets):
+                templates[mode] = [env.get_template(os.path.basename(jinja_template_batch.name)),
+                                   env.get_template(os.path.basename(jinja_template_shell.name))]
+
+    # Index the icon themes up front so each menu item's icon lookup is cheap
+    with report.phase("icon_index"):
+        icon_index = IconThemeIndex.load([preferred_theme] + list(alternative_theme), ICON_THEME_INDEX_FILE,
+                                         rebuild=force_rebuild)
+
+    # Icons are converted once for all targets. When watching, the same icon workers and shortcut writer sessions
+    # see to every change rather than being started up again each time.
+    icon_cache = IconCache(icon_cache_dir, icon_cache_size * 1024 * 1024) if icon_cache_size > 0 else None
+    icon_converter = None if dry_run else IconConverter(jobs, icon_cache)
+    staging = StagingDirectory() if write_mode == "staged" and not dry_run else None
+    shortcut_writers = {}
+    if watch:
+        for target in targets:
+            shortcut_writers[target["target_name"]] = SHORTCUT_WRITERS[shortcut_backend]()
+    results = install_targets(targets, templates, icon_index, icon_converter, jobs, force_rebuild, dry_run,
+                              stream=not plan_file, shortcut_writers=shortcut_writers, staging=staging)
+    if not watch:
+        if icon_converter is not None:
+            icon_converter.close()
+        if staging is not None:
+            staging.close()
+
+    if plan_file:
+        plans = [plan for plan, shortcuts_installed in results]
+        json.dump(plans[0] if len(plans) == 1 else plans, plan_file, indent=1, sort_keys=True)
+        plan_file.write("\n")
+
+    report.log_summary()
+    if report_file:
+        report.save(report_file)
+    if dry_run:
+        return
+
+    for target, (plan, shortcuts_installed) in zip(targets, results):
+        logger.info("Finished creating %d shortcuts for %s (%d unchanged)!", shortcuts_installed, target["target_name"],
+                    len(plan["diff"]["unchanged"]))
+    logger.info("Before raising an issue, make sure you have Xming / X410 etc set up in your .bashrc.")
+    for target in targets:
+        logger.info(
+            "Right click on the toolbar, then select Toolbars -> New toolbar... and select the directory '%s'.",
+            target["install_directory"]
+        )
+
+    broker = None
+    if broker_targets:
+        broker = LaunchBroker()
+        for target in broker_targets:
+            broker.add(target)
+        broker.start()
+
+    if watch:
+        try:
+            watch_targets(targets, templates, [preferred_theme] + list(alternative_theme), icon_index, icon_converter,
+                          jobs, shortcut_writers, staging, broker)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching for changes")
+        finally:
+            for shortcut_writer in shortcut_writers.values():
+                shortcut_writer.close()
+            icon_converter.close()
+            if staging is not None:
+                staging.close()
+            if broker is not None:
+                broker.close()
+    elif broker is not None:
+        logger.info("Serving launches (ctrl+c to stop)")
+        try:
+            broker.wait()
+        except KeyboardInterrupt:
+            logger.info("Stopped serving launches")
+        finally:
+            broker.close()
+
+
+# Options which may differ between targets, either given once for each target on the command line (distribution, menu
+# file and target name) or set for each target in the config file
+TARGET_OPTIONS = ["target_name", "distribution", "user", "menu_file", "wsl_executable", "rc_file", "launch_directory",
+                  "shortcut_suffix", "launcher_mode", "launch_environment"]
+TARGET_GROUP_OPTIONS = ["distribution", "menu_file", "target_name"]
+# Every target option is a string, and these may also be null in a config file to get the usual default
+TARGET_NULLABLE_OPTIONS = ["target_name", "shortcut_suffix"]
+
+
+# Works out the targets for cli. With a config file, these are its "targets" list, each with any of TARGET_OPTIONS and
+# the command line filling in the rest. Otherwise the distribution, menu file and target name options make up the
+# targets - each given once per target, or once to be shared by them all.
+def get_targets(groups, defaults, config_file=None):
+    if config_file:
+        try:
+            config = json.load(config_file)
+        except ValueError as e:
+            logger.error("Could not read config file %s: %s", config_file.name, e)
+            sys.exit(os.EX_DATAERR)
+        config_targets = config.get("targets") if isinstance(config, dict) else None
+        if not config_targets or not isinstance(config_targets, list) or \
+                not all(isinstance(config_target, dict) for config_target in config_targets):
+            logger.error("Config file %s should contain a list of targets, e.g. {\"targets\": [{\"distribution\": "
+                         "\"Ubuntu\"}]}", config_file.name)
+            sys.exit(os.EX_DATAERR)
+        for name, values in groups.items():
+            defaults[name] = values[0] if values else None
+        targets = []
+        for index, config_target in enumerate(config_targets):
+            unknown = sorted(set(config_target) - set(TARGET_OPTIONS))
+            if unknown:
+                logger.error("Unknown target option(s) %s in config file %s (expected any of %s)",
+                             ", ".join(unknown), config_file.name, ", ".join(TARGET_OPTIONS))
+                sys.exit(os.EX_DATAERR)
+            for name, value in sorted(config_target.items()):
+                if not isinstance(value, str) and not (value is None and name in TARGET_NULLABLE_OPTIONS):
+                    logger.error("Target %d in config file %s has %s %s, but it should be a string%s", index + 1,
+                                 config_file.name, name, json.dumps(value),
+                                 " or null" if name in TARGET_NULLABLE_OPTIONS else "")
+                    sys.exit(os.EX_DATAERR)
+            targets.append(dict(defaults, **config_target))
+    else:
+        count = max([1] + [len(values) for values in groups.values()])
+        for name, values in groups.items():
+            if len(values) > 1 and len(values) != count:
+                logger.error("--%s was given %d times for %d targets - give it once, or once for each target",
+                             name.replace("_", "-"), len(values), count)
+                sys.exit(os.EX_USAGE)
+        targets = []
+        for index in range(count):
+            target = dict(defaults)
+            for name, values in groups.items():
+                target[name] = values[index if len(values) > 1 else 0] if values else None
+            targets.append(target)
+
+    for target in targets:
+        if not target["target_name"]:
+            # A lone target keeps the usual name, several are told apart by their distribution
+            target["target_name"] = target["distribution"] if len(targets) > 1 and target["distribution"] else "WSL"
+        if not target["menu_file"]:
+            logger.error(
+                "Could not find an appropriate .menu file in %s - perhaps yum/apt install gnome-menus or another "
+                "desktop?",
+                DEFAULT_MENU_LOCATION
+            )
+            sys.exit(os.EX_OSFILE)
+        if not os.path.isfile(target["menu_file"]):
+            logger.error("Could not find menu file %s for %s", target["menu_file"], target["target_name"])
+            sys.exit(os.EX_OSFILE)
+        if target["launcher_mode"] not in LAUNCHER_MODES or target["launch_environment"] not in LAUNCH_ENVIRONMENTS:
+            logger.error("Unknown launcher mode '%s' or launch environment '%s' for %s", target["launcher_mode"],
+                         target["launch_environment"], target["target_name"])
+            sys.exit(os.EX_DATAERR)
+
+    # Target names become directory names on windows, where case doesn't count
+    target_names = [target["target_name"].lower() for target in targets]
+    if len(set(target_names)) != len(target_names):
+        logger.error("Each target needs a different name, but got %s - set target names with --target-name",
+                     ", ".join(target["target_name"] for target in targets))
+        sys.exit(os.EX_USAGE)
+    return targets
+
+
+# Older pyxdg releases keep their menu parsing state in module globals
+MENU_PARSE_LOCK = threading.Lock()
+
+
+# Installs the shortcuts for one of cli's targets (or with dry_run, just works out what it would do) given its
+# settings. Returns the plan and how many shortcuts were created. A shortcut writer can be passed in to be kept open,
+# and a staging directory to have everything written there first.
+def install_target(settings, templates, icon_index, icon_converter=None, force_rebuild=False, dry_run=False,
+                   stream=True, shortcut_writer=None, staging=None):
+    install_directory = settings["install_directory"]
+    metadata_directory = settings["metadata_directory"]
+
+    with report.phase("directories"):
+        if not dry_run:
+            # OK we're ready to go - ensure we can create / have write access to the installation directory
+            try:
+                # Create directory and fear not if it already exists
+                os.makedirs(install_directory, exist_ok=True)
+                os.makedirs(metadata_directory, exist_ok=True)
+            except PermissionError:
+                logger.error("No permissions to create directories %s or %s - aborting",
+                             install_directory, metadata_directory)
+                sys.exit(os.EX_NOPERM)
+
+        # One look over everything already installed, which the rest of the run goes by instead of asking windows
+        inventory = FileInventory([install_directory, metadata_directory])
+        logger.debug("Found %d files and directories in %s and %s", len(inventory.entries), install_directory,
+                     metadata_directory)
+
+        if not dry_run:
+            # Check we have absolute ownership of these directories - if not, chicken out
+            for directory in [install_directory, metadata_directory]:
+                unwritable = inventory.get_unwritable(directory)
+                for path in unwritable:
+                    logger.error("Cannot write to %s", path)
+                if unwritable:
+                    logger.error("Could not confirm write access to all contents of %s - aborting", directory)
+                    sys.exit(os.EX_NOPERM)
+
+            # Learn where windows finds the metadata directory up front, so planning never has to ask wslpath
+            get_windows_path_from_wsl_path(metadata_directory)
+
+    # Load the menu from the cache, or else parse it - its desktop menu items are only walked as they are planned
+    with report.phase("menu"):
+        entries = load_menu_entries(settings["menu_file"], rebuild=force_rebuild)
+
+    # The manifest records what was generated last time so unchanged entries can be skipped and removed ones pruned
+    with report.phase("manifest"):
+        manifest = {} if force_rebuild else load_manifest(metadata_directory)
+
+    # Unless the whole plan is wanted up front, menu items are planned as they are found and applied as they are planned
+    batch_template, shell_template = templates[settings["launcher_mode"]]
+    with report.phase("plan"):
+        plan = plan_menu_items(entries, manifest, settings, batch_template, shell_template,
+                               icon_index, stream=stream and not dry_run, inventory=inventory)
+
+    if dry_run:
+        for status, paths in sorted(plan["diff"].items()):
+            for path in paths:
+                logger.info("Would %s menu item for: %s", PLAN_STATUS_ACTIONS[status], path)
+        logger.info("Dry run complete for %s - %d new, %d changed, %d unchanged and %d removed menu items, nothing "
+                    "written", settings["target_name"], len(plan["diff"]["new"]), len(plan["diff"]["changed"]),
+                    len(plan["diff"]["unchanged"]), len(plan["diff"]["removed"]))
+        return plan, 0
+
+    # Take the environment snapshot now so the first launch doesn't have to - only possible for this distribution, the
+    # launchers of any others take their own when first run
+    if settings["environment_snapshot"] and settings["distribution"] == os.environ.get("WSL_DISTRO_NAME"):
+        with report.phase("environment_snapshot"):
+            update_environment_snapshot(settings["environment_snapshot"], settings["rc_file"])
+
+    shortcuts_installed = apply_plan(plan, manifest, settings["shortcut_backend"], icon_converter=icon_converter,
+                                     shortcut_writer=shortcut_writer, staging=staging, inventory=inventory)
+    return plan, shortcuts_installed
+
+
+# Installs each of cli's targets with install_target, returning a (plan, shortcuts created) for each. Targets are done
+# side by side when icon conversion has worker processes of its own to do it in, as most of the rest is waiting on
+# windows.
+def install_targets(targets, templates, icon_index, icon_converter=None, jobs=1, force_rebuild=False, dry_run=False,
+                    stream=True, shortcut_writers=None, staging=None):
+    def install(target):
+        return install_target(target, templates, icon_index, icon_converter, force_rebuild, dry_run, stream,
+                              (shortcut_writers or {}).get(target["target_name"]), staging)
+
+    if len(targets) > 1 and jobs > 1 and not dry_run:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets)) as target_executor:
+            return list(target_executor.map(install, targets))
+    return [install(target) for target in targets]
+
+
+# Watch mode waits for a change, then until nothing more has changed for WATCH_DEBOUNCE seconds (a package install
+# touches a lot of files) before updating. Without inotify, modification times are checked every WATCH_POLL_INTERVAL.
+WATCH_DEBOUNCE = 2.0
+WATCH_POLL_INTERVAL = 5.0
+# inotify(7) events that mean something was written, created, removed or renamed
+INOTIFY_MASK = 0x00000002 | 0x00000004 | 0x00000008 | 0x00000040 | 0x00000080 | 0x00000100 | 0x00000200 | \
+    0x00000400 | 0x00000800
+# struct inotify_event, less the name which follows it
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+# Keeps the shortcuts of cli's targets up to date until interrupted. Each time the menu files, desktop entries or icon
+# themes change, the targets are planned again - which only regenerates, adds or removes the menu items affected. A
+# launch broker is brought up to date along with them.
+def watch_targets(targets, templates, themes, icon_index, icon_converter, jobs, shortcut_writers, staging=None,
+                  broker=None):
+    watcher = get_watcher()
+    # The directories each target's menu takes from, only worked out again when its menu files change
+    menu_paths = {}
+    changed = set()
+    try:
+        while True:
+            for target in targets:
+                menu_paths[target["target_name"]] = get_menu_watch_paths(target, menu_paths.get(target["target_name"]),
+                                                                         changed)
+            watcher.watch(get_watch_paths(menu_paths.values(), icon_index))
+            logger.info("Watching %d directories for changes (ctrl+c to stop)", len(watcher.paths))
+            changed = watcher.wait()
+            more_changed = watcher.wait(WATCH_DEBOUNCE)
+            while more_changed:
+                changed.update(more_changed)
+                more_changed = watcher.wait(WATCH_DEBOUNCE)
+
+            logger.info("Changes found - updating shortcuts")
+            icon_index = IconThemeIndex.load(themes, ICON_THEME_INDEX_FILE)
+            icon_converter.reset()
+            results = install_targets(targets, templates, icon_index, icon_converter, jobs,
+                                      shortcut_writers=shortcut_writers, staging=staging)
+            for target, (plan, shortcuts_installed) in zip(targets, results):
+                logger.info("Updated %s - %d shortcuts created, %d removed and %d unchanged", target["target_name"],
+                            shortcuts_installed, len(plan["diff"]["removed"]), len(plan["diff"]["unchanged"]))
+            if broker is not None:
+                broker.reload()
+    finally:
+        watcher.close()
+
+
+# Everything which feeds into the targets' shortcuts - the directories of each target's menu (see
+# get_menu_watch_paths) and the icon theme directories the icon index was built from
+def get_watch_paths(menu_paths, icon_index):
+    paths = set(icon_index.mtimes)
+    for target_paths in menu_paths:
+        paths.update(target_paths)
+    return sorted(path for path in paths if os.path.exists(path))
+
+
+# The directories holding a target's menu files, and every directory its menu takes desktop entries from. Parsing the
+# menu is slow, so the paths found last time are kept unless a menu file has changed since - of the rest, only the
+# directories which changed are looked through again, for any subdirectories added to them.
+def get_menu_watch_paths(target, previous=None, changed=()):
+    menu_directory = os.path.dirname(os.path.abspath(target["menu_file"]))
+    menu_directories = {menu_directory, os.path.join(menu_directory, "applications-merged")}
+    if previous is None or menu_directories.intersection(changed):
+        import xdg.Menu
+        with MENU_PARSE_LOCK:
+            menu = xdg.Menu.parse(target["menu_file"])
+        return sorted(menu_directories.union(get_menu_directories(menu)))
+    paths = set(previous)
+    for directory in paths.intersection(changed):
+        for subdirectory, _, _ in os.walk(directory):
+            paths.add(subdirectory)
+    return sorted(paths)
+
+
+def get_watcher():
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError) as e:
+        logger.info("Could not use inotify (%s) - checking for changes every %ss instead", e, WATCH_POLL_INTERVAL)
+        return PollingWatcher()
+
+
+# Waits for changes to a list of paths with inotify. Watches are not recursive, so each directory of interest is listed.
+class InotifyWatcher(object):
+
+    def __init__(self):
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1: %s" % os.strerror(ctypes.get_errno()))
+        self.paths = []
+        # The directory each watch descriptor is for
+        self.watches = {}
+
+    def watch(self, paths):
+        # Adding a watch again is harmless, and picks up directories which have been replaced since
+        import ctypes
+        self.paths = []
+        for path in paths:
+            watch_descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK)
+            if watch_descriptor < 0:
+                logger.debug("Could not watch %s: %s", path, os.strerror(ctypes.get_errno()))
+            else:
+                self.paths.append(path)
+                self.watches[watch_descriptor] = path
+
+    def wait(self, timeout=None):
+        # The set of directories which changed within timeout seconds (or at all, without one) - empty if none did
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        events = b""
+        try:
+            while True:
+                read = os.read(self.fd, 65536)
+                if not read:
+                    break
+                events += read
+        except BlockingIOError:
+            pass
+        changed = set()
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(events):
+            watch_descriptor, _, _, name_length = INOTIFY_EVENT.unpack_from(events, offset)
+            offset += INOTIFY_EVENT.size + name_length
+            if watch_descriptor < 0:
+                # The event queue overflowed, so anything could have changed
+                changed.update(self.paths)
+            elif watch_descriptor in self.watches:
+                changed.add(self.watches[watch_descriptor])
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Stands in for InotifyWatcher where inotify is not available, comparing modification times every so often. Directory
+# modification times change whenever something in them is added, removed or renamed, which is how packages update files.
+class PollingWatcher(object):
+
+    def __init__(self, interval=WATCH_POLL_INTERVAL):
+        self.interval = interval
+        self.paths = []
+        self.mtimes = {}
+
+    def watch(self, paths):
+        self.paths = list(paths)
+        self.mtimes = dict((path, _get_mtime(path)) for path in self.paths)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+            mtimes = dict((path, _get_mtime(path)) for path in self.paths)
+            if mtimes != self.mtimes:
+                changed = set(path for path in self.paths if mtimes[path] != self.mtimes[path])
+                self.mtimes = mtimes
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+
+    def close(self):
+        pass
+
+
+PLAN_VERSION = 1
+PLAN_STATUS_ACTIONS = {
+    "new": "create",
+    "changed": "update",
+    "unchanged": "keep",
+    "removed": "remove"
+}
+
+
+# Works out everything a run would do without doing any of it - nothing is written and no windows process is started,
+# so the result can be inspected, diffed or handed to apply_plan. Only menu items which are new or have changed since
+# the manifest was written are rendered in full. Entries are (menu path, desktop entry) pairs, as from
+# iter_desktop_entries. With stream set, the plan's items are planned one at a time as apply_plan asks for them, and its
+# removed items, diff and dispatch table are only filled in once they have all been used up. Given an inventory of the
+# target's directories, whether generated files are still there is looked up in that.
+def plan_menu_items(entries, manifest, settings, batch_template, shell_template, icon_index=None, stream=False,
+                    inventory=None):
+    install_directory = settings["install_directory"]
+    metadata_directory = settings["metadata_directory"]
+    shortcut_suffix = settings["shortcut_suffix"]
+    dispatch = settings.get("launcher_mode") == "dispatch"
+
+    # Anything which affects the generated output for every entry - if any of this changes, everything is regenerated
+    run_fingerprint = [
+        settings["distribution"],
+        settings["user"],
+        settings["wsl_executable"],
+        settings["rc_file"],
+        settings["launch_directory"],
+        settings["batch_encoding"],
+        settings["use_batch_newline_crlf"],
+        shortcut_suffix,
+        settings.get("launcher_mode"),
+        settings.get("environment_snapshot"),
+        settings["shortcut_backend"],
+        install_directory,
+        settings["preferred_theme"],
+        settings["alternative_theme"],
+        batch_template.environment.loader.get_source(batch_template.environment, batch_template.name)[0],
+        shell_template.environment.loader.get_source(shell_template.environment, shell_template.name)[0]
+    ]
+    # Only added when set, so the fingerprints of launchers which don't use the snapshot or broker are the same as ever
+    if settings.get("environment_snapshot"):
+        run_fingerprint.append(ENVIRONMENT_SNAPSHOT_VERSION)
+    if settings.get("broker_file"):
+        run_fingerprint.append(settings["broker_file"])
+
+    # Create shortcut launcher script (avoids terminal being displayed while launching) - the dispatcher flavour passes
+    # the menu item id through to the batch file as well
+    if dispatch:
+        silent_launcher_script_file = os.path.join(metadata_directory, "silent-dispatcher.vbs")
+        silent_launcher_content = \
+            'CreateObject("Wscript.Shell").Run """" & WScript.Arguments(0) & """ " & WScript.Arguments(1), 0, False'
+    else:
+        silent_launcher_script_file = os.path.join(metadata_directory, "silent-launcher.vbs")
+        silent_launcher_content = 'CreateObject("Wscript.Shell").Run """" & WScript.Arguments(0) & """", 0, False'
+    silent_launcher_script_file_win = get_windows_path_from_wsl_path(silent_launcher_script_file, query_wslpath=False)
+    renderer = LauncherRenderer(batch_template, shell_template, settings)
+    plan = {
+        "version": PLAN_VERSION,
+        "install_directory": install_directory,
+        "metadata_directory": metadata_directory,
+        "shortcut_suffix": shortcut_suffix,
+        "silent_launcher": {
+            "path": silent_launcher_script_file,
+            "windows_path": silent_launcher_script_file_win,
+            # If this gets more complicated, we could make this a resource, but at one line, this is fine
+            "content": silent_launcher_content
+        },
+        "launchers": [],
+        "obsolete_files": [],
+        "items": [],
+        "removed": [],
+        "diff": dict((status, []) for status in PLAN_STATUS_ACTIONS)
+    }
+
+    dispatch_files = [os.path.join(metadata_directory, name) for name in [
+        DISPATCH_TABLE_FILE_NAME,
+        DISPATCH_SHELL_FILE_NAME,
+        DISPATCH_BATCH_FILE_NAME,
+        "silent-dispatcher.vbs"
+    ]]
+    if dispatch:
+        table_file, shell_launcher_path, batch_launcher_path = dispatch_files[:3]
+        plan["launchers"] = renderer.render(shell_launcher_path, batch_launcher_path, table=table_file)
+        launch_target = get_windows_path_from_wsl_path(batch_launcher_path, query_wslpath=False)
+        plan["obsolete_files"] = [os.path.join(metadata_directory, "silent-launcher.vbs")]
+    else:
+        table_file = None
+        plan["obsolete_files"] = dispatch_files
+        launch_target = None
+
+    plan["items"] = _iter_planned_items(plan, entries, manifest, settings, renderer, icon_index, run_fingerprint,
+                                        silent_launcher_script_file_win, launch_target, table_file, inventory)
+    if not stream:
+        plan["items"] = list(plan["items"])
+    return plan
+
+
+def _iter_planned_items(plan, entries, manifest, settings, renderer, icon_index, run_fingerprint,
+                        silent_launcher_script_file_win, launch_target, table_file, inventory=None):
+    planned = set()
+    table_rows = []
+    for path, entry in entries:
+        started = time.perf_counter()
+        item = plan_menu_item(path, entry, manifest, settings, renderer, icon_index, run_fingerprint,
+                              silent_launcher_script_file_win, launch_target, inventory)
+        planned.add(path)
+        plan["diff"][item["status"]].append(path)
+        if table_file:
+            exec_cmd, exec_dir, run_in_terminal = get_launch_details(entry, settings)
+            # Tabs and line breaks would break up the table, and are just whitespace to the shell anyway
+            table_rows.append("\t".join([get_entry_id(path), "1" if run_in_terminal else "0"] + [
+                re.sub(r"[\t\r\n]+", " ", field) for field in [exec_dir, exec_cmd]]))
+        report.record_entry(path, time.perf_counter() - started)
+        yield item
+
+    # Only once every entry has been seen is it known which ones have gone away
+    for path in sorted(set(manifest) - planned):
+        plan["removed"].append({"path": path, "files": manifest[path]["files"]})
+        plan["diff"]["removed"].append(path)
+
+    if table_file:
+        plan["launchers"].insert(0, {
+            "path": table_file,
+            "content": "".join(row + "\n" for row in table_rows),
+            "encoding": "utf-8",
+            "newline": "\n",
+            "mode": None
+        })
+
+
+# Plans a single menu item for plan_menu_items. With a launch target (the dispatcher), the shortcut runs that with the
+# menu item's id rather than getting launchers of its own.
+def plan_menu_item(path, entry, manifest, settings, renderer, icon_index, run_fingerprint,
+                   silent_launcher_script_file_win, launch_target=None, inventory=None):
+    install_directory = settings["install_directory"]
+    metadata_directory = settings["metadata_directory"]
+    shortcut_suffix = settings["shortcut_suffix"]
+
+    # Carve the way for the shortcut
     if shortcut_suffix is None:
-        shortcut_suffix = " (%s)" % target_name
-    logger.info("shortcut_suffix = '%s'", shortcut_suffix)
+        shortcut_path = os.path.join(install_directory, "%s.lnk" % path)
+    else:
+        shortcut_path = os.path.join(install_directory, "%s%s.lnk" % (path, shortcut_suffix))
+
+    icon = entry.icon
+    icon = icon if icon else entry.name.lower()
+    icon_path = find_icon_path(
+        icon,
+        preferred_theme=settings["preferred_theme"],
+        alternative_theme=settings["alternative_theme"],
+        icon_index=icon_index
+    )
+    fingerprint = get_entry_fingerprint(entry, icon_path, run_fingerprint)
+    exists = inventory.exists if inventory is not None else os.path.exists
+    if path not in manifest:
+        status = "new"
+    elif manifest[path]["fingerprint"] == fingerprint and \
+            all(exists(generated_file) for generated_file in manifest[path]["files"]):
+        status = "unchanged"
+    else:
+        status = "changed"
+    item = {"path": path, "status": status, "fingerprint": fingerprint}
+    if status == "unchanged":
+        item["files"] = manifest[path]["files"]
+        return item
+
+    exec_cmd, exec_dir, run_in_terminal = get_launch_details(entry, settings)
+    metadata_prefix = os.path.join(metadata_directory, "%s" % path)
+    if launch_target is None:
+        shell_launcher_path = metadata_prefix + ".sh"
+        batch_launcher_path = metadata_prefix + ".bat"
+        item["launchers"] = renderer.render(shell_launcher_path, batch_launcher_path, command=exec_cmd,
+                                            exec_dir=exec_dir, run_in_terminal=run_in_terminal)
+        target = get_windows_path_from_wsl_path(batch_launcher_path, query_wslpath=False)
+        target_arguments = ""
+    else:
+        item["launchers"] = []
+        target = launch_target
+        target_arguments = get_entry_id(path)
 
-    # Add distro to directory names, since we want to support multiple concurrent distributions
-    install_directory = os.path.join(install_directory, target_name)
-    metadata_directory = os.path.join(metadata_directory, target_name)
+    # The icon is converted while applying - the shortcut only gets it if that conversion works out
+    if icon_path:
+        item["icon"] = {
+            "name": icon,
+            "source": icon_path,
+            "path": metadata_prefix + ".ico",
+            "windows_path": get_windows_path_from_wsl_path(metadata_prefix + ".ico", query_wslpath=False)
+        }
+    else:
+        item["icon"] = {"name": icon, "source": None, "path": None, "windows_path": None}
 
-    # OK print it debug information for these now
-    logger.info("install_directory = '%s'", install_directory)
-    logger.info("metadata_directory = '%s'", metadata_directory)
+    if run_in_terminal:
+        executable, arguments = target, target_arguments
+    else:
+        executable = "wscript"
+        arguments = ('"%s" "%s" %s' % (silent_launcher_script_file_win, target, target_arguments)).rstrip()
+    item["shortcut"] = {
+        "path": shortcut_path,
+        "target": executable,
+        "arguments": arguments,
+        "description": entry.comment,
+        "icon": item["icon"]["windows_path"]
+    }
+    item["files"] = [shortcut_path] + [launcher["path"] for launcher in item["launchers"]]
+    return item
+
+
+def get_launch_details(entry, settings):
+    exec_cmd = entry.exec
+    # https://specifications.freedesktop.org/desktop-entry-spec/desktop-entry-spec-latest.html#key-path
+    exec_dir = entry.path
+    # https://specifications.freedesktop.org/desktop-entry-spec/desktop-entry-spec-latest.html#key-terminal
+    run_in_terminal = entry.terminal
+
+    if not exec_dir:
+        exec_dir = settings["launch_directory"]
+
+    # These parts aren't relevant for menu launcher so prune out from the command
+    for substr in FREEDESKTOP_FIELD_CODES:
+        exec_cmd = exec_cmd.replace(substr, "")
+    return exec_cmd, exec_dir, run_in_terminal
+
+
+# Renders the launcher scripts of a target from its batch and shell templates. The template context every launcher
+# shares is worked out once, so each launcher only has its own fields to add on top.
+class LauncherRenderer(object):
+
+    def __init__(self, batch_template, shell_template, settings):
+        self.batch_template = batch_template
+        self.shell_template = shell_template
+        self.settings = settings
+        self.context = {
+            "distribution": settings["distribution"],
+            "user": settings["user"],
+            "wsl": settings["wsl_executable"],
+            "rcfile": settings["rc_file"],
+            "load_environment": get_environment_loader(settings)
+        }
 
-    if not menu_file:
-        logger.error(
-            "Could not find an appropriate .menu file in %s - perhaps yum/apt install gnome-menus or another desktop?",
-            DEFAULT_MENU_LOCATION
+    def render(self, shell_launcher_path, batch_launcher_path, **fields):
+        context = dict(self.context, launch_script=shell_launcher_path, **fields)
+        return get_launcher_files(
+            shell_launcher_path, self.shell_template.render(context),
+            batch_launcher_path, self.batch_template.render(context),
+            self.settings
         )
-        sys.exit(os.EX_OSFILE)
 
-    if not confirm_yes:
-        logger.info("For full list of options available, call script again with --help")
-        logger.info("This script will write to the above locations if it can, but giving final chance to chicken out.")
-        confirm("Press <enter> to continue or ctrl+c to abort.")
 
-    # OK we're ready to go - ensure we can create / have write access to the installation directory
+def get_launcher_files(shell_launcher_path, shell_content, batch_launcher_path, batch_content, settings):
+    return [
+        {
+            "path": shell_launcher_path,
+            "content": shell_content,
+            "encoding": None,
+            "newline": None,
+            "mode": 509
+        },
+        {
+            "path": batch_launcher_path,
+            "content": batch_content,
+            "encoding": settings["batch_encoding"],
+            "newline": "\r\n" if settings["use_batch_newline_crlf"] else None,
+            "mode": None
+        }
+    ]
+
+
+def get_environment_loader(settings):
+    if settings.get("broker_file"):
+        return BROKER_LOADER % {
+            "broker_file": settings["broker_file"],
+            "timeout": BROKER_TIMEOUT,
+            "rcfile": settings["rc_file"]
+        }
+    if not settings.get("environment_snapshot"):
+        return ""
+    return ENVIRONMENT_SNAPSHOT_LOADER % {
+        "boot_id_file": BOOT_ID_FILE,
+        "snapshot": settings["environment_snapshot"],
+        "rcfile": settings["rc_file"],
+        "function": ENVIRONMENT_SNAPSHOT_FUNCTION,
+        "version": ENVIRONMENT_SNAPSHOT_VERSION
+    }
+
+
+def update_environment_snapshot(snapshot_file, rc_file):
+    # Same format as the launchers write (see ENVIRONMENT_SNAPSHOT_LOADER) - boot id, hash of the rc file, version of
+    # the snapshot function, environment
+    with open(BOOT_ID_FILE) as boot_id_handle:
+        boot_id = boot_id_handle.read().strip()
+    with open(rc_file, "rb") as rc_handle:
+        rc_hash = hashlib.sha256(rc_handle.read()).hexdigest()
+    header = ["# boot %s\n" % boot_id, "# rc %s\n" % rc_hash, "# snapshot %d\n" % ENVIRONMENT_SNAPSHOT_VERSION]
+    try:
+        with open(snapshot_file) as snapshot_handle:
+            if [snapshot_handle.readline() for line in header] == header:
+                # Make sure the launchers agree it is fresh, even if the rc file has only been touched
+                if os.stat(rc_file).st_mtime > os.stat(snapshot_file).st_mtime:
+                    os.utime(snapshot_file)
+                logger.debug("Environment snapshot %s is up to date", snapshot_file)
+                return False
+    except OSError:
+        pass
+
+    logger.info("Taking a snapshot of the environment set up by %s", rc_file)
+    os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+    environment_file = "%s.%d" % (snapshot_file, os.getpid())
     try:
-        # Create directory and fear not if it already exists
-        os.makedirs(install_directory, exist_ok=True)
-        os.makedirs(metadata_directory, exist_ok=True)
-    except PermissionError:
-        logger.error("No permissions to create directories %s or %s - aborting", install_directory, metadata_directory)
-        sys.exit(os.EX_NOPERM)
-
-    # Make metadata a hidden system file to hide it from indexer (cleaner search results for powertoys etc)
-    set_hidden_from_indexer(metadata_directory)
-
-    # Check we have absolute ownership of this directory - if not, chicken out
-    if not is_directory_writable(install_directory):
-        logger.error("Could not confirm write access to all contents of %s - aborting", install_directory)
-        sys.exit(os.EX_NOPERM)
-
-    # Find all desktop menu items, indexed by menu path
-    menu = xdg.Menu.parse(menu_file.name)
-    entries = get_desktop_entries(menu)
-
-    # Create shortcut launcher script (avoids terminal being displayed while launching)
-    silent_launcher_script_file = os.path.join(metadata_directory, "silent-launcher.vbs")
-    if not os.path.exists(silent_launcher_script_file):
-        try:
-            with open(silent_launcher_script_file, "w") as lsf:
-                # If this gets more complicated, we could make this a resource, but at one line, this is fine
-                lsf.write('CreateObject("Wscript.Shell").Run """" & WScript.Arguments(0) & """", 0, False')
-        except Exception:
-            logger.error("Could not create %s", silent_launcher_script_file)
-            sys.exit(os.EX_IOERR)
-
-    # Build windows path for the launcher script
-    silent_launcher_script_file_win = get_windows_path_from_wsl_path(silent_launcher_script_file)
-
-    # Load in the template which is used to generate the launcher script
-    if not jinja_template_batch:
-        # Default load from package
-        env = Environment(loader=PackageLoader('wsl_windows_toolbar', package_path=''))
-        batch_template = env.get_template("wsl-windows-toolbar-template.bat.j2")
-        shell_template = env.get_template("wsl-windows-toolbar-template.sh.j2")
+        command_executor.check_output(["bash", "-c", ENVIRONMENT_SNAPSHOT_FUNCTION + '\ntake_environment_snapshot "$@"',
+                                       "bash", rc_file, environment_file])
+        with open(environment_file) as environment_handle:
+            environment_script = environment_handle.read()
+        with open(snapshot_file + ".tmp", "w") as snapshot_handle:
+            snapshot_handle.writelines(header)
+            snapshot_handle.write(environment_script)
+        os.replace(snapshot_file + ".tmp", snapshot_file)
+    except (OSError, subprocess.SubprocessError) as e:
+        # Launchers will try again for themselves the first time they run
+        logger.warning("Could not take a snapshot of the environment set up by %s: %s", rc_file, e)
+        return False
+    finally:
+        try:
+            os.remove(environment_file)
+        except OSError:
+            pass
+    return True
+
+
+# The environment launchers get once an interactive shell has sourced the rc file, less what belongs to that shell
+def get_rc_environment(rc_file):
+    with tempfile.TemporaryDirectory(prefix="wsl-windows-toolbar-") as directory:
+        environment_file = os.path.join(directory, "environment")
+        command_executor.check_output(["bash", "-i", "-c", 'source "$1" > /dev/null 2>&1; env -0 > "$2"', "bash",
+                                       rc_file, environment_file])
+        with open(environment_file, "rb") as environment_handle:
+            variables = environment_handle.read().decode("utf-8", errors="surrogateescape").split("\0")
+    environment = dict(variable.split("=", 1) for variable in variables if "=" in variable)
+    for name in ["PWD", "OLDPWD", "SHLVL", "TERM", "_"]:
+        environment.pop(name, None)
+    return environment
+
+
+# Starts menu items for launchers on their behalf, so a click costs a connection to an already running process rather
+# than an interactive shell sourcing the rc file. Each target added gets a token and a table of its menu items, by id
+# (for the dispatcher) and by launcher script, which is loaded again whenever a launcher asks for one it doesn't know.
+# The environment from the rc file is loaded up front, and again whenever the rc file changes. Menu items which run in a
+# terminal need the console their launcher has, so are turned down and left to the launcher.
+class LaunchBroker(object):
+
+    def __init__(self):
+        self.targets = {}
+        self.server = None
+        self.thread = None
+
+    def add(self, settings):
+        token = base64.urlsafe_b64encode(os.urandom(24)).decode("ascii")
+        self.targets[token] = {
+            "settings": settings,
+            "entries": self._get_launch_table(settings),
+            "environment": None,
+            "rc_mtime": None,
+            "lock": threading.Lock()
+        }
+        try:
+            self._get_environment(self.targets[token])
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning("Could not load the environment set up by %s, will try again on the first launch: %s",
+                           settings["rc_file"], e)
+
+    def reload(self):
+        for target in self.targets.values():
+            entries = self._get_launch_table(target["settings"])
+            with target["lock"]:
+                target["entries"] = entries
+
+    def start(self):
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _LaunchBrokerHandler)
+        self.server.daemon_threads = True
+        self.server.broker = self
+        for token, target in self.targets.items():
+            broker_file = target["settings"]["broker_file"]
+            os.makedirs(os.path.dirname(broker_file), exist_ok=True)
+            broker_handle = os.fdopen(os.open(broker_file + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w")
+            with broker_handle:
+                broker_handle.write("%d %s\n" % (self.server.server_address[1], token))
+            os.replace(broker_file + ".tmp", broker_file)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logger.info("Launch broker listening on 127.0.0.1:%d for %s", self.server.server_address[1],
+                    ", ".join(target["settings"]["target_name"] for target in self.targets.values()))
+
+    def wait(self):
+        self.thread.join()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        for target in self.targets.values():
+            try:
+                os.remove(target["settings"]["broker_file"])
+            except OSError:
+                pass
+
+    def launch(self, token, launcher, argument):
+        # Gives back why the menu item couldn't be launched, or None once it has been
+        target = None
+        for target_token, candidate in self.targets.items():
+            if hmac.compare_digest(target_token.encode("utf-8"), token.encode("utf-8")):
+                target = candidate
+        if target is None:
+            logger.warning("Launch broker turned down %s, which sent an unknown token", launcher)
+            return "unknown token"
+
+        with target["lock"]:
+            details = target["entries"].get(argument) or target["entries"].get(launcher)
+            if details is None:
+                # Perhaps installed since the broker started
+                target["entries"] = self._get_launch_table(target["settings"])
+                details = target["entries"].get(argument) or target["entries"].get(launcher)
+            if details is None:
+                logger.warning("Launch broker has no menu item for %s %s", launcher, argument)
+                return "unknown menu item"
+            exec_cmd, exec_dir, run_in_terminal = details
+            if run_in_terminal:
+                logger.debug("Leaving %s to its launcher as it runs in a terminal", exec_cmd)
+                return "menu item runs in a terminal"
+            environment = self._get_environment(target)
+
+        # Just as the launchers do - the command is left running in the background once the shell has gone
+        subprocess.Popen(
+            ["bash", "-c", 'cd "$1"; eval "$2" > /dev/null 2>&1 & disown', "bash", exec_dir, exec_cmd],
+            env=environment,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
+        ).wait()
+        logger.info("Launched %s", exec_cmd)
+        return None
+
+    @staticmethod
+    def _get_environment(target):
+        rc_file = target["settings"]["rc_file"]
+        rc_mtime = _get_mtime(rc_file)
+        if target["environment"] is None or rc_mtime != target["rc_mtime"]:
+            logger.info("Loading the environment set up by %s for the launch broker", rc_file)
+            target["environment"] = get_rc_environment(rc_file)
+            target["rc_mtime"] = rc_mtime
+        return target["environment"]
+
+    @staticmethod
+    def _get_launch_table(settings):
+        entries = {}
+        for path, entry in load_menu_entries(settings["menu_file"]):
+            details = get_launch_details(entry, settings)
+            entries[get_entry_id(path)] = details
+            entries[os.path.join(settings["metadata_directory"], "%s.sh" % path)] = details
+        return entries
+
+
+# Speaks the launch broker's protocol - a line of token, launcher script and launcher argument separated by tabs, which
+# is answered with OK or ERR and the reason
+class _LaunchBrokerHandler(socketserver.StreamRequestHandler):
+    timeout = BROKER_TIMEOUT
+
+    def handle(self):
+        request = []
+        try:
+            request = self.rfile.readline(65536).decode("utf-8", errors="replace").rstrip("\r\n").split("\t")
+            if len(request) == 3:
+                error = self.server.broker.launch(*request)
+            else:
+                error = "bad request"
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning("Launch broker could not launch %s: %s", " ".join(request[1:]).strip(), e)
+            error = "%s: %s" % (type(e).__name__, e)
+        try:
+            self.wfile.write(("ERR %s\n" % error if error else "OK\n").encode("utf-8"))
+        except OSError:
+            pass
+
+
+def get_entry_id(path):
+    # Short, stable and safe to pass on a command line, whatever the menu path looks like
+    return hashlib.sha1(path.encode("utf-8")).hexdigest()[:12]
+
+
+# Carries out a plan from plan_menu_items, updating the manifest to match. Returns how many shortcuts were created.
+# Icons are converted by icon_converter when given (so it can be shared between several plans), or else by one of its
+# own with jobs worker processes. Likewise a shortcut writer which is passed in is only flushed, not closed. Given a
+# staging directory, new files are written there and copied across to windows in one go once they are all done. Given
+# an inventory of the target's directories, generated shortcuts in there which no menu item accounts for (say from a
+# lost manifest) are removed as well, along with their launchers and icons.
+def apply_plan(plan, manifest, shortcut_backend="powershell", jobs=1, icon_cache=None, icon_converter=None,
+               shortcut_writer=None, staging=None, inventory=None):
+    install_directory = plan["install_directory"]
+    metadata_directory = plan["metadata_directory"]
+    if staging is not None:
+        staging.add(install_directory)
+        staging.add(metadata_directory)
+    stage = staging.path if staging is not None else os.path.abspath
+
+    # Make metadata a hidden system file to hide it from indexer (cleaner search results for powertoys etc) - this and
+    # all other metadata files are marked in bulk at the end of the run rather than one attrib.exe call per file
+    hidden_batch = HiddenAttributeBatch(metadata_directory)
+    set_hidden_from_indexer(metadata_directory, hidden_batch)
+
+    with report.phase("prepare"):
+        remove_generated_files(plan["obsolete_files"], [install_directory, metadata_directory])
+
+        silent_launcher = plan["silent_launcher"]
+        if not os.path.exists(silent_launcher["path"]):
+            try:
+                os.makedirs(os.path.dirname(stage(silent_launcher["path"])), exist_ok=True)
+                with open(stage(silent_launcher["path"]), "w") as lsf:
+                    lsf.write(silent_launcher["content"])
+            except Exception:
+                logger.error("Could not create %s", silent_launcher["path"])
+                sys.exit(os.EX_IOERR)
+
+    with report.phase("generate"):
+        # Each menu item which needs (re)generating has its icon converted in the background as soon as it is planned,
+        # and is finished off in menu order once that is done - a few are let queue up so conversions overlap with
+        # planning the items behind them. Shortcut files are all funnelled through one shortcut writer session.
+        own_icon_converter = icon_converter is None
+        if own_icon_converter:
+            icon_converter = IconConverter(jobs, icon_cache)
+        launcher_writer = LauncherWriter(hidden_batch, staging)
+        own_shortcut_writer = shortcut_writer is None
+        if own_shortcut_writer:
+            shortcut_writer = SHORTCUT_WRITERS[shortcut_backend]()
+        generated = {}
+        apply_item = functools.partial(_apply_planned_item, manifest=manifest,
+                                       roots=[install_directory, metadata_directory], launcher_writer=launcher_writer,
+                                       shortcut_writer=shortcut_writer, hidden_batch=hidden_batch, generated=generated,
+                                       stage=stage)
+        queued = collections.deque()
+        deferred = []
+        # Files which some menu item accounts for, or which are removed along with what they belonged to
+        accounted_for = set(plan["obsolete_files"])
+        for item in itertools.chain(report.iterate("plan", plan["items"]), [None]):
+            if item is not None:
+                accounted_for.update(item["files"])
+                accounted_for.update(manifest[item["path"]]["files"] if item["path"] in manifest else [])
+                if item["status"] != "unchanged" and item["icon"]["path"]:
+                    accounted_for.add(item["icon"]["path"])
+            if item is not None and item["status"] == "unchanged":
+                continue
+            if item is not None:
+                icon_future, icon_shared = None, False
+                if item["icon"]["source"]:
+                    icon_future, icon_shared = icon_converter.submit(item["icon"]["source"],
+                                                                     os.path.splitext(stage(item["icon"]["path"]))[0])
+                queued.append((item, icon_future, icon_shared))
+            # Everything left is applied once the plan runs out (the None on the end)
+            while queued and (item is None or len(queued) > icon_converter.jobs * 2 or queued[0][1] is None or
+                              queued[0][1].done()):
+                if queued[0][1] is not None and icon_converter.is_deferred(queued[0][1]):
+                    # Its icon is waiting on imagemagick, which is run for all such icons together at the end
+                    deferred.append(queued.popleft())
+                else:
+                    apply_item(*queued.popleft())
+        if deferred:
+            icon_futures = icon_converter.decode_deferred([icon_future for item, icon_future, shared in deferred])
+            for (item, _, icon_shared), icon_future in zip(deferred, icon_futures):
+                apply_item(item, icon_future, icon_shared)
+        if own_icon_converter:
+            icon_converter.close()
+
+        # Menu items whose launchers could not be written are as good as failed
+        failed = set()
+        for path, launcher_path, error in launcher_writer.close():
+            logger.error("Failed to write launcher %s: %s", launcher_path, error)
+            failed.add(path)
+
+    with report.phase("tidy"):
+        # Removed menu items and the launchers shared between all menu items (like the dispatch table) are only known
+        # once every menu item has been planned. Shared launchers are only rewritten when they change.
+        for removed in plan["removed"]:
+            logger.info("Removing menu item for: %s", removed["path"])
+            remove_generated_files(removed["files"], [install_directory, metadata_directory])
+            manifest.pop(removed["path"], None)
+            accounted_for.update(removed["files"])
+        for launcher in plan["launchers"]:
+            write_launcher(launcher, hidden_batch, only_if_changed=True, staging=staging)
+            accounted_for.add(launcher["path"])
+
+        if inventory is not None:
+            accounted_for.add(plan["silent_launcher"]["path"])
+            stale_files = inventory.get_stale_files(install_directory, metadata_directory, plan["shortcut_suffix"],
+                                                    accounted_for)
+            if stale_files:
+                logger.info("Removing %d files left behind by menu items which are no longer installed",
+                            len(stale_files))
+                remove_generated_files(stale_files, [install_directory, metadata_directory], threads=INVENTORY_THREADS)
+
+    with report.phase("shortcuts"):
+        # Wait for the shortcut writer to catch up and report on how it got on
+        shortcuts_installed = 0
+        shortcut_results = shortcut_writer.close() if own_shortcut_writer else shortcut_writer.flush()
+
+        # Everything staged is now written, so can go across to windows - if any of it doesn't make it, every menu
+        # item generated this time is retried next time
+        sync_failures = staging.sync([install_directory, metadata_directory]) if staging is not None else []
+        for directory, error in sync_failures:
+            logger.error("Failed to copy staged files to %s: %s", directory, error)
+
+        for shortcut_path, error in sorted(shortcut_results.items()):
+            path, shortcut_path, record = generated[shortcut_path]
+            if error or path in failed or sync_failures:
+                # Forget about failed entries so they will be retried next time around
+                if error:
+                    logger.error("Failed to create shortcut %s: %s", shortcut_path, error)
+                manifest.pop(path, None)
+            else:
+                logger.debug("Created %s", shortcut_path)
+                manifest[path] = record
+                shortcuts_installed += 1
+        save_manifest(metadata_directory, manifest)
+
+    with report.phase("attributes"):
+        for path, error in hidden_batch.apply():
+            logger.warning("Failed to set hidden system attributes on %s: %s", path, error)
+    return shortcuts_installed
+
+
+# Writes out a single planned menu item for apply_plan, once its icon conversion (if any) has been set going
+def _apply_planned_item(item, icon_future, icon_shared, manifest, roots, launcher_writer, shortcut_writer, hidden_batch,
+                        generated, stage=os.path.abspath):
+    started = time.perf_counter()
+    path = item["path"]
+    shortcut = item["shortcut"]
+    logger.info("Creating menu item for: %s", path)
+    os.makedirs(os.path.dirname(stage(shortcut["path"])), exist_ok=True)
+    logger.debug("Will create shortcut file: %s", shortcut["path"])
+
+    # Anything generated last time which this version of the menu item no longer needs (say after switching launcher
+    # mode) is tidied away
+    if path in manifest:
+        remove_generated_files(sorted(set(manifest[path]["files"]) - set(item["files"]) - set([item["icon"]["path"]])),
+                               roots)
+
+    # Icon conversion output is replayed here so the log stays grouped by menu item however the conversions were
+    # scheduled - time spent waiting on the conversion is swapped for the time it actually took
+    generated_files = list(item["files"])
+    ico_file_winpath = None
+    if icon_future is None:
+        logger.warning("Failed to find icon file for %s", item["icon"]["name"])
     else:
-        # Optionally load from custom filesystem location
-        env = Environment(loader=FileSystemLoader(os.path.dirname(os.path.abspath(jinja_template_batch.name))))
-        batch_template = env.get_template(os.path.basename(jinja_template_batch.name))
-        shell_template = env.get_template(os.path.basename(jinja_template_shell.name))
-
-    # Create shortcut files
-    shortcuts_installed = 0
-    for path, entry in entries.items():
-        logger.info("Creating menu item for: %s", path)
-        exec_cmd = entry.getExec()
-        # https://specifications.freedesktop.org/desktop-entry-spec/desktop-entry-spec-latest.html#key-path
-        exec_dir = entry.getPath()
-        # https://specifications.freedesktop.org/desktop-entry-spec/desktop-entry-spec-latest.html#key-terminal
-        run_in_terminal = entry.getTerminal()
-
-        if not exec_dir:
-            exec_dir = launch_directory
-
-        # These parts aren't relevant for menu launcher so prune out from the command
-        for substr in FREEDESKTOP_FIELD_CODES:
-            exec_cmd = exec_cmd.replace(substr, "")
-
-        # Carve the way for the shortcut
-        if shortcut_suffix is None:
-            shortcut_path = os.path.join(install_directory, "%s.lnk" % path)
+        waiting = time.perf_counter()
+        ico_file, icon_log, icon_calls, icon_seconds = icon_future.result()
+        if icon_shared:
+            # Converted for another menu item (or target) with the same icon source, so just take a copy of that
+            started += time.perf_counter() - waiting
+            if ico_file:
+                try:
+                    os.makedirs(os.path.dirname(stage(item["icon"]["path"])), exist_ok=True)
+                    _link_or_copy(ico_file, stage(item["icon"]["path"]))
+                except OSError as e:
+                    logger.warning("Could not copy icon %s to %s (%s)", ico_file, item["icon"]["path"], e)
+                    ico_file = None
         else:
-            shortcut_path = os.path.join(install_directory, "%s%s.lnk" % (path, shortcut_suffix))
-
-        os.makedirs(os.path.dirname(shortcut_path), exist_ok=True)
-        logger.debug("Will create shortcut file: %s", shortcut_path)
-
-        # Normalize the icon to a windows path so shortcut can find it
-        icon = entry.getIcon()
-        metadata_prefix = os.path.join(metadata_directory, "%s" % path)
-        ico_file_winpath = create_windows_icon(
-            icon if icon else entry.getName().lower(),
-            metadata_prefix,
-            preferred_theme=preferred_theme,
-            alternative_theme=alternative_theme
-        )
+            started += time.perf_counter() - waiting - icon_seconds
+            report.merge_calls(icon_calls)
+            for level, message in icon_log:
+                logger.log(level, "%s", message)
+        if ico_file:
+            set_hidden_from_indexer(item["icon"]["path"], hidden_batch)
+            ico_file_winpath = shortcut["icon"]
+            generated_files.append(item["icon"]["path"])
+
+    # Create the little shell and batch file launchers for the executable
+    for launcher in item["launchers"]:
+        launcher_writer.add(launcher, path)
+
+    windows_lnk = create_shortcut(
+        stage(shortcut["path"]),
+        shortcut["target"],
+        shortcut["arguments"],
+        comment=shortcut["description"],
+        icon_file=ico_file_winpath,
+        writer=shortcut_writer
+    )
+    logger.debug("Requested %s", windows_lnk)
+    generated[stage(shortcut["path"])] = (path, shortcut["path"],
+                                          {"fingerprint": item["fingerprint"], "files": generated_files})
+    report.record_entry(path, time.perf_counter() - started)
 
-        shell_launcher_path = os.path.join(metadata_directory, "%s.sh" % path)
-        template_dict = {
-            "distribution": distribution,
-            "user": user,
-            "command": exec_cmd,
-            "wsl": wsl_executable,
-            "rcfile": rc_file.name,
-            "launch_script": shell_launcher_path,
-            "exec_dir": exec_dir,
-            "run_in_terminal": run_in_terminal
-        }
 
-        # Create a little shell launcher for the executable
-        with open(shell_launcher_path, mode="w") as script_handle:
-            script_handle.write(shell_template.render(template_dict))
-        # Make executable
-        os.chmod(shell_launcher_path, 509)
-        set_hidden_from_indexer(shell_launcher_path)
-
-        # Create a little batch file launcher for the executable
-        batch_launcher_path = os.path.join(metadata_directory, "%s.bat" % path)
-        batch_newline = "\r\n" if use_batch_newline_crlf else None
-        with open(batch_launcher_path, mode="w", encoding=batch_encoding, newline=batch_newline) as script_handle:
-            script_handle.write(batch_template.render(template_dict))
-        batch_launcher_path_win = get_windows_path_from_wsl_path(batch_launcher_path)
-
-        if run_in_terminal:
-            windows_lnk = create_shortcut(
-                shortcut_path,
-                batch_launcher_path_win,
-                comment=entry.getComment(),
-                icon_file=ico_file_winpath
-            )
+def write_launcher(launcher, hidden_batch=None, only_if_changed=False, staging=None):
+    if only_if_changed:
+        try:
+            with open(launcher["path"], encoding=launcher["encoding"]) as script_handle:
+                if script_handle.read() == launcher["content"]:
+                    return False
+        except (OSError, ValueError):
+            pass
+    path = staging.path(launcher["path"]) if staging is not None else launcher["path"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode="w", encoding=launcher["encoding"], newline=launcher["newline"]) as script_handle:
+        script_handle.write(launcher["content"])
+    if launcher["mode"] is not None:
+        if staging is not None:
+            staging.set_mode(launcher["path"], launcher["mode"])
         else:
-            windows_lnk = create_shortcut(
-                shortcut_path,
-                "wscript",
-                '"%s" "%s"' % (silent_launcher_script_file_win, batch_launcher_path_win),
-                comment=entry.getComment(),
-                icon_file=ico_file_winpath
-            )
-        set_hidden_from_indexer(batch_launcher_path)
-        logger.debug("Created %s", windows_lnk)
-        shortcuts_installed += 1
-
-    logger.info("Finished creating %d shortcuts!", shortcuts_installed)
-    logger.info("Before raising an issue, make sure you have Xming / X410 etc set up in your .bashrc.")
-    logger.info(
-        "Right click on the toolbar, then select Toolbars -> New toolbar... and select the directory '%s'.",
-        install_directory
-    )
+            os.chmod(path, launcher["mode"])
+    set_hidden_from_indexer(launcher["path"], hidden_batch)
+    return True
+
+
+# Writes launcher scripts on a few threads for apply_plan - on the windows side every file operation is a round trip to
+# the host, so making them one after another soon adds up. Launchers are written as they are added, and closing waits
+# for them all, giving back (owner, path, error) for any which could not be written.
+class LauncherWriter(object):
+    THREADS = 8
+
+    def __init__(self, hidden_batch=None, staging=None):
+        self.hidden_batch = hidden_batch
+        self.staging = staging
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.THREADS)
+        self.pending = []
+
+    def add(self, launcher, owner=None):
+        future = self.executor.submit(write_launcher, launcher, self.hidden_batch, staging=self.staging)
+        self.pending.append((owner, launcher["path"], future))
+
+    def close(self):
+        failures = []
+        for owner, path, future in self.pending:
+            try:
+                future.result()
+            except (OSError, ValueError) as e:
+                failures.append((owner, path, e))
+        self.pending = []
+        self.executor.shutdown()
+        return failures
 
 
-def get_windows_path_from_wsl_path(path):
+def get_windows_path_from_wsl_path(path, query_wslpath=True):
+    # Translations are cached by directory since most paths we convert share a handful of parent directories
     return "%s\\%s" % (
-        subprocess.check_output(["wslpath", "-w", "-a", os.path.dirname(path)]).rstrip().decode(),
+        get_windows_directory_from_wsl_directory(os.path.dirname(os.path.abspath(path)), query_wslpath).rstrip("\\"),
         os.path.basename(path)
     )
 
 
-def create_shortcut(link_file, executable, arguments="", comment="", icon_file=""):
-    windows_lnk = get_windows_path_from_wsl_path(link_file)
-    powershell_cmd = "powershell.exe -ExecutionPolicy Bypass -NoLogo -NonInteractive -NoProfile "
-    powershell_cmd += "-Command '"
-    powershell_cmd += '$ws = New-Object -ComObject WScript.Shell; '
-    powershell_cmd += '$s = $ws.CreateShortcut("%s");' % windows_lnk
-    powershell_cmd += '$s.TargetPath = "%s";' % executable
-    powershell_cmd += '$s.Arguments = "%s";' % arguments.replace('"', '`"')
-    powershell_cmd += '$s.Description = "%s";' % comment
-    powershell_cmd += '$s.WorkingDirectory = "%USERPROFILE%";'
-    powershell_cmd += '$s.IconLocation = "%s";' % icon_file
-    powershell_cmd += '$s.Save()'
-    powershell_cmd += "'"
-    logger.debug("Powershell command to create shortcut: %s", powershell_cmd)
-    os.popen(powershell_cmd).read().rstrip()
+POWERSHELL_EXECUTABLE = "powershell.exe"
+POWERSHELL_ARGUMENTS = ["-ExecutionPolicy", "Bypass", "-NoLogo", "-NonInteractive", "-NoProfile", "-Command", "-"]
+SHORTCUT_RESULT_MARKER = "WSL-WINDOWS-TOOLBAR"
+
+
+# Creates windows shortcuts through a single long-lived powershell session. Each shortcut is streamed to the session's
+# stdin as a one line command as soon as it is requested and reports back success or failure on stdout, so the cost of
+# starting powershell is paid once per run rather than once per shortcut. A session which stops making progress for
+# longer than the timeout is killed, and whatever it had not got round to is retried in a fresh session.
+class ShortcutWriter(object):
+    def __init__(self, powershell=POWERSHELL_EXECUTABLE, timeout=None, retries=None):
+        self.powershell = powershell
+        self.timeout = command_executor.timeout if timeout is None else timeout
+        self.retries = command_executor.retries if retries is None else retries
+        self.process = None
+        self.reader = None
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.results = {}
+        self.flushed = -1
+        self.progress = 0
+        self.finished = False
+        self.next_id = 0
+
+    def create(self, link_file, executable, arguments="", comment="", icon_file=""):
+        windows_lnk = get_windows_path_from_wsl_path(link_file)
+        command_id = self.next_id
+        self.next_id += 1
+
+        properties = [
+            ("TargetPath", executable),
+            ("Arguments", arguments),
+            ("Description", comment),
+            ("WorkingDirectory", "%USERPROFILE%")
+        ]
+        if icon_file:
+            properties.append(("IconLocation", icon_file))
+
+        # Values are passed base64 encoded to avoid any quoting / console code page issues for unusual names
+        command = "try { $s = $ws.CreateShortcut((D '%s')); " % _powershell_encode(windows_lnk)
+        for name, value in properties:
+            command += "$s.%s = (D '%s'); " % (name, _powershell_encode(value))
+        command += "$s.Save(); Write-Output '%s OK %d' } " % (SHORTCUT_RESULT_MARKER, command_id)
+        command += "catch { Write-Output ('%s ERR %d ' + ($_.Exception.Message -replace '\\s+', ' ')) }" % (
+            SHORTCUT_RESULT_MARKER, command_id)
+        logger.debug("Powershell command to create shortcut %s: %s", windows_lnk, command)
+        with self.condition:
+            self.results.pop(link_file, None)
+        self._submit(command_id, link_file, command, 0)
+        return windows_lnk
+
+    def flush(self):
+        # Wait for everything sent so far to be processed, returning the results of all shortcuts since last flush
+        while self.process is not None:
+            flush_id = self.next_id
+            self.next_id += 1
+            self._send("Write-Output '%s FLUSH %d'" % (SHORTCUT_RESULT_MARKER, flush_id))
+            if self._wait_for(flush_id):
+                break
+            self._restart()
+        return self._collect()
+
+    def close(self):
+        results = self.flush()
+        if self.process is not None:
+            self._stop()
+        return results
+
+    def _start(self):
+        logger.debug("Starting powershell session for shortcut creation")
+        self.started = time.perf_counter()
+        self.process = subprocess.Popen(
+            [self.powershell] + POWERSHELL_ARGUMENTS,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            encoding="utf-8",
+            errors="replace"
+        )
+        self.finished = False
+        self.reader = threading.Thread(target=self._read_results, daemon=True)
+        self.reader.start()
+        self._send("$ws = New-Object -ComObject WScript.Shell")
+        self._send("function D($b) { [Text.Encoding]::UTF8.GetString([Convert]::FromBase64String($b)) }")
+
+    def _stop(self, kill=False):
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=self.timeout or None)
+        except subprocess.TimeoutExpired:
+            logger.warning("Powershell session did not exit within %ss - killing it", self.timeout)
+            self.process.kill()
+            self.process.wait()
+        self.reader.join()
+        self.process = None
+        # The session is one long running call as far as the run report is concerned
+        report.record_call(os.path.basename(self.powershell), time.perf_counter() - self.started)
+
+    def _restart(self):
+        # Throw away a stuck or dead session, and send anything it did not finish to a new one
+        self._stop(kill=True)
+        with self.condition:
+            pending, self.pending = self.pending, {}
+        for command_id, (link_file, command, attempts) in sorted(pending.items()):
+            if attempts < self.retries:
+                logger.debug("Retrying shortcut %s in a new powershell session", link_file)
+                self._submit(command_id, link_file, command, attempts + 1)
+            else:
+                self.results[link_file] = "powershell session stopped responding before creating shortcut"
+
+    def _submit(self, command_id, link_file, command, attempts):
+        with self.condition:
+            self.pending[command_id] = (link_file, command, attempts)
+        self._send(command)
+
+    def _send(self, command):
+        if self.process is None:
+            self._start()
+        try:
+            self.process.stdin.write(command + "\n")
+            self.process.stdin.flush()
+        except OSError:
+            # Session has died - anything still pending will be retried or reported as failed when flushed
+            logger.debug("Could not write to powershell session: %s", command)
+
+    def _wait_for(self, flush_id):
+        # True once everything up to flush_id is done, False if the session died or went quiet with work outstanding
+        with self.condition:
+            while self.flushed < flush_id and not self.finished:
+                progress = self.progress
+                self.condition.wait(self.timeout or None)
+                if self.progress == progress and self.flushed < flush_id and not self.finished:
+                    logger.warning("Powershell session made no progress for %ss", self.timeout)
+                    return False
+            return not (self.finished and self.pending)
+
+    def _read_results(self):
+        for line in self.process.stdout:
+            fields = line.rstrip().split(" ", 3)
+            if len(fields) < 3 or fields[0] != SHORTCUT_RESULT_MARKER or not fields[2].isdigit():
+                if line.strip():
+                    logger.debug("powershell: %s", line.rstrip())
+                continue
+            status, command_id = fields[1], int(fields[2])
+            with self.condition:
+                self.progress += 1
+                if status == "FLUSH":
+                    self.flushed = max(self.flushed, command_id)
+                elif command_id in self.pending:
+                    link_file = self.pending.pop(command_id)[0]
+                    self.results[link_file] = None if status == "OK" else (fields[3] if len(fields) > 3 else status)
+                self.condition.notify_all()
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def _collect(self):
+        with self.condition:
+            for link_file, command, attempts in self.pending.values():
+                self.results[link_file] = "powershell session ended before creating shortcut"
+            self.pending.clear()
+            results, self.results = self.results, {}
+        return results
+
+
+def _powershell_encode(value):
+    return base64.b64encode((value or "").encode("utf-8")).decode("ascii")
+
+
+# Writes MS-SHLLINK (.lnk) files directly from python, avoiding any windows process round trip at all
+class NativeShortcutWriter(object):
+
+    def __init__(self):
+        self.results = {}
+
+    def create(self, link_file, executable, arguments="", comment="", icon_file=""):
+        windows_lnk = get_windows_path_from_wsl_path(link_file)
+        try:
+            with open(link_file, "wb") as link_handle:
+                link_handle.write(build_shell_link(
+                    executable,
+                    arguments=arguments,
+                    description=comment,
+                    working_directory="%USERPROFILE%",
+                    icon_location=icon_file
+                ))
+            self.results[link_file] = None
+        except Exception as e:
+            logger.debug("Could not write shortcut %s", link_file, exc_info=True)
+            self.results[link_file] = "%s: %s" % (type(e).__name__, e)
+        return windows_lnk
+
+    def flush(self):
+        results, self.results = self.results, {}
+        return results
+
+    def close(self):
+        return self.flush()
+
+
+SHORTCUT_WRITERS = {
+    "powershell": ShortcutWriter,
+    "native": NativeShortcutWriter
+}
+
+# Constants from the [MS-SHLLINK] specification
+SHELL_LINK_CLSID = bytes.fromhex("0114020000000000c000000000000046")
+SHELL_LINK_HAS_LINK_INFO = 0x00000002
+SHELL_LINK_HAS_NAME = 0x00000004
+SHELL_LINK_HAS_WORKING_DIR = 0x00000010
+SHELL_LINK_HAS_ARGUMENTS = 0x00000020
+SHELL_LINK_HAS_ICON_LOCATION = 0x00000040
+SHELL_LINK_IS_UNICODE = 0x00000080
+SHELL_LINK_HAS_EXP_STRING = 0x00000200
+SHELL_LINK_SW_SHOWNORMAL = 0x00000001
+SHELL_LINK_DRIVE_FIXED = 0x00000003
+SHELL_LINK_VOLUME_ID_AND_LOCAL_BASE_PATH = 0x00000001
+SHELL_LINK_COMMON_NETWORK_RELATIVE_LINK_AND_PATH_SUFFIX = 0x00000002
+SHELL_LINK_ENVIRONMENT_VARIABLE_DATA_BLOCK = 0xA0000001
+SHELL_LINK_SYSTEM_DIRECTORY = "%SystemRoot%\\System32"
+
+
+def build_shell_link(target, arguments="", description="", working_directory="", icon_location=""):
+    link_flags = SHELL_LINK_IS_UNICODE
+    link_info = b""
+    extra_data = b""
+
+    if "\\" not in target and "/" not in target:
+        # Bare executable names (e.g. wscript) are resolved by the shell the same way WScript.Shell would
+        if not os.path.splitext(target)[1]:
+            target += ".exe"
+        link_flags |= SHELL_LINK_HAS_EXP_STRING
+        extra_data += _build_shell_link_environment_block("%s\\%s" % (SHELL_LINK_SYSTEM_DIRECTORY, target))
+    else:
+        link_flags |= SHELL_LINK_HAS_LINK_INFO
+        link_info = _build_shell_link_info(target)
+
+    string_data = b""
+    for flag, value in [(SHELL_LINK_HAS_NAME, description),
+                        (SHELL_LINK_HAS_WORKING_DIR, working_directory),
+                        (SHELL_LINK_HAS_ARGUMENTS, arguments),
+                        (SHELL_LINK_HAS_ICON_LOCATION, icon_location)]:
+        if value:
+            link_flags |= flag
+            encoded = value.encode("utf-16-le")
+            string_data += struct.pack("<H", len(encoded) // 2) + encoded
+
+    header = struct.pack(
+        "<I16sIIQQQIiIHHII",
+        0x4C,                       # HeaderSize
+        SHELL_LINK_CLSID,           # LinkCLSID
+        link_flags,                 # LinkFlags
+        0,                          # FileAttributes
+        0, 0, 0,                    # CreationTime, AccessTime, WriteTime
+        0,                          # FileSize
+        0,                          # IconIndex
+        SHELL_LINK_SW_SHOWNORMAL,   # ShowCommand
+        0,                          # HotKey
+        0, 0, 0                     # Reserved1-3
+    )
+    # ExtraData is always closed off with a TerminalBlock
+    return header + link_info + string_data + extra_data + struct.pack("<I", 0)
+
+
+def _build_shell_link_info(target):
+    header_size = 0x24
+    if target.startswith("\\\\"):
+        # UNC path (e.g. \\wsl.localhost\distro\...) - split into \\server\share and the remaining suffix
+        parts = target.split("\\")
+        net_name, suffix = "\\".join(parts[:4]), "\\".join(parts[4:])
+        net_name_ansi, net_name_unicode = _shell_link_strings(net_name)
+        network_link_header_size = 0x1C
+        network_link = struct.pack(
+            "<IIIIIII",
+            network_link_header_size + len(net_name_ansi) + len(net_name_unicode),
+            0,                                                      # CommonNetworkRelativeLinkFlags
+            network_link_header_size,                               # NetNameOffset
+            0,                                                      # DeviceNameOffset
+            0,                                                      # NetworkProviderType
+            network_link_header_size + len(net_name_ansi),          # NetNameOffsetUnicode
+            0                                                       # DeviceNameOffsetUnicode
+        ) + net_name_ansi + net_name_unicode
+        flags = SHELL_LINK_COMMON_NETWORK_RELATIVE_LINK_AND_PATH_SUFFIX
+        volume_id = b""
+        local_base_path_ansi, local_base_path_unicode = b"", b""
+    else:
+        suffix = ""
+        network_link = b""
+        flags = SHELL_LINK_VOLUME_ID_AND_LOCAL_BASE_PATH
+        # VolumeID with an empty volume label - windows only uses this to help track down moved targets
+        volume_id = struct.pack("<IIII", 0x11, SHELL_LINK_DRIVE_FIXED, 0, 0x10) + b"\0"
+        local_base_path_ansi, local_base_path_unicode = _shell_link_strings(target)
+    suffix_ansi, suffix_unicode = _shell_link_strings(suffix)
+
+    # Lay the body out in order, recording the offset of each structure relative to the start of the LinkInfo
+    offsets = []
+    body = b""
+    for part in [volume_id, local_base_path_ansi, network_link, suffix_ansi, local_base_path_unicode, suffix_unicode]:
+        offsets.append(header_size + len(body) if part else 0)
+        body += part
+
+    return struct.pack(
+        "<IIIIIIIII",
+        header_size + len(body),    # LinkInfoSize
+        header_size,                # LinkInfoHeaderSize
+        flags,                      # LinkInfoFlags
+        *offsets                    # VolumeID, LocalBasePath, CommonNetworkRelativeLink, CommonPathSuffix (+unicode)
+    ) + body
+
+
+def _build_shell_link_environment_block(target):
+    target_ansi = target.encode("cp1252", errors="replace")[:259]
+    target_unicode = target.encode("utf-16-le")[:518]
+    return struct.pack(
+        "<II260s520s",
+        0x314,
+        SHELL_LINK_ENVIRONMENT_VARIABLE_DATA_BLOCK,
+        target_ansi,
+        target_unicode
+    )
+
+
+def _shell_link_strings(value):
+    # Null terminated system code page and unicode variants of a LinkInfo string
+    return value.encode("cp1252", errors="replace") + b"\0", value.encode("utf-16-le") + b"\0\0"
+
+
+def create_shortcut(link_file, executable, arguments="", comment="", icon_file="", writer=None):
+    if writer is not None:
+        return writer.create(link_file, executable, arguments, comment, icon_file)
+
+    # One-off shortcut - spin up a dedicated session and report back any failure
+    writer = ShortcutWriter()
+    windows_lnk = writer.create(link_file, executable, arguments, comment, icon_file)
+    error = writer.close().get(link_file)
+    if error:
+        logger.error("Failed to create shortcut %s: %s", windows_lnk, error)
     return windows_lnk
 
 
-def set_hidden_from_indexer(path):
+def set_hidden_from_indexer(path, batch=None):
+    if batch is not None:
+        batch.add(path)
+        return
     try:
-        subprocess.check_output(["attrib.exe", "+I", "+S", "+H", get_windows_path_from_wsl_path(path)])
+        command_executor.check_output(["attrib.exe", "+I", "+S", "+H", get_windows_path_from_wsl_path(path)])
         logger.debug("Set hidden system attributes in metadata directory %s", path)
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
         logger.exception("Failed to set hidden system attributes in metadata directory %s", path)
 
 
+# Collects paths to hide from the windows indexer during a run, then marks them all in one go. Anything under the root
+# directory is covered by a single recursive attrib.exe call on the whole tree.
+class HiddenAttributeBatch(object):
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.paths = []
+
+    def add(self, path):
+        self.paths.append(os.path.abspath(path))
+
+    def apply(self):
+        if not self.paths:
+            return []
+
+        windows_root = get_windows_path_from_wsl_path(self.root)
+        commands = []
+        if self.root in self.paths:
+            commands.append(["attrib.exe", "+I", "+S", "+H", windows_root])
+        if any(path.startswith(self.root + os.sep) for path in self.paths):
+            commands.append(["attrib.exe", "+I", "+S", "+H", windows_root + "\\*", "/S", "/D"])
+        for path in self.paths:
+            if path != self.root and not path.startswith(self.root + os.sep):
+                commands.append(["attrib.exe", "+I", "+S", "+H", get_windows_path_from_wsl_path(path)])
+
+        # attrib.exe is silent on success, and otherwise prints a line per failure like "Access denied - C:\..."
+        failures = []
+        for command in commands:
+            logger.debug("Setting hidden system attributes: %s", " ".join(command))
+        for result in command_executor.run(commands):
+            if result.error is not None:
+                failures.append((result.command[4], str(result.error)))
+                continue
+            output = (result.stdout + result.stderr).decode(errors="replace")
+            for line in output.splitlines():
+                if line.strip():
+                    error, separator, path = line.strip().rpartition(" - ")
+                    failures.append((path, error) if separator else (result.command[4], line.strip()))
+        self.paths = []
+        return failures
+
+
+# Stands in for windows directories while they are written to. Every file operation on the windows side is a round trip
+# to the host, so files are made on the linux filesystem instead and sync then copies the lot across in one robocopy.exe
+# call per directory. Only what has been written since the directory was added is staged, so only that is copied.
+class StagingDirectory(object):
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.directory = None
+        self.roots = {}
+        self.modes = {}
+        self.lock = threading.Lock()
+
+    def add(self, root):
+        # Starts staging root afresh, giving back the directory which stands in for it
+        root = os.path.abspath(root)
+        with self.lock:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="wsl-windows-toolbar-staging-", dir=self.parent)
+            if root not in self.roots:
+                self.roots[root] = os.path.join(self.directory, str(len(self.roots)))
+            staged_root = self.roots[root]
+        shutil.rmtree(staged_root, ignore_errors=True)
+        os.makedirs(staged_root)
+        return staged_root
+
+    def path(self, path):
+        # Where to write path instead - anything outside the staged directories is written in place
+        path = os.path.abspath(path)
+        for root, staged_root in list(self.roots.items()):
+            if path == root or path.startswith(root + os.sep):
+                return staged_root + path[len(root):]
+        return path
+
+    def set_mode(self, path, mode):
+        # Permissions don't survive the trip through robocopy.exe, so are set on the windows side once copied
+        self.modes[os.path.abspath(path)] = mode
+
+    def sync(self, roots):
+        # Copies what has been staged for roots across to windows, giving back (root, error) for any which failed
+        roots = [os.path.abspath(root) for root in roots]
+        copied_roots, commands = [], []
+        for root in roots:
+            staged_root = self.roots[root]
+            if any(os.scandir(staged_root)):
+                copied_roots.append(root)
+                commands.append([ROBOCOPY_EXECUTABLE, get_windows_path_from_wsl_path(staged_root),
+                                 get_windows_path_from_wsl_path(root)] + ROBOCOPY_ARGUMENTS)
+                logger.debug("Copying staged files across: %s", " ".join(commands[-1]))
+
+        failures = []
+        for root, result in zip(copied_roots, command_executor.run(commands)):
+            if result.error is not None:
+                failures.append((root, str(result.error)))
+            elif result.returncode >= ROBOCOPY_FAILED:
+                output = (result.stdout + result.stderr).decode(errors="replace")
+                failures.append((root, " ".join(line.strip() for line in output.splitlines() if line.strip()) or
+                                 "%s exited with %d" % (ROBOCOPY_EXECUTABLE, result.returncode)))
+
+        failed_roots = [root for root, error in failures]
+        for path, mode in list(self.modes.items()):
+            if any(path.startswith(root + os.sep) for root in roots):
+                del self.modes[path]
+                if any(path.startswith(root + os.sep) for root in failed_roots):
+                    continue
+                try:
+                    os.chmod(path, mode)
+                except OSError as e:
+                    failures.append((path, str(e)))
+        return failures
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+        self.roots = {}
+        self.modes = {}
+
+
 def create_windows_icon(icon,
                         metadata_prefix,
                         preferred_theme=None,
-                        alternative_theme=None):
-    logger.debug("Creating icon files for: %s, %s [%s]", icon, metadata_prefix, preferred_theme)
-    os.makedirs(os.path.dirname(metadata_prefix), exist_ok=True)
+                        alternative_theme=None,
+                        hidden_batch=None):
+    icon_path = find_icon_path(icon, preferred_theme=preferred_theme, alternative_theme=alternative_theme)
+    if icon_path:
+        return convert_windows_icon(icon_path, metadata_prefix, hidden_batch=hidden_batch)
+
+    logger.warning("Failed to find icon file for %s", icon)
+    return None
+
+
+def find_icon_path(icon, preferred_theme=None, alternative_theme=None, icon_index=None):
+    if icon_index is not None:
+        return icon_index.find_icon_path(icon, preferred_theme=preferred_theme, alternative_theme=alternative_theme)
+
+    import xdg.IconTheme
+
     icon_path = xdg.IconTheme.getIconPath(icon, theme=preferred_theme)
     if not icon_path:
         for icon_c in [icon, icon.lower()]:
@@ -476,64 +2680,747 @@ def create_windows_icon(icon,
                     logger.debug("Checking with theme: %s", theme)
                     icon_path = xdg.IconTheme.getIconPath(icon_c, theme=theme)
                     if icon_path:
-                        icon = icon_c
                         logger.debug("Found icon path: %s for theme %s", icon_c, theme)
-                        break
-
-    if icon_path:
-        filename, extension = os.path.splitext(icon_path)
-        png_file = metadata_prefix + ".png"
-        mime_type = magic.from_file(icon_path, mime=True)
-
-        try:
-            # Some icons appear to have the wrong extension on windows, so check mime type here too
-            if extension == ".png" or mime_type == "image/png":
-                shutil.copyfile(icon_path, png_file)
-            elif has_cairosvg and (extension == ".svg" or mime_type == "image/svg"):
-                # Attempt with svg2png if available
-                with open(icon_path, 'rb') as f:
-                    svg2png(file_obj=f, write_to=png_file)
-            else:
-                # Attempt with PIL if available
-                img = Image.open(icon_path)
-                img.save(png_file)
-        except Exception as e:
-            if has_imagemagick:
-                logger.debug("Could not convert using python methods - falling back on imagemagick")
-                try:
-                    subprocess.check_output(["convert", icon_path, png_file], timeout=10)
-                    logger.debug("Converted %s to %s using imagemagick", icon_path, png_file)
-                except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
-                    logger.exception("Failed to create or find png file for %s - icon will not be available (%s: %s)",
-                                     icon_path, type(e).__name__, e)
-                    png_file = None
-
-        if png_file:
+                        return icon_path
+    return icon_path
+
+
+ICON_EXTENSIONS = ["png", "svg", "xpm"]
+# Size (in pixels) icons are looked up at, as per the pyxdg default
+ICON_LOOKUP_SIZE = 48
+
+
+# Index of every icon in the configured themes, the themes they inherit from and the loose icon directories, built
+# with a single walk of the theme directories. This follows the same lookup rules as xdg.IconTheme.getIconPath but makes
+# each lookup a dictionary access. The index is saved to disk and reused until any directory it was built from changes.
+class IconThemeIndex(object):
+
+    def __init__(self, themes, icon_directories=None):
+        self.requested_themes = [theme for theme in themes if theme]
+        if icon_directories is None:
+            import xdg.IconTheme
+            icon_directories = xdg.IconTheme.icondirs
+        self.icon_directories = list(icon_directories)
+        self.themes = {}
+        self.loose_icons = {}
+        self.mtimes = {}
+
+    @classmethod
+    def load(cls, themes, index_file, rebuild=False):
+        index = cls(themes)
+        if not rebuild:
             try:
-                # Should have a png file available here now - convert to icon
-                img = Image.open(png_file)
-                ico_file = metadata_prefix + ".ico"
-                img.save(ico_file)
-                logger.debug("Successfully created %s", ico_file)
-                # Mark both icon and png as system
-                set_hidden_from_indexer(png_file)
-                set_hidden_from_indexer(ico_file)
-                return get_windows_path_from_wsl_path(ico_file)
-            except Exception:
-                logger.warning("Could not generate icon for %s", png_file)
-    else:
-        logger.warning("Failed to find icon file for %s", icon)
+                with open(index_file) as index_handle:
+                    saved = json.load(index_handle)
+                if saved["version"] == ICON_THEME_INDEX_VERSION and \
+                        saved["requested_themes"] == index.requested_themes and \
+                        saved["icon_directories"] == index.icon_directories and \
+                        all(_get_mtime(path) == mtime for path, mtime in saved["mtimes"].items()):
+                    index.themes, index.loose_icons = saved["themes"], saved["loose_icons"]
+                    index.mtimes = saved["mtimes"]
+                    logger.debug("Loaded icon theme index from %s", index_file)
+                    return index
+                logger.debug("Icon theme index %s is out of date", index_file)
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError, TypeError):
+                logger.debug("Could not read icon theme index %s", index_file, exc_info=True)
+
+        index.build()
+        try:
+            index.save(index_file)
+        except OSError:
+            logger.warning("Could not save icon theme index to %s", index_file)
+        return index
+
+    def save(self, index_file):
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        with open(index_file + ".tmp", "w") as index_handle:
+            json.dump({
+                "version": ICON_THEME_INDEX_VERSION,
+                "requested_themes": self.requested_themes,
+                "icon_directories": self.icon_directories,
+                "mtimes": self.mtimes,
+                "themes": self.themes,
+                "loose_icons": self.loose_icons
+            }, index_handle)
+        os.replace(index_file + ".tmp", index_file)
+
+    def build(self):
+        logger.debug("Building icon theme index for %s", self.requested_themes)
+        for theme in self.requested_themes + ["hicolor"]:
+            self._index_theme(theme)
+
+        # Icons sitting directly in the icon directories (e.g. /usr/share/pixmaps), earlier directories taking priority
+        for directory in self.icon_directories:
+            for name, path in _list_icon_files(directory, self.mtimes):
+                self.loose_icons.setdefault(name, path)
+
+    def _index_theme(self, theme):
+        if theme in self.themes:
+            return
+        # Mark as seen up front in case of inheritance loops
+        self.themes[theme] = None
+
+        theme_file = None
+        for directory in self.icon_directories:
+            self.mtimes[os.path.join(directory, theme)] = _get_mtime(os.path.join(directory, theme))
+            for candidate in ["index.theme", "index.desktop"]:
+                if theme_file is None and os.path.isfile(os.path.join(directory, theme, candidate)):
+                    theme_file = os.path.join(directory, theme, candidate)
+                    self.mtimes[theme_file] = _get_mtime(theme_file)
+        if theme_file is None:
+            logger.debug("Could not find icon theme %s", theme)
+            return
+
+        import xdg.IconTheme
+        parsed_theme = xdg.IconTheme.IconTheme()
+        parsed_theme.parse(theme_file)
+        directories = {}
+        icons = {}
+        for subdir in parsed_theme.getDirectories():
+            directories[subdir] = {
+                "type": parsed_theme.getType(subdir),
+                "size": parsed_theme.getSize(subdir),
+                "min_size": parsed_theme.getMinSize(subdir),
+                "max_size": parsed_theme.getMaxSize(subdir),
+                "threshold": parsed_theme.getThreshold(subdir)
+            }
+            for directory in self.icon_directories:
+                for name, path in _list_icon_files(os.path.join(directory, theme, subdir), self.mtimes):
+                    icons.setdefault(name, []).append([subdir, path])
+
+        self.themes[theme] = {
+            "inherits": parsed_theme.getInherits(),
+            "directories": directories,
+            "icons": icons
+        }
+        for inherited_theme in parsed_theme.getInherits():
+            self._index_theme(inherited_theme)
+
+    def lookup(self, icon, theme, size=ICON_LOOKUP_SIZE):
+        for theme_name in self._get_theme_chain(theme, set()):
+            icon_path = self._lookup_in_theme(self.themes[theme_name], icon, size)
+            if icon_path:
+                return icon_path
+        if icon in self.loose_icons:
+            return self.loose_icons[icon]
+        # "hicolor" is the fallback for everything
+        if theme != "hicolor":
+            return self.lookup(icon, "hicolor", size)
+        return None
+
+    def find_icon_path(self, icon, preferred_theme=None, alternative_theme=None):
+        if os.path.isabs(icon):
+            return icon
+        if os.path.splitext(icon)[1][1:] in ICON_EXTENSIONS:
+            icon = os.path.splitext(icon)[0]
+
+        icon_path = self.lookup(icon, preferred_theme)
+        if not icon_path:
+            for icon_c in [icon, icon.lower()]:
+                for theme in alternative_theme or []:
+                    icon_path = self.lookup(icon_c, theme)
+                    if icon_path:
+                        logger.debug("Found icon path: %s for theme %s", icon_c, theme)
+                        return icon_path
+        return icon_path
+
+    def _get_theme_chain(self, theme, seen):
+        if self.themes.get(theme) and theme not in seen:
+            seen.add(theme)
+            yield theme
+            for inherited_theme in self.themes[theme]["inherits"]:
+                for theme_name in self._get_theme_chain(inherited_theme, seen):
+                    yield theme_name
+
+    @staticmethod
+    def _lookup_in_theme(theme, icon, size):
+        # Exact size matches win outright, otherwise take the closest size (candidates are in theme directory order)
+        closest = None
+        for subdir, icon_path in theme["icons"].get(icon, []):
+            directory = theme["directories"][subdir]
+            if _icon_directory_matches_size(directory, size):
+                return icon_path
+            distance = _icon_directory_size_distance(directory, size)
+            if closest is None or distance < closest[0]:
+                closest = (distance, icon_path)
+        return closest[1] if closest else None
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
 
+def _list_icon_files(directory, mtimes):
+    # Icon files in a directory as (name, path), ordered so preferred extensions come first for any given name
+    mtimes[directory] = _get_mtime(directory)
+    try:
+        file_names = os.listdir(directory)
+    except OSError:
+        return []
+    icon_files = []
+    for file_name in file_names:
+        name, extension = os.path.splitext(file_name)
+        if extension[1:] in ICON_EXTENSIONS:
+            icon_files.append((ICON_EXTENSIONS.index(extension[1:]), name, os.path.join(directory, file_name)))
+    return [(name, path) for rank, name, path in sorted(icon_files)]
+
+
+# Directory size matching as per the freedesktop icon theme specification
+def _icon_directory_matches_size(directory, size):
+    if directory["type"] == "Fixed":
+        return directory["size"] == size
+    elif directory["type"] == "Scalable":
+        return directory["min_size"] <= size <= directory["max_size"]
+    return directory["size"] - directory["threshold"] <= size <= directory["size"] + directory["threshold"]
+
+
+def _icon_directory_size_distance(directory, size):
+    if directory["type"] == "Fixed":
+        return abs(directory["size"] - size)
+    elif directory["type"] == "Scalable":
+        lower, upper = directory["min_size"], directory["max_size"]
+    else:
+        lower, upper = directory["size"] - directory["threshold"], directory["size"] + directory["threshold"]
+    if size < lower:
+        return lower - size
+    elif size > upper:
+        return size - upper
+    return 0
+
+
+def convert_windows_icon(icon_path, metadata_prefix, hidden_batch=None):
+    ico_file = convert_windows_icon_files(icon_path, metadata_prefix)
+    if ico_file:
+        set_hidden_from_indexer(ico_file, hidden_batch)
+        return get_windows_path_from_wsl_path(ico_file)
     return None
 
 
-def get_desktop_entries(menu, entries=None):
-    if entries is None:
-        entries = {}
+def convert_windows_icon_files(icon_path, metadata_prefix, icon_cache=None, decoded=None):
+    # Pure file conversion with no windows interaction, so this is safe to run in worker processes. Given decoded (the
+    # pngs imagemagick has made from sources, see IconConverter), sources which need imagemagick and aren't in there
+    # raise IconDecodingDeferred rather than running it for this icon alone.
+    logger.debug("Creating icon files for: %s, %s", icon_path, metadata_prefix)
+    os.makedirs(os.path.dirname(metadata_prefix), exist_ok=True)
+    ico_file = metadata_prefix + ".ico"
+    sources = find_icon_size_variants(icon_path)
+
+    cache_key = None
+    if icon_cache is not None:
+        cache_key = icon_cache.get_key(sources)
+        if icon_cache.fetch(cache_key, metadata_prefix):
+            logger.debug("Found converted icon for %s in cache", icon_path)
+            return ico_file
+
+    # Never write through existing files here since they may be hard links into the cache (and .png files are only
+    # left over from older versions which went via an intermediate png)
+    for extension in [".ico", ".png"]:
+        try:
+            os.remove(metadata_prefix + extension)
+        except FileNotFoundError:
+            pass
+
+    try:
+        images = render_icon_images(sources, ICON_SIZES, decoded)
+        write_ico(images, ico_file)
+    except IconDecodingDeferred:
+        # All of the icon's sources go to imagemagick, so there is no coming back for another one later
+        raise IconDecodingDeferred(*sources)
+    except Exception as e:
+        logger.warning("Could not generate icon for %s (%s: %s)", icon_path, type(e).__name__, e)
+        return None
+
+    logger.debug("Successfully created %s", ico_file)
+    if cache_key:
+        icon_cache.store(cache_key, metadata_prefix)
+    return ico_file
+
+
+def find_icon_size_variants(icon_path):
+    # Icon themes keep the same icon drawn at several sizes in sibling directories (e.g. .../16x16/apps/foo.png,
+    # .../128x128/apps/foo.png and .../scalable/apps/foo.svg). Each ico size comes from the smallest of those drawings
+    # at least as big as it (vectors being big enough for anything), or failing that the biggest - only the drawings
+    # some ico size comes from are given, smallest first.
+    parts = icon_path.split(os.sep)
+    index = next((index for index, part in enumerate(parts) if ICON_SIZE_DIRECTORY_PATTERN.match(part)), None)
+    if index is None:
+        # Not a sized theme directory (e.g. pixmaps) - everything comes from the one source
+        return [icon_path]
+    theme_directory = os.sep.join(parts[:index])
+    name, extension = os.path.splitext(os.sep.join(parts[index + 1:]))
+    variants = {_get_icon_source_size(icon_path): icon_path}
+    try:
+        size_directories = sorted(os.listdir(theme_directory))
+    except OSError:
+        size_directories = []
+    for size_directory in size_directories:
+        if not ICON_SIZE_DIRECTORY_PATTERN.match(size_directory):
+            continue
+        for variant_extension in [extension] + ICON_VARIANT_EXTENSIONS:
+            variant = os.path.join(theme_directory, size_directory, name + variant_extension)
+            if os.path.isfile(variant):
+                variants.setdefault(_get_icon_source_size(variant), variant)
+                break
+
+    sizes = sorted(variants)
+    used = set(next((source_size for source_size in sizes if source_size >= size), sizes[-1]) for size in ICON_SIZES)
+    return [variants[size] for size in sorted(used)]
+
+
+def render_icon_images(sources, sizes, decoded=None):
+    # Source paths are ordered by their nominal size, so take the first which is big enough or failing that the biggest
+    images = []
+    source_images = {}
+    source_formats = dict((source, sniff_icon_format(source)) for source in sources)
+    for size in sizes:
+        source = sources[-1]
+        for candidate in sources:
+            if _get_icon_source_size(candidate) >= size:
+                source = candidate
+                break
+        # Raster sources are loaded once and scaled, vectors are rendered afresh at each size
+        if source not in source_images or source_formats[source] == "svg":
+            source_images[source] = _load_icon_image(source, size, source_formats[source], decoded)
+        images.append(_fit_icon_image(source_images[source], size))
+    return images
+
+
+def _get_icon_source_size(path):
+    # The size an icon theme drew a source at - vectors from its scalable directory suit any size, and sources from
+    # outside of a theme count as the smallest
+    match = re.search(r"%s(\d+)x\1%s" % (re.escape(os.sep), re.escape(os.sep)), path)
+    if match:
+        return int(match.group(1))
+    return float("inf") if "%sscalable%s" % (os.sep, os.sep) in path else 0
+
+
+def sniff_icon_format(path):
+    # Some icons appear to have the wrong extension, so the file's header has the final say where it is recognised
+    with open(path, "rb") as icon_handle:
+        header = icon_handle.read(ICON_SNIFF_BYTES)
+    stripped = header.lstrip(b"\xef\xbb\xbf \t\r\n")
+    for signature, icon_format in ICON_FORMAT_SIGNATURES:
+        if stripped.startswith(signature):
+            return icon_format
+    return ICON_FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def _load_icon_image(path, size, icon_format, decoded=None):
+    from PIL import Image
+    try:
+        if icon_format == "svg":
+            if not environment.has_cairosvg:
+                raise ValueError("cairosvg is required to render svg icons")
+            # Render vectors directly at the requested size rather than scaling a single rendering
+            from cairosvg import svg2png
+            with open(path, "rb") as svg_handle, report.call("svg2png"):
+                png_data = svg2png(file_obj=svg_handle, output_width=size, output_height=size)
+            return Image.open(io.BytesIO(png_data)).convert("RGBA")
+        if icon_format == "xpm":
+            with open(path, "rb") as xpm_handle:
+                return decode_xpm(xpm_handle.read())
+        image = Image.open(path)
+        image.load()
+        return image.convert("RGBA")
+    except Exception as e:
+        if not environment.has_imagemagick:
+            raise
+        logger.debug("Could not convert %s using python methods (%s: %s) - falling back on imagemagick",
+                     path, type(e).__name__, e)
+        if decoded is None:
+            png_data = command_executor.check_output(IMAGEMAGICK_COMMAND + [path, "png:-"])
+        elif path not in decoded:
+            raise IconDecodingDeferred(path)
+        elif decoded[path] is None:
+            raise
+        else:
+            with open(decoded[path], "rb") as png_handle:
+                png_data = png_handle.read()
+        logger.debug("Converted %s using imagemagick", path)
+        return Image.open(io.BytesIO(png_data)).convert("RGBA")
+
+
+# Raised by icon conversions which are waiting on imagemagick to decode the given sources
+class IconDecodingDeferred(Exception):
+
+    @property
+    def sources(self):
+        return list(self.args)
+
+
+def decode_icons_with_imagemagick(sources, directory):
+    # One imagemagick run for every source python couldn't read, rather than one per icon. Gives the png made from
+    # each source under directory, or None for any imagemagick couldn't read either.
+    input_directory = os.path.join(directory, "in")
+    output_directory = os.path.join(directory, "out")
+    os.makedirs(input_directory, exist_ok=True)
+    os.makedirs(output_directory, exist_ok=True)
+    inputs = []
+    for index, source in enumerate(sources):
+        # Linked under names of our own, as sources from different directories can share a file name
+        input_file = os.path.join(input_directory, "%d%s" % (index, os.path.splitext(source)[1]))
+        os.symlink(os.path.abspath(source), input_file)
+        inputs.append(input_file)
+    try:
+        command_executor.check_output(IMAGEMAGICK_BATCH_COMMAND + ["-path", output_directory] + inputs)
+    except Exception as e:
+        # Still worth looking for the ones which did convert
+        logger.debug("imagemagick could not convert every icon (%s: %s)", type(e).__name__, e)
+
+    decoded = {}
+    for index, source in enumerate(sources):
+        decoded[source] = None
+        # Formats holding several images come out as one png per image, of which the first will do
+        for name in ["%d.png", "%d-0.png"]:
+            if os.path.exists(os.path.join(output_directory, name % index)):
+                decoded[source] = os.path.join(output_directory, name % index)
+                break
+    return decoded
+
+
+# Decodes XPM images (both the usual C source form and the older XPM2) which is what a lot of older applications still
+# ship their icons as. Pillow only manages a subset of these, with at most 256 colours and one character per pixel.
+def decode_xpm(data):
+    from PIL import Image
+    text = data.decode("latin-1")
+    if text.lstrip().startswith("! XPM2"):
+        lines = text.lstrip().splitlines()[1:]
+    else:
+        lines = [re.sub(r"\\(.)", r"\1", match.group(1)) for match in XPM_TOKEN_PATTERN.finditer(text)
+                 if match.group(1) is not None]
+    try:
+        width, height, colour_count, chars_per_pixel = [int(value) for value in lines[0].split()[:4]]
+    except (IndexError, ValueError):
+        raise ValueError("Not an XPM image")
+
+    colours = {}
+    for line in lines[1:1 + colour_count]:
+        colours[line[:chars_per_pixel]] = _parse_xpm_colour(line[chars_per_pixel:])
+    rows = lines[1 + colour_count:1 + colour_count + height]
+    if len(colours) < colour_count or len(rows) < height:
+        raise ValueError("XPM image is truncated")
+
+    pixels = bytearray()
+    row_length = width * chars_per_pixel
+    for row in rows:
+        if len(row) < row_length:
+            raise ValueError("XPM image is truncated")
+        try:
+            pixels += b"".join(colours[row[index:index + chars_per_pixel]]
+                               for index in range(0, row_length, chars_per_pixel))
+        except KeyError as e:
+            raise ValueError("XPM image uses undefined colour %r" % e.args[0])
+    return Image.frombytes("RGBA", (width, height), bytes(pixels))
+
+
+def _parse_xpm_colour(definition):
+    values = {}
+    key = None
+    for word in definition.split():
+        if word in XPM_COLOUR_KEYS or word == "s":
+            key = word
+            values[key] = []
+        elif key is not None:
+            values[key].append(word)
+    for key in XPM_COLOUR_KEYS:
+        if values.get(key):
+            return _get_xpm_colour(" ".join(values[key]))
+    raise ValueError("XPM colour %r has no usable value" % definition)
+
+
+def _get_xpm_colour(name):
+    # X11 colour names may be written with spaces and in any case (e.g. "Light Grey"), and numbered greys go in steps
+    # of one percent
+    name = name.lower().replace(" ", "")
+    if name in ["none", "transparent"]:
+        return b"\x00\x00\x00\x00"
+    if name.startswith("#"):
+        digits = name[1:]
+        if len(digits) not in [3, 6, 9, 12] or not re.match(r"^[0-9a-f]+$", digits):
+            raise ValueError("Unknown XPM colour %s" % name)
+        step = len(digits) // 3
+        return bytes([int(digits[index:index + step], 16) * 255 // (16 ** step - 1)
+                      for index in range(0, len(digits), step)] + [255])
+    match = re.match(r"^gr[ae]y(\d+)$", name)
+    if match and int(match.group(1)) <= 100:
+        level = int(round(int(match.group(1)) * 2.55))
+        return bytes([level, level, level, 255])
+    from PIL import ImageColor
+    return bytes(list(ImageColor.getrgb(name)[:3]) + [255])
+
+
+def _fit_icon_image(image, size):
+    from PIL import Image
+    if image.size == (size, size):
+        return image
+    # Scale to fit (preserving aspect ratio) and centre on a transparent square canvas
+    scale = float(size) / max(image.size)
+    scaled = image.resize((max(1, int(round(image.width * scale))), max(1, int(round(image.height * scale)))),
+                          Image.LANCZOS)
+    canvas = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    canvas.paste(scaled, ((size - scaled.width) // 2, (size - scaled.height) // 2))
+    return canvas
+
+
+def write_ico(images, ico_file):
+    # ICONDIR header and one ICONDIRENTRY per image, followed by the images themselves stored as png
+    frames = []
+    for image in images:
+        frame = io.BytesIO()
+        with report.call("Image.save"):
+            image.save(frame, format="PNG")
+        frames.append((image.width, image.height, frame.getvalue()))
+
+    offset = 6 + 16 * len(frames)
+    directory = struct.pack("<HHH", 0, 1, len(frames))
+    for width, height, data in frames:
+        # Dimensions of 256 are stored as 0
+        directory += struct.pack("<BBBBHHII", width % 256, height % 256, 0, 0, 1, 32, len(data), offset)
+        offset += len(data)
+
+    with open(ico_file, "wb") as ico_handle:
+        ico_handle.write(directory)
+        for width, height, data in frames:
+            ico_handle.write(data)
+
+
+# Content addressed store of converted icons shared by every menu item, theme and target name. Entries are keyed by a
+# hash of the source icon and the conversion settings, and evicted least recently used first once over max_size bytes.
+class IconCache(object):
+    extensions = [".ico"]
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get_key(self, icon_paths):
+        digest = hashlib.sha256()
+        digest.update(("%s:%s:%s:%s;" % (
+            ICON_CACHE_VERSION,
+            ICON_SIZES,
+            environment.has_cairosvg,
+            environment.has_imagemagick
+        )).encode("utf-8"))
+        for icon_path in icon_paths:
+            with open(icon_path, "rb") as icon_handle:
+                for block in iter(lambda: icon_handle.read(65536), b""):
+                    digest.update(block)
+            digest.update(b";")
+        return digest.hexdigest()
+
+    def fetch(self, key, metadata_prefix):
+        cached_files = [os.path.join(self.directory, key + extension) for extension in self.extensions]
+        if not all(os.path.exists(cached_file) for cached_file in cached_files):
+            return None
+        try:
+            for cached_file, extension in zip(cached_files, self.extensions):
+                _link_or_copy(cached_file, metadata_prefix + extension)
+                # Keep track of recent use for eviction
+                os.utime(cached_file)
+        except OSError:
+            logger.debug("Could not use cached icon %s", key, exc_info=True)
+            return None
+        return metadata_prefix + ".ico"
+
+    def store(self, key, metadata_prefix):
+        try:
+            for extension in self.extensions:
+                # Copy then rename so concurrent workers never see a partially written file
+                cached_file = os.path.join(self.directory, key + extension)
+                temporary_file = "%s.%d.tmp" % (cached_file, os.getpid())
+                shutil.copyfile(metadata_prefix + extension, temporary_file)
+                os.replace(temporary_file, cached_file)
+        except OSError:
+            logger.debug("Could not add %s to icon cache", metadata_prefix, exc_info=True)
+
+    def evict(self):
+        cached_files = []
+        for directory_entry in os.scandir(self.directory):
+            if directory_entry.is_file():
+                stat = directory_entry.stat()
+                cached_files.append((stat.st_mtime, stat.st_size, directory_entry.path))
+        total_size = sum(size for mtime, size, path in cached_files)
+        for mtime, size, path in sorted(cached_files):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+                logger.debug("Evicted %s from icon cache", path)
+            except OSError:
+                pass
+
+
+def _link_or_copy(source, destination):
+    # Hard links are free where source and destination share a filesystem, otherwise fall back to a plain copy
+    try:
+        os.remove(destination)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+# Holds back log records made by a thread while it is capturing them, so output from icon conversion (which may be done
+# in another process) can be replayed grouped by menu item. Records from any other thread go through as usual.
+class _CapturingFilter(logging.Filter):
+
+    def __init__(self):
+        super(_CapturingFilter, self).__init__()
+        self.formatter = logging.Formatter("%(message)s")
+        self.local = threading.local()
+
+    def filter(self, record):
+        records = getattr(self.local, "records", None)
+        if records is None:
+            return True
+        records.append((record.levelno, self.formatter.format(record)))
+        return False
+
+    @contextlib.contextmanager
+    def capture(self):
+        records = []
+        self.local.records = records
+        try:
+            yield records
+        finally:
+            self.local.records = None
+
+
+log_capture = _CapturingFilter()
+logger.addFilter(log_capture)
+
+
+def _convert_windows_icon_task(icon_path, metadata_prefix, icon_cache=None, decoded=None):
+    # Log records and external call timings are handed back with the result, since this may run in another process
+    started = time.perf_counter()
+    with log_capture.capture() as records, report.capture_calls() as calls:
+        ico_file = convert_windows_icon_files(icon_path, metadata_prefix, icon_cache=icon_cache, decoded=decoded)
+    return ico_file, records, calls, time.perf_counter() - started
+
+
+# Runs tasks immediately in the calling process, for when a worker pool is not worth its start up cost
+class _InlineExecutor(concurrent.futures.Executor):
+
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def get_icon_executor(jobs):
+    if jobs <= 1:
+        return _InlineExecutor()
+    # This is linux only, and fork avoids workers re-importing (and so re-probing the environment) from scratch. Ctrl+C
+    # is left to the main process to deal with.
+    return concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork"),
+                                                  initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+
+
+# Converts icons in the background for apply_plan. One converter can be shared between several plans, and each icon
+# source is only converted once however many menu items (or targets) use it - the rest get a copy of the result.
+# Submitting gives the conversion's future, and whether it was already under way for someone else. Icons with sources
+# only imagemagick can read are deferred, and once the rest are done decode_deferred runs it over all of them at once.
+class IconConverter(object):
+
+    def __init__(self, jobs=1, icon_cache=None):
+        self.jobs = jobs
+        self.icon_cache = icon_cache
+        self.executor = get_icon_executor(jobs)
+        self.conversions = {}
+        self.icon_paths = {}
+        self.metadata_prefixes = {}
+        self.lock = threading.Lock()
+        if jobs > 1:
+            # Start the workers now, as forking them later on while other threads are busy is asking for trouble
+            self.executor.submit(int).result()
+
+    def submit(self, icon_path, metadata_prefix):
+        with self.lock:
+            if icon_path in self.conversions:
+                return self.conversions[icon_path], True
+            self.conversions[icon_path] = self.executor.submit(
+                _convert_windows_icon_task,
+                icon_path,
+                metadata_prefix,
+                self.icon_cache,
+                {}
+            )
+            self.icon_paths[self.conversions[icon_path]] = icon_path
+            self.metadata_prefixes[icon_path] = metadata_prefix
+            return self.conversions[icon_path], False
+
+    def is_deferred(self, conversion):
+        return isinstance(conversion.exception(), IconDecodingDeferred)
+
+    def decode_deferred(self, conversions):
+        # Gives the conversions which take over from the given deferred ones, in the same order. Those which another
+        # plan has already seen to are shared rather than decoded again.
+        replacements = []
+        pending = collections.OrderedDict()
+        with self.lock:
+            for conversion in conversions:
+                icon_path = self.icon_paths[conversion]
+                if self.conversions.get(icon_path, conversion) is conversion:
+                    self.conversions[icon_path] = concurrent.futures.Future()
+                    self.icon_paths[self.conversions[icon_path]] = icon_path
+                    pending[icon_path] = (self.conversions[icon_path], conversion.exception().sources)
+                replacements.append(self.conversions[icon_path])
+        if not pending:
+            return replacements
+
+        sources = sorted(set(source for replacement, icon_sources in pending.values() for source in icon_sources))
+        logger.debug("Converting %d icon files using imagemagick", len(sources))
+        with tempfile.TemporaryDirectory(prefix="wsl-windows-toolbar-icons-") as directory:
+            decoded = decode_icons_with_imagemagick(sources, directory)
+            # The icons themselves are converted as usual, now python has pngs to read in place of the sources
+            submitted = [(replacement, self.executor.submit(_convert_windows_icon_task, icon_path,
+                                                            self.metadata_prefixes[icon_path], self.icon_cache,
+                                                            decoded))
+                         for icon_path, (replacement, icon_sources) in pending.items()]
+            for replacement, conversion in submitted:
+                try:
+                    replacement.set_result(conversion.result())
+                except Exception as e:
+                    replacement.set_exception(e)
+        return replacements
+
+    def reset(self):
+        # Forget what has been converted so far, for when the icon files may have changed since
+        with self.lock:
+            self.conversions = {}
+            self.icon_paths = {}
+            self.metadata_prefixes = {}
+        if self.icon_cache is not None:
+            self.icon_cache.evict()
+
+    def close(self):
+        self.executor.shutdown()
+        if self.icon_cache is not None:
+            self.icon_cache.evict()
+
+
+# Walks the menu tree, yielding (menu path, desktop entry) for each application as soon as it is found. Two applications
+# at the same menu path would make for the same shortcut, so only the first of them is kept.
+def iter_desktop_entries(menu, seen=None):
+    import xdg.Menu
+    if seen is None:
+        seen = {}
     for entry in menu.getEntries():
         if isinstance(entry, xdg.Menu.Menu):
             # Recurse subdirectory
-            get_desktop_entries(entry, entries)
+            yield from iter_desktop_entries(entry, seen)
         elif isinstance(entry, xdg.Menu.MenuEntry):
             # We are only interested in "Application" entries
             if entry.DesktopEntry.getType() == "Application":
@@ -542,29 +3429,305 @@ def get_desktop_entries(menu, entries=None):
                     prefix = menu.getPath() + os.sep
                 else:
                     prefix = ""
-                entries[prefix + entry.DesktopEntry.getName()] = entry.DesktopEntry
+                path = prefix + entry.DesktopEntry.getName()
+                if path in seen:
+                    logger.warning("Skipping %s as %s is already at menu path %s", entry.DesktopFileID, seen[path],
+                                   path)
+                    continue
+                seen[path] = entry.DesktopFileID
+                yield path, DesktopEntryRecord.from_desktop_entry(entry.DesktopEntry)
+
+
+def get_desktop_entries(menu):
+    return collections.OrderedDict(iter_desktop_entries(menu))
+
+
+# The parts of a desktop entry which shortcuts are made from - all that is kept of an application once its menu has
+# been parsed, so this is also what the menu cache holds
+class DesktopEntryRecord(collections.namedtuple("DesktopEntryRecord", ["name", "exec", "path", "terminal", "icon",
+                                                                       "comment"])):
+
+    @classmethod
+    def from_desktop_entry(cls, desktop_entry):
+        return cls(
+            desktop_entry.getName(),
+            desktop_entry.getExec(),
+            desktop_entry.getPath(),
+            desktop_entry.getTerminal(),
+            desktop_entry.getIcon(),
+            desktop_entry.getComment()
+        )
+
 
-    return entries
+# Directories a parsed menu takes its desktop entries (and submenu .directory files) from, and their subdirectories
+def get_menu_directories(menu):
+    directories = set()
+    menus = [menu]
+    while menus:
+        menu = menus.pop()
+        for directory in menu.AppDirs + menu.DirectoryDirs:
+            for subdirectory, _, _ in os.walk(directory):
+                directories.add(subdirectory)
+        menus.extend(menu.Submenus)
+    return sorted(directories)
+
+
+# Gives the (menu path, desktop entry) of each application in a menu file like iter_desktop_entries, from the menu cache
+# when nothing which went into the menu has changed since it was saved. Otherwise the menu is parsed up front, and its
+# entries walked (and the cache saved) as they are used.
+def load_menu_entries(menu_file, rebuild=False):
+    cache_file = MENU_CACHE_FILE % hashlib.sha1(os.path.abspath(menu_file).encode("utf-8")).hexdigest()[:12]
+    if not rebuild:
+        try:
+            with open(cache_file) as cache_handle:
+                saved = json.load(cache_handle)
+            if saved["version"] == MENU_CACHE_VERSION and saved["menu_file"] == os.path.abspath(menu_file) and \
+                    saved["fingerprint"] == get_menu_fingerprint(menu_file, saved["directories"]):
+                logger.debug("Loaded menu entries for %s from %s", menu_file, cache_file)
+                return [(path, DesktopEntryRecord(*fields)) for path, fields in saved["entries"]]
+            logger.debug("Menu cache %s is out of date", cache_file)
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError):
+            logger.debug("Could not read menu cache %s", cache_file, exc_info=True)
+
+    import xdg.Menu
+    with MENU_PARSE_LOCK, report.call("xdg.Menu.parse"):
+        menu = xdg.Menu.parse(menu_file)
+    return _iter_menu_entries_to_cache(menu, menu_file, cache_file)
+
+
+def _iter_menu_entries_to_cache(menu, menu_file, cache_file):
+    entries = []
+    for path, entry in iter_desktop_entries(menu):
+        entries.append([path, list(entry)])
+        yield path, entry
+
+    directories = get_menu_directories(menu)
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file + ".tmp", "w") as cache_handle:
+            json.dump({
+                "version": MENU_CACHE_VERSION,
+                "menu_file": os.path.abspath(menu_file),
+                "directories": directories,
+                "fingerprint": get_menu_fingerprint(menu_file, directories),
+                "entries": entries
+            }, cache_handle)
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError:
+        logger.warning("Could not save menu cache to %s", cache_file)
+
+
+# Everything a parsed menu depends on, as far as can be told from stats alone - the menu file, the menu directories
+# (which hold any merged menus), the desktop entry directories the menu used or might start to use, every file in them,
+# and the environment variables which pyxdg takes into account
+def get_menu_fingerprint(menu_file, directories):
+    import xdg.BaseDirectory
+    menu_file = os.path.abspath(menu_file)
+    roots = set(directories)
+    roots.add(os.path.join(os.path.dirname(menu_file), "applications-merged"))
+    for config_directory in [xdg.BaseDirectory.xdg_config_home] + xdg.BaseDirectory.xdg_config_dirs:
+        roots.add(os.path.join(config_directory, "menus"))
+    for data_directory in xdg.BaseDirectory.xdg_data_dirs:
+        roots.add(os.path.join(data_directory, "applications"))
+        roots.add(os.path.join(data_directory, "desktop-directories"))
+
+    paths = [menu_file]
+    for root in sorted(roots):
+        paths.append(root)
+        for directory, _, file_names in os.walk(root):
+            paths.extend([directory] + [os.path.join(directory, file_name) for file_name in file_names])
+
+    stats = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stats[path] = [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            stats[path] = None
+    return {
+        "environment": [os.environ.get(name) for name in MENU_ENVIRONMENT],
+        "stats": stats
+    }
+
+
+# Threads taking an inventory - stat calls over drvfs spend most of their time waiting on windows, so a good few of
+# them are worth having under way at once
+INVENTORY_THREADS = 16
+# Files kept in the metadata directory for each menu item, which are tidied away along with a shortcut no menu item
+# accounts for any more (.png files are from older versions)
+STALE_METADATA_EXTENSIONS = [".sh", ".bat", ".ico", ".png"]
+
+InventoryEntry = collections.namedtuple("InventoryEntry", ["writable", "size", "mtime", "is_directory"])
+
+
+# Everything in a target's install and metadata directories as of the start of a run, taken in a single pass with a
+# thread listing each directory. Entries are kept by path for the rest of the run to look things up in rather than go
+# back to windows, and directories which couldn't be listed are kept in errors.
+class FileInventory(object):
+
+    def __init__(self, roots, threads=INVENTORY_THREADS):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.entries = {}
+        self.errors = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = set(executor.submit(self._scan_root, root) for root in self.roots)
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    entries, error = future.result()
+                    if error is not None:
+                        self.errors[error[0]] = error[1]
+                    for path, entry in entries:
+                        self.entries[path] = entry
+                        if entry.is_directory:
+                            pending.add(executor.submit(self._scan_directory, path))
+
+    @staticmethod
+    def _scan_root(root):
+        try:
+            stat = os.stat(root)
+        except FileNotFoundError:
+            return [], None
+        except OSError as e:
+            return [], (root, str(e))
+        return [(root, InventoryEntry(os.access(root, os.W_OK), stat.st_size, stat.st_mtime, True))], None
+
+    @staticmethod
+    def _scan_directory(directory):
+        entries = []
+        try:
+            with os.scandir(directory) as directory_entries:
+                for directory_entry in directory_entries:
+                    stat = directory_entry.stat(follow_symlinks=False)
+                    entries.append((directory_entry.path, InventoryEntry(
+                        os.access(directory_entry.path, os.W_OK, follow_symlinks=False),
+                        stat.st_size,
+                        stat.st_mtime,
+                        directory_entry.is_dir(follow_symlinks=False)
+                    )))
+        except OSError as e:
+            return entries, (directory, str(e))
+        return entries, None
+
+    def covers(self, path):
+        return any(path == root or path.startswith(root + os.sep) for root in self.roots)
+
+    def exists(self, path):
+        path = os.path.abspath(path)
+        return path in self.entries if self.covers(path) else os.path.exists(path)
+
+    def get_unwritable(self, root):
+        # Anything under root (or root itself) which can't be written to, or can't even be looked at
+        root = os.path.abspath(root)
+        return sorted([path for path, entry in self.entries.items() if not entry.writable and
+                       (path == root or path.startswith(root + os.sep))] +
+                      [path for path in self.errors if path == root or path.startswith(root + os.sep)])
+
+    def get_stale_files(self, install_directory, metadata_directory, shortcut_suffix, accounted_for):
+        # Generated files which no menu item accounts for. Only shortcuts named the way they are generated (ending in
+        # the shortcut suffix) are taken to be ours, along with the launchers and icons kept for the same menu path in
+        # the metadata directory - anything else was put there by someone else and is left alone.
+        if not shortcut_suffix:
+            return []
+        install_directory = os.path.abspath(install_directory)
+        metadata_directory = os.path.abspath(metadata_directory)
+        accounted_for = set(os.path.abspath(path) for path in accounted_for)
+        shortcut_ending = shortcut_suffix + ".lnk"
+        stale_files = []
+        stale_paths = set()
+        for path, entry in self.entries.items():
+            if not entry.is_directory and path not in accounted_for and path.startswith(install_directory + os.sep) \
+                    and path.endswith(shortcut_ending):
+                stale_files.append(path)
+                stale_paths.add(path[len(install_directory) + 1:-len(shortcut_ending)])
+        for path, entry in self.entries.items():
+            prefix, extension = os.path.splitext(path)
+            if not entry.is_directory and path not in accounted_for and path.startswith(metadata_directory + os.sep) \
+                    and extension in STALE_METADATA_EXTENSIONS and prefix[len(metadata_directory) + 1:] in stale_paths:
+                stale_files.append(path)
+        return sorted(stale_files)
+
+
+MANIFEST_FILE_NAME = "manifest.json"
+MANIFEST_VERSION = 2
+
+
+def load_manifest(metadata_directory):
+    manifest_file = os.path.join(metadata_directory, MANIFEST_FILE_NAME)
+    try:
+        with open(manifest_file) as manifest_handle:
+            manifest = json.load(manifest_handle)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest["entries"]
+        logger.info("Ignoring manifest %s from a different version", manifest_file)
+    except FileNotFoundError:
+        logger.debug("No manifest found at %s - all menu items will be generated", manifest_file)
+    except (ValueError, KeyError, AttributeError):
+        logger.warning("Ignoring unreadable manifest %s - all menu items will be generated", manifest_file)
+    return {}
+
+
+def save_manifest(metadata_directory, entries):
+    manifest_file = os.path.join(metadata_directory, MANIFEST_FILE_NAME)
+    # Write then rename so an interrupted run never leaves a truncated manifest behind
+    with open(manifest_file + ".tmp", "w") as manifest_handle:
+        json.dump({"version": MANIFEST_VERSION, "entries": entries}, manifest_handle, indent=1, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def get_entry_fingerprint(entry, icon_path, run_fingerprint):
+    icon_mtime = None
+    if icon_path:
+        try:
+            icon_mtime = os.stat(icon_path).st_mtime
+        except OSError:
+            pass
+    fields = [
+        entry.exec,
+        entry.path,
+        entry.terminal,
+        entry.icon,
+        entry.comment,
+        icon_path,
+        icon_mtime,
+        run_fingerprint
+    ]
+    if icon_path:
+        # Whether the icon can be converted at all depends on which converters are around, so an icon which failed to
+        # convert is tried again once one turns up (say after installing cairosvg)
+        fields.append([environment.has_cairosvg, environment.has_imagemagick])
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
 
 
-def is_directory_writable(base_path):
-    writable = True
-    # Check the directory is writable
-    if os.access(base_path, os.W_OK):
-        logger.debug("Can write to %s", base_path)
+def remove_generated_files(files, roots, threads=1):
+    # Each removal is a round trip to windows, so a lot of them at once are better spread over a few threads
+    if threads > 1 and len(files) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(functools.partial(_remove_generated_file, roots=roots), files))
     else:
-        writable = False
-        logger.error("Cannot write to %s", base_path)
+        for generated_file in files:
+            _remove_generated_file(generated_file, roots)
 
-    for root, dirs, files in os.walk(base_path):
-        for path in dirs + files:
-            if os.access(base_path, os.W_OK):
-                logger.debug("Can write to %s", os.path.join(root, path))
-            else:
-                writable = False
-                logger.error("Cannot write to %s", os.path.join(root, path))
 
-    return writable
+def _remove_generated_file(generated_file, roots):
+    try:
+        os.remove(generated_file)
+        logger.debug("Removed %s", generated_file)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logger.warning("Could not remove %s", generated_file)
+        return
+    # Tidy up any menu directories left empty, but never the roots themselves
+    directory = os.path.dirname(generated_file)
+    while any(directory.startswith(root + os.sep) for root in roots):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
 
 
 if __name__ == '__main__':